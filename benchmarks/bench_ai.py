@@ -0,0 +1,206 @@
+"""Throughput benchmark of the `AI` cog, without Discord or Azure.
+
+The cog is driven with fake Discord messages (with mentions and attachments) while a local stub
+(`benchmarks.stub_openai`) plays the Responses and Whisper APIs. Tools are replaced by stubs that
+only wait for their configured latency. For every concurrency level it reports messages per second,
+time to the first reply, reply latency percentiles and the event loop lag.
+
+    python -m benchmarks.bench_ai --concurrency 1,2,4,8 --messages 40 --mention-ratio 0.5
+
+The full bot dependencies must be installed, since the real cog is imported.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+from .fakes import FakeAttachment, FakeBot, FakeChannel, FakeMessage, FakeUser
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else float("nan"),
+    }
+
+
+def parse_weights(text: str) -> dict[str, float]:
+    weights = {}
+    for item in filter(None, text.split(",")):
+        name, _, value = item.partition("=")
+        weights[name.strip()] = float(value or 1)
+    return weights
+
+
+def start_stub(args: argparse.Namespace) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "benchmarks.stub_openai",
+        "--port", str(args.port),
+        "--ttft", str(args.ttft),
+        "--tokens-per-second", str(args.tokens_per_second),
+    ]
+    if args.script:
+        command += ["--script", args.script]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The stub server didn't start.")
+
+
+def stub_tool(latency: float):
+    async def handler(context: Any, **arguments: Any) -> str:
+        await asyncio.sleep(latency)
+        return f"Stub result for {arguments}."
+    return handler
+
+
+async def monitor_lag(samples: list[float], interval: float = 0.05) -> None:
+    """Measure how late the event loop wakes up from a sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def run_level(args: argparse.Namespace, concurrency: int) -> dict[str, Any]:
+    from tmg_bot.ai import AI
+
+    bot = FakeBot()
+    cog = AI(bot)
+    base_url = f"http://127.0.0.1:{args.port}"
+    scenarios = parse_weights(args.scenarios)
+    rng = random.Random(args.seed + concurrency)
+    latencies: list[float] = []
+    first_replies: list[float] = []
+    lag: list[float] = []
+    per_user = max(1, args.messages // concurrency)
+
+    async def user(index: int) -> None:
+        author = FakeUser(f"user{index}")
+        channel = FakeChannel(f"channel{index % args.channels}")
+        for _ in range(per_user):
+            mentioned = rng.random() < args.mention_ratio
+            scenario = rng.choices(list(scenarios), weights=list(scenarios.values()))[0]
+            attachments = []
+            if rng.random() < args.attachment_ratio:
+                attachments.append(FakeAttachment(base_url, "notes.txt", "text/plain", args.attachment_size))
+            message = FakeMessage(
+                author,
+                channel,
+                f"[scenario:{scenario}] ¿Cómo se deriva x^2?",
+                mentions=[bot.user] if mentioned else [],
+                attachments=attachments,
+            )
+            start = time.perf_counter()
+            await cog.on_message(message)
+            if mentioned:
+                latencies.append(time.perf_counter() - start)
+                if message.first_reply_at is not None:
+                    first_replies.append(message.first_reply_at - start)
+
+    monitor = asyncio.create_task(monitor_lag(lag))
+    start = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    return {
+        "concurrency": concurrency,
+        "messages": per_user * concurrency,
+        "replies": len(latencies),
+        "elapsed": elapsed,
+        "messages_per_second": per_user * concurrency / elapsed,
+        "first_reply": summarize(first_replies),
+        "reply_latency": summarize(latencies),
+        "loop_lag": summarize(lag),
+    }
+
+
+async def run_levels(args: argparse.Namespace) -> list[dict[str, Any]]:
+    # Every level runs in the same event loop, since the locks and semaphores of the bot bind
+    # to the first loop that waits on them.
+    results = []
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        result = await run_level(args, concurrency)
+        results.append(result)
+        print(
+            f"concurrency={result['concurrency']:>3}  "
+            f"msg/s={result['messages_per_second']:7.2f}  "
+            f"first reply p50={result['first_reply']['p50']:6.2f}s  "
+            f"reply p50={result['reply_latency']['p50']:6.2f}s "
+            f"p95={result['reply_latency']['p95']:6.2f}s "
+            f"p99={result['reply_latency']['p99']:6.2f}s  "
+            f"loop lag p99={result['loop_lag']['p99'] * 1000:6.1f}ms "
+            f"max={result['loop_lag']['max'] * 1000:6.1f}ms"
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Comma separated numbers of simultaneous users.")
+    parser.add_argument("--messages", type=int, default=40, help="Messages per concurrency level.")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--mention-ratio", type=float, default=0.5)
+    parser.add_argument("--attachment-ratio", type=float, default=0.2)
+    parser.add_argument("--attachment-size", type=int, default=20_000)
+    parser.add_argument("--scenarios", default="default=1", help="Weights of the stub scenarios, like default=3,search=1.")
+    parser.add_argument("--script", help="Scenario script for the stub server.")
+    parser.add_argument("--tool-latency", default="bing_search=1.5,solve_math=4,render_manim=10")
+    parser.add_argument("--ttft", type=float, default=0.6)
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    stub = start_stub(args)
+    # The cog saves its state as it runs, so it's kept away from the files of the real bot
+    state_dir = tempfile.TemporaryDirectory(prefix="bench_ai-")
+    try:
+        os.environ["STATE_PATH"] = os.path.join(state_dir.name, "state.sqlite3")
+        os.environ["BROKER_PATH"] = os.path.join(state_dir.name, "broker.sqlite3")
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+        os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+        os.environ.setdefault("SUPABASE_KEY", "unused")
+        from tmg_bot.tools import academic_tools
+
+        for name, latency in parse_weights(args.tool_latency).items():
+            academic_tools.tools[name].handler = stub_tool(latency)
+
+        results = asyncio.run(run_levels(args))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=4)
+    finally:
+        stub.terminate()
+        if "tmg_bot.state" in sys.modules:
+            sys.modules["tmg_bot.state"].store.flush()
+        state_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark of the reply normalizer against the regex chain it replaced.
+
+Replies from `benchmarks/fixtures/replies.json` are concatenated into longer ones, and both
+implementations normalize each size `--repeat` times. Reports the median time and throughput of
+each one, and how many of the replies they normalize differently (the legacy chain rewrites
+quotes inside math and code, and puts a stray backslash after `$$` for `\\[...\\]`).
+
+    python -m benchmarks.bench_normalize --sizes 1,10,100 --repeat 20
+
+Only `emoji` needs to be installed.
+"""
+import argparse
+import json
+import pathlib
+import re
+import statistics
+import time
+from typing import Callable
+
+import emoji
+
+from tmg_bot.normalize import normalize
+
+fixtures_dir = pathlib.Path(__file__).parent / "fixtures"
+
+# The previous implementation, kept verbatim for comparison
+tex_message = re.compile(r"(\$.*?\$)|(\$\$.*?\$\$)|\\\(.*?\\\)|\\\[.*?\\\]", re.DOTALL)
+mentions = re.compile(r"<@!?\d+>")
+double_quotes = re.compile(r"\"(.*?)\"")
+single_quotes = re.compile(r"'(.*?)'")
+markdown_list = re.compile(r"^(\*|\+|\-)\s+(.*)", re.MULTILINE)
+
+
+def change_prefix_and_suffix(tex: str) -> str:
+    if tex.startswith("\\(") and tex.endswith("\\)"):
+        return f"${tex[2:-2]}$"
+    elif tex.startswith("\\[") and tex.endswith("\\]"):
+        return f"$$\\{tex[2:-2]}$$"
+    else:
+        return tex
+
+
+def legacy_fix_tex_bugs(text: str) -> str:
+    without_emojis = emoji.replace_emoji(text, "")
+    without_mentions = mentions.sub("Usuario de Discord", without_emojis)
+    beautify_quotes = double_quotes.sub(r"“\1”", without_mentions)
+    beautify_quotes = single_quotes.sub(r"‘\1’", beautify_quotes)
+    force_dollars = tex_message.sub(
+        lambda m: change_prefix_and_suffix(m.group(0)), beautify_quotes
+    )
+    result = markdown_list.sub(
+        lambda m: f"* {m.group(2)}", force_dollars
+    )
+    return result
+
+
+def time_function(function: Callable[[str], str], text: str, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", default=str(fixtures_dir / "replies.json"), help="JSON list of {name, text}.")
+    parser.add_argument("--sizes", default="1,10,100", help="How many copies of the corpus each reply has.")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    replies = [reply["text"] for reply in json.loads(pathlib.Path(args.replies).read_text(encoding="utf-8"))]
+    different = [i for i, text in enumerate(replies) if normalize(text) != legacy_fix_tex_bugs(text)]
+    print(f"{len(different)} of {len(replies)} replies are normalized differently: {different}")
+
+    corpus = "\n\n".join(replies)
+    print(f"{'size':>10} {'legacy':>12} {'normalize':>12} {'speedup':>8}")
+    for copies in (int(size) for size in args.sizes.split(",")):
+        text = "\n\n".join([corpus] * copies)
+        legacy = time_function(legacy_fix_tex_bugs, text, args.repeat)
+        new = time_function(normalize, text, args.repeat)
+        mb = len(text.encode("utf-8")) / 1e6
+        print(
+            f"{len(text):>10} {legacy * 1000:>9.2f} ms {new * 1000:>9.2f} ms {legacy / new:>7.2f}x"
+            f"   ({mb / legacy:.1f} vs {mb / new:.1f} MB/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
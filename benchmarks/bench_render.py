@@ -0,0 +1,215 @@
+"""Micro-benchmarks of the TeX and Manim rendering pipelines.
+
+Every stage is timed separately, over a corpus of real-world replies and `videos_dataset` rows
+(see `benchmarks/fixtures`):
+
+- TeX replies: `latex` (both passes), `dvipng` and the PNG `encode`, with the sizes before and
+  after encoding.
+- Manim scenes: scene code execution, frame rendering (the `play` and `wait` calls) and the final
+  ffmpeg encode of the movie. Every run gets an empty Tex cache, so MathTex compilation is
+  included in the execution time like for a scene the bot hasn't seen before.
+
+    python -m benchmarks.bench_render --repeat 3 --save before.json
+    python -m benchmarks.bench_render --repeat 3 --compare before.json
+
+Rows exported from the `videos_dataset` table can be benchmarked with `--scenes rows.json`. When
+comparing, stages whose median got slower than `--threshold` are reported as regressions and the
+exit code is 1.
+"""
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+fixtures_dir = pathlib.Path(__file__).parent / "fixtures"
+
+
+class StageTimer:
+    """Accumulates the time spent in each stage of a single run."""
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def wrap(self, name: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def bench_tex(replies: list[dict[str, str]], repeat: int, dpi: int | None) -> dict[str, list[dict[str, float]]]:
+    from PIL import Image
+    from tmg_bot.tex_blocks import choose_dpi, dvi_size, encode_png
+    from tmg_bot.utils import run_dvipng, run_latex, write_tex
+
+    results: dict[str, list[dict[str, float]]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        temp_dir = pathlib.Path(directory)
+        for reply in replies:
+            runs = []
+            for _ in range(repeat):
+                timer = StageTimer()
+                markdown = write_tex(temp_dir, reply["name"], reply["text"])
+                try:
+                    with timer.stage("latex"):
+                        run_latex(temp_dir, reply["name"], markdown)
+                    width, height = dvi_size(str(temp_dir / f"{reply['name']}.dvi"))
+                    with timer.stage("dvipng"):
+                        png = run_dvipng(temp_dir, reply["name"], dpi=dpi or choose_dpi(width * height))
+                except subprocess.CalledProcessError as e:
+                    print(f"tex/{reply['name']}: {e}", file=sys.stderr)
+                    break
+                with Image.open(png) as image, timer.stage("encode"):
+                    encoded = encode_png(image)
+                timer.stages["png_bytes"] = png.stat().st_size
+                timer.stages["encoded_bytes"] = len(encoded)
+                runs.append(dict(timer.stages))
+            results[f"tex/{reply['name']}"] = runs
+    return results
+
+
+def render_scene(row: dict[str, Any], timer: StageTimer, tex_cache_dir: str) -> None:
+    import manim
+    from manim.mobject.text import tex_mobject
+    from tmg_bot.tex_cache import TexCache
+    from tmg_bot.tools import ResponseScene, ResponseScene3D
+
+    # Importing the tools installs the production cache, replaced by an empty one for this run
+    tex_mobject.tex_to_svg_file = TexCache(tex_cache_dir).svg_file
+    scene_class = ResponseScene3D if row.get("is_3d") else ResponseScene
+    manim.config.output_file = scene_class.__name__
+    manim.config.write_to_movie = True
+    scene = scene_class(
+        title=row["title"],
+        description=row["description"],
+        type=row.get("type", "video"),
+        data=[{"code": row["code"]}],
+    )
+    # Time spent in `play` (and `wait`, which goes through it) renders frames and writes
+    # the partial movie files. The rest of `construct` is the execution of the scene code.
+    renderer = scene.renderer
+    renderer.play = timer.wrap("frames", renderer.play)
+    file_writer = renderer.file_writer
+    file_writer.finish = timer.wrap("encode", file_writer.finish)
+    start = time.perf_counter()
+    scene.render()
+    total = time.perf_counter() - start
+    timer.stages["exec"] = total - timer.stages["frames"] - timer.stages["encode"]
+
+
+def bench_manim(rows: list[dict[str, Any]], repeat: int, quality: str) -> dict[str, list[dict[str, float]]]:
+    import manim
+
+    results: dict[str, list[dict[str, float]]] = {}
+    with tempfile.TemporaryDirectory() as directory, manim.tempconfig({"quality": quality, "media_dir": directory, "disable_caching": True, "progress_bar": "none"}):
+        for row in rows:
+            runs = []
+            for _ in range(repeat):
+                timer = StageTimer()
+                try:
+                    with tempfile.TemporaryDirectory(prefix="tex_cache-") as tex_cache_dir:
+                        render_scene(row, timer, tex_cache_dir)
+                except Exception as e:
+                    print(f"manim/{row['title']}: {type(e).__name__}: {e}", file=sys.stderr)
+                    break
+                runs.append(dict(timer.stages))
+            results[f"manim/{row['title']}"] = runs
+    return results
+
+
+def medians(results: dict[str, list[dict[str, float]]]) -> dict[str, dict[str, float]]:
+    summary = {}
+    for case, runs in results.items():
+        if runs:
+            summary[case] = {stage: statistics.median(run[stage] for run in runs) for stage in runs[0]}
+    return summary
+
+
+def print_summary(summary: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]] | None) -> None:
+    for case, stages in summary.items():
+        parts = []
+        for stage, value in stages.items():
+            if stage.endswith("_bytes"):
+                parts.append(f"{stage}={int(value)}")
+                continue
+            part = f"{stage}={value * 1000:8.1f}ms"
+            if baseline and stage in baseline.get(case, {}):
+                before = baseline[case][stage]
+                part += f" ({(value - before) / before:+.0%})" if before else ""
+            parts.append(part)
+        print(f"{case:40} " + "  ".join(parts))
+
+
+def regressions(summary: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], threshold: float) -> list[str]:
+    found = []
+    for case, stages in summary.items():
+        for stage, value in stages.items():
+            before = baseline.get(case, {}).get(stage)
+            if not stage.endswith("_bytes") and before and value > before * (1 + threshold):
+                found.append(f"{case} {stage}: {before * 1000:.1f}ms -> {value * 1000:.1f}ms")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", default=str(fixtures_dir / "replies.json"), help="JSON list of {name, text}.")
+    parser.add_argument("--scenes", default=str(fixtures_dir / "scenes.json"), help="JSON list of videos_dataset rows.")
+    parser.add_argument("--only", choices=["tex", "manim"], help="Run a single pipeline.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dpi", type=int, help="Fixed DPI. By default it's chosen from the page size, like the bot does.")
+    parser.add_argument("--quality", default="high_quality", help="Manim quality, like low_quality or high_quality.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with the results saved in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression.")
+    args = parser.parse_args()
+
+    # The tools module builds its clients at import time, but never calls them here.
+    os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+    os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+    os.environ.setdefault("SUPABASE_KEY", "unused")
+
+    results: dict[str, list[dict[str, float]]] = {}
+    if args.only != "manim":
+        replies = json.loads(pathlib.Path(args.replies).read_text(encoding="utf-8"))
+        results.update(bench_tex(replies, args.repeat, args.dpi))
+    if args.only != "tex":
+        rows = json.loads(pathlib.Path(args.scenes).read_text(encoding="utf-8"))
+        results.update(bench_manim(rows, args.repeat, args.quality))
+
+    summary = medians(results)
+    baseline = None
+    if args.compare:
+        baseline = json.loads(pathlib.Path(args.compare).read_text(encoding="utf-8"))["summary"]
+    print_summary(summary, baseline)
+    if args.save:
+        pathlib.Path(args.save).write_text(json.dumps({
+            "settings": {"repeat": args.repeat, "dpi": args.dpi, "quality": args.quality},
+            "summary": summary,
+            "runs": results,
+        }, indent=4), encoding="utf-8")
+    if baseline is not None:
+        found = regressions(summary, baseline, args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Minimal stand-ins for the Discord objects the `AI` cog uses."""
+import itertools
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+
+_ids = itertools.count(1_000_000)
+
+
+class FakeUser:
+    def __init__(self, name: str) -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.mention = f"<@{self.id}>"
+        self.roles: list[Any] = []
+
+    def mentioned_in(self, message: "FakeMessage") -> bool:
+        return self in message.mentions
+
+
+class FakeChannel:
+    def __init__(self, name: str) -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.mention = f"<#{self.id}>"
+
+    async def send(self, content: str | None = None, **kwargs: Any) -> "FakeSentMessage":
+        return FakeSentMessage(content)
+
+
+class FakeAttachment:
+    def __init__(self, base_url: str, filename: str, content_type: str, size: int) -> None:
+        self.url = f"{base_url}/files/{filename}?size={size}"
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+
+
+class FakeSentMessage:
+    def __init__(self, content: str | None) -> None:
+        self.id = next(_ids)
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content: str | None = None, **kwargs: Any) -> "FakeSentMessage":
+        self.content = content
+        self.edits += 1
+        return self
+
+    async def add_reaction(self, emoji: str) -> None:
+        pass
+
+
+class FakeMessage:
+    """A message sent by a user. Records when the bot first replied to it."""
+
+    def __init__(
+        self,
+        author: FakeUser,
+        channel: FakeChannel,
+        content: str,
+        mentions: list[FakeUser] | None = None,
+        attachments: list[FakeAttachment] | None = None,
+    ) -> None:
+        self.id = next(_ids)
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.mentions = mentions or []
+        self.attachments = attachments or []
+        self.reference = None
+        self.created_at = datetime.now(timezone.utc)
+        self.replies: list[FakeSentMessage] = []
+        self.first_reply_at: float | None = None
+
+    async def reply(self, content: str | None = None, **kwargs: Any) -> FakeSentMessage:
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        sent = FakeSentMessage(content)
+        self.replies.append(sent)
+        return sent
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.user = FakeUser("TheMathGuysBot")
+        self.guilds: list[Any] = []
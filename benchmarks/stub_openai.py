@@ -0,0 +1,228 @@
+"""Local stub of the OpenAI Responses and Whisper APIs, for benchmarks.
+
+Responses are scripted: a message whose text contains `[scenario:<name>]` follows the turns of
+that scenario in the script file, and any other message follows the `default` scenario. Every
+turn can call tools and/or answer with text:
+
+    {
+        "default": [{"text_tokens": 120}],
+        "search": [
+            {"tool_calls": [{"name": "bing_search", "arguments": {"query": "teorema de Pitágoras"}}]},
+            {"text_tokens": 300}
+        ]
+    }
+
+Run it with `python -m benchmarks.stub_openai --port 8765` and point the bot to it with
+`OPENAI_BASE_URL=http://127.0.0.1:8765/v1`. It also serves fake attachments at
+`/files/<name>?size=<bytes>`.
+"""
+import argparse
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+
+DEFAULT_SCRIPT: dict[str, list[dict[str, Any]]] = {
+    "default": [{"text_tokens": 120}],
+}
+WORDS = "la derivada de una función mide cómo cambia su valor cuando cambia la variable".split()
+scenario_tag = re.compile(r"\[scenario:([\w-]+)\]")
+
+
+class StubState:
+    """Script, latency settings and the turn reached by every response chain."""
+
+    def __init__(self, script: dict[str, list[dict[str, Any]]], ttft: float, tokens_per_second: float, jitter: float, whisper_latency: float) -> None:
+        self.script = script
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.whisper_latency = whisper_latency
+        self.turns: dict[str, tuple[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def delay(self, seconds: float) -> None:
+        time.sleep(max(0.0, seconds * (1.0 + random.uniform(-self.jitter, self.jitter))))
+
+    def next_turn(self, body: dict[str, Any]) -> tuple[str, int, dict[str, Any]]:
+        previous = body.get("previous_response_id")
+        items = body.get("input")
+        continues = isinstance(items, list) and any(
+            isinstance(item, dict) and item.get("type") == "function_call_output" for item in items
+        )
+        with self.lock:
+            if continues and previous in self.turns:
+                scenario, turn = self.turns[previous]
+                turn += 1
+            else:
+                match = scenario_tag.search(json.dumps(items, ensure_ascii=False))
+                scenario = match.group(1) if match and match.group(1) in self.script else "default"
+                turn = 0
+        turns = self.script[scenario]
+        return scenario, turn, turns[min(turn, len(turns) - 1)]
+
+    def remember(self, response_id: str, scenario: str, turn: int) -> None:
+        with self.lock:
+            self.turns[response_id] = (scenario, turn)
+
+
+def make_response(response_id: str, model: str, output: list[dict[str, Any]], input_tokens: int, output_tokens: int) -> dict[str, Any]:
+    return {
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": model,
+        "output": output,
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    state: StubState
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        # Attachment downloads: /files/<name>?size=<bytes>
+        match = re.fullmatch(r"/files/[^?]+\?size=(\d+)", self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        body = b"x" * int(match.group(1))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        if self.path.endswith("/responses"):
+            self.responses(json.loads(raw))
+        elif self.path.endswith("/audio/transcriptions"):
+            self.state.delay(self.state.whisper_latency)
+            self.send_json({"text": "Transcripción de prueba."})
+        else:
+            self.send_error(404)
+
+    def send_json(self, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, event: dict[str, Any]) -> None:
+        self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def responses(self, body: dict[str, Any]) -> None:
+        state = self.state
+        scenario, turn, script = state.next_turn(body)
+        response_id = f"resp_{secrets.token_hex(12)}"
+        state.remember(response_id, scenario, turn)
+        model = body.get("model", "stub")
+        input_tokens = len(json.dumps(body.get("input"), ensure_ascii=False)) // 4
+        output: list[dict[str, Any]] = []
+        for call in script.get("tool_calls", []):
+            output.append({
+                "type": "function_call",
+                "id": f"fc_{secrets.token_hex(8)}",
+                "call_id": f"call_{secrets.token_hex(8)}",
+                "name": call["name"],
+                "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False),
+                "status": "completed",
+            })
+        text_tokens = script.get("text_tokens", 0)
+        words = [WORDS[i % len(WORDS)] for i in range(text_tokens)]
+        message_id = f"msg_{secrets.token_hex(8)}"
+        text = " ".join(words)
+        if text:
+            output.append({
+                "type": "message",
+                "id": message_id,
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            })
+        response = make_response(response_id, model, output, input_tokens, text_tokens + 20 * len(script.get("tool_calls", [])))
+        state.delay(state.ttft)
+        if not body.get("stream"):
+            state.delay(text_tokens / state.tokens_per_second)
+            self.send_json(response)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        in_progress = dict(response, status="in_progress", output=[], usage=None)
+        self.send_event({"type": "response.created", "sequence_number": 0, "response": in_progress})
+        sequence = 1
+        # Deltas are flushed every 50 ms, like a real stream coalesced by the network
+        chunk = max(1, int(state.tokens_per_second * 0.05))
+        for i in range(0, len(words), chunk):
+            state.delay(len(words[i:i + chunk]) / state.tokens_per_second)
+            self.send_event({
+                "type": "response.output_text.delta",
+                "sequence_number": sequence,
+                "item_id": message_id,
+                "output_index": len(output) - 1,
+                "content_index": 0,
+                "delta": ("" if i == 0 else " ") + " ".join(words[i:i + chunk]),
+            })
+            sequence += 1
+        if text:
+            self.send_event({
+                "type": "response.output_text.done",
+                "sequence_number": sequence,
+                "item_id": message_id,
+                "output_index": len(output) - 1,
+                "content_index": 0,
+                "text": text,
+            })
+            sequence += 1
+        self.send_event({"type": "response.completed", "sequence_number": sequence, "response": response})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--script", help="JSON file with the scenarios to follow.")
+    parser.add_argument("--ttft", type=float, default=0.6, help="Seconds until the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative random variation of every delay.")
+    parser.add_argument("--whisper-latency", type=float, default=1.5)
+    args = parser.parse_args()
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+    state = StubState(script, args.ttft, args.tokens_per_second, args.jitter, args.whisper_latency)
+    handler = type("BoundHandler", (Handler,), {"state": state})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Stub OpenAI server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+from tmg_bot.broker import Broker
+
+
+def test_renders_wait_in_order_of_priority_for_a_slot(tmp_path) -> None:
+    broker = Broker(str(tmp_path / "broker.sqlite3"))
+    first = broker.put_render(1, 1, "worker-1", 5)
+    assert broker.poll_render(first, 1) == ("running", None)
+    normal = broker.put_render(2, 1, "worker-2", 5)
+    high = broker.put_render(3, 0, "worker-2", 5)
+    assert broker.poll_render(normal, 1) == ("waiting", 2)
+    assert broker.poll_render(high, 1) == ("waiting", 1)
+    assert broker.active_renders() == 3
+    broker.finish_render(first)
+    assert broker.poll_render(normal, 1) == ("waiting", 2)
+    assert broker.poll_render(high, 1) == ("running", None)
+
+
+def test_full_queue_rejects_counted_renders_only(tmp_path) -> None:
+    broker = Broker(str(tmp_path / "broker.sqlite3"))
+    running = broker.put_render(1, 1, "worker-1", 1)
+    broker.poll_render(running, 1)
+    assert broker.put_render(2, 1, "worker-1", 1) is not None
+    assert broker.put_render(3, 1, "worker-2", 1) is None
+    assert broker.put_render(4, 2, "worker-2", None) is not None
+    assert broker.active_renders() == 2
+
+
+def test_cancel_reaches_the_renders_of_a_message(tmp_path) -> None:
+    broker = Broker(str(tmp_path / "broker.sqlite3"))
+    render = broker.put_render(1, 1, "worker-1", 5)
+    broker.put("answer", 1, {})
+    assert broker.cancel(1) == 2
+    assert broker.poll_render(render, 1) == ("cancelled", None)
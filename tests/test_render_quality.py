@@ -0,0 +1,40 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("discord")
+
+from tmg_bot.quality import HIGH, LOW, MEDIUM, choose_quality
+from tmg_bot.render_queue import RenderQueue
+
+
+def test_render_queued_behind_another_user_gets_low_quality() -> None:
+    loads: dict[str, int] = {}
+
+    async def main() -> None:
+        queue = RenderQueue(max_concurrent=1, max_length=5)
+        first_started = asyncio.Event()
+        release_first = asyncio.Event()
+
+        async def first(cancel_event: threading.Event, load: int) -> None:
+            loads["first"] = load
+            first_started.set()
+            await release_first.wait()
+
+        async def second(cancel_event: threading.Event, load: int) -> None:
+            loads["second"] = load
+
+        first_task = asyncio.create_task(queue.submit(1, first))
+        await first_started.wait()
+        second_task = asyncio.create_task(queue.submit(2, second))
+        await asyncio.sleep(0)
+        assert queue.queued == 1
+        release_first.set()
+        await asyncio.gather(first_task, second_task)
+
+    asyncio.run(main())
+    # A long 2D video is downgraded once for its duration, and once more when it had to wait
+    assert choose_quality(30.0, False, loads["first"]) is MEDIUM
+    assert choose_quality(30.0, False, loads["second"]) is LOW
+    assert choose_quality(5.0, False, loads["first"]) is HIGH
@@ -0,0 +1,35 @@
+import pytest
+
+from tmg_bot.solution_cache import SolutionCache, normalize_problem
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("Distancia entre (1,2) y (3,4)", "Distancia entre (1.2) y (3.4)"),
+        ("A={1,2,3}", "A={1.2.3}"),
+        ("f(1,234)", "f(1234)"),
+    ],
+)
+def test_different_problems_have_different_keys(first: str, second: str) -> None:
+    cache = SolutionCache("test")
+    assert cache.key(first) != cache.key(second)
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("Distancia entre (1, 2) y (3, 4)", "Distancia entre (1,2) y (3,4)"),
+        ("Calcula $\\dfrac{1}{2}$", "calcula \\(\\frac{1}{2}\\)"),
+        ("¿Cuánto es 2.50 + 1?", "cuanto es 2.5+1"),
+    ],
+)
+def test_equivalent_problems_have_the_same_key(first: str, second: str) -> None:
+    assert normalize_problem(first) == normalize_problem(second)
+
+
+def test_cached_solution_is_returned_for_the_same_problem_only() -> None:
+    cache = SolutionCache("test")
+    cache.put("Distancia entre (1,2) y (3,4)", "2\\sqrt{2}")
+    assert cache.get("Distancia entre (1, 2) y (3, 4)") == "2\\sqrt{2}"
+    assert cache.get("Distancia entre (1.2) y (3.4)") is None
@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+from tmg_bot.state import ConversationStore
+
+
+def test_read_sees_writes_of_other_processes(tmp_path) -> None:
+    path = str(tmp_path / "state.sqlite3")
+    first = ConversationStore(path)
+    second = ConversationStore(path)
+    first.write("academic", {"response_id": "resp_1"})
+    assert second.read("academic") == {"response_id": "resp_1"}
+    first.write("academic", {"response_id": "resp_2"})
+    assert second.read("academic") == {"response_id": "resp_2"}
+
+
+def test_read_prefers_the_pending_local_value(tmp_path) -> None:
+    store = ConversationStore(str(tmp_path / "state.sqlite3"))
+    store.write("key", 1)
+    store.set("key", 2)
+    assert store.read("key") == 2
+
+
+def test_failed_flush_keeps_the_dirty_keys(tmp_path, monkeypatch) -> None:
+    path = str(tmp_path / "state.sqlite3")
+    store = ConversationStore(path)
+    store.get("buffer:1")
+    store.set("buffer:1", {"entries": []})
+    connection = store._connection
+
+    class FailingConnection:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def executemany(self, *args):
+            raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(store, "_connection", FailingConnection())
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    monkeypatch.setattr(store, "_connection", connection)
+    store.flush()
+    assert ConversationStore(path).get("buffer:1") == {"entries": []}
+
+
+def test_shared_lock_has_a_single_owner_until_it_expires(tmp_path) -> None:
+    path = str(tmp_path / "state.sqlite3")
+    first = ConversationStore(path)
+    second = ConversationStore(path)
+    assert first.acquire("ai", "worker-1", 60.0)
+    assert not second.acquire("ai", "worker-2", 60.0)
+    assert first.acquire("ai", "worker-1", 60.0)
+    first.release("ai", "worker-1")
+    assert second.acquire("ai", "worker-2", -1.0)
+    # An expired lease can be taken by another owner
+    assert first.acquire("ai", "worker-1", 60.0)
@@ -1,12 +1,34 @@
 from dotenv import load_dotenv
+import argparse
+import asyncio
+import logging
 import os
 import discord
 
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
 from .ai import AI
+from .broker import Broker
 
 def main() -> None:
+    parser = argparse.ArgumentParser(prog="tmg-bot")
+    parser.add_argument(
+        "--mode",
+        choices=["standalone", "gateway", "worker"],
+        default=os.getenv("TMG_MODE", "standalone"),
+        help="standalone answers in this process. gateway only keeps the Discord connection and "
+        "queues requests for worker processes, which answer them.",
+    )
+    args = parser.parse_args()
+    if args.mode == "worker":
+        from .worker import run_worker
+        asyncio.run(run_worker(os.getenv("DISCORD_TOKEN")))
+        return
     tmg_bot = discord.Bot(intents=discord.Intents.all(), activity=discord.Game(name="math"))
-    tmg_bot.add_cog(AI(tmg_bot))
+    tmg_bot.add_cog(AI(tmg_bot, broker=Broker() if args.mode == "gateway" else None))
     tmg_bot.run(os.getenv("DISCORD_TOKEN"))
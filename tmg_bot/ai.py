@@ -1,37 +1,81 @@
 from discord.ext import commands
 import discord
 import json
+import logging
+import os
 from io import StringIO
-import time
-from typing import Any
+import asyncio
+import dataclasses
+from typing import Any, Awaitable
 
-from .utils import attachment_parts, render_tex
-from .tools import render_manim, solve_math, bing_search
+from .broker import Broker
+from .buffer import ChannelBuffer
+from .utils import AttachmentRef, attachment_parts, render_tex
+from .tools import academic_tools
 from .instructions import ACADEMIC_INSTRUCTIONS
 from .regex import tex_message
-from .locks import ai_lock
-from .client import client
+from .locks import ai_lock, shared_lock
+from .entitlements import Entitlements
+from .metrics import inflight_requests, start_server
+from .state import store
+from .streaming import StreamingReply, stream_response
+from . import tools, tracing
 from .supabase_client import supabase
 
 
-mecenas: int = 1357139735700574218
+logger = logging.getLogger(__name__)
+
 message_limit: int = 500
+buffer_max_messages: int = 50
+buffer_max_bytes: int = 256 * 1024
+attachment_budget_bytes: int = 25 * 1024 * 1024
+tool_concurrency: int = 3
+edit_debounce: float = 1.5  # Seconds without new edits before an edited message is answered again
 
 
 class AI(commands.Cog):
-    current_input: list[dict[str, Any]] = []
-    previous_response_id: str | None = None
-    message_count: int = 0
-
-    def __init__(self, bot: discord.Bot) -> None:
+    def __init__(self, bot: discord.Bot, broker: Broker | None = None) -> None:
         self.bot = bot
+        # In gateway mode, requests are put on the broker and answered by worker processes
+        self.broker = broker
+        self.buffers: dict[int, ChannelBuffer] = {}
+        # Work in progress for each message, and the content of edited messages before their pending edits
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.edit_origins: dict[int, str] = {}
+        self.entitlements = Entitlements(bot)
+        self.metrics_server = None
     
     @commands.Cog.listener()
     async def on_ready(self) -> None:
-        print("Bot is ready")
+        logger.info("Bot is ready")
+        metrics_port = os.getenv("METRICS_PORT")
+        if metrics_port and self.metrics_server is None:
+            self.metrics_server = await start_server(os.getenv("METRICS_HOST", "127.0.0.1"), int(metrics_port))
     
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild) -> None:
+        self.entitlements.index_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild) -> None:
+        self.entitlements.index_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        self.entitlements.forget_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
+        if before.roles != after.roles:
+            self.entitlements.update(after)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member) -> None:
+        self.entitlements.remove(member)
+
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member) -> None:
+        self.entitlements.update(member)
         general_id = 1045453709221568535
         rules_id = 1046564924035436674
         aplus_id = 1196603434254737468
@@ -41,6 +85,15 @@ class AI(commands.Cog):
         if general is not None and rules is not None and aplus is not None:
             await general.send(f"¡Bienvenido {member.mention} a The Math Guys! Recuerda leer todas las reglas en {rules.mention} y verificarte ahí mismo. ¡Disfruta tu estadía! {aplus}")
     
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        if self.cancel_message_work(payload.message_id):
+            logger.info("Cancelled the response to deleted message %d", payload.message_id)
+        if tools.render_queue.cancel(payload.message_id):
+            logger.info("Cancelled the renders of deleted message %d", payload.message_id)
+        if self.broker is not None and await asyncio.to_thread(self.broker.cancel, payload.message_id):
+            logger.info("Cancelled the jobs of deleted message %d", payload.message_id)
+
     # Reaction
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent) -> None:
@@ -118,324 +171,252 @@ class AI(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: discord.Message, after: discord.Message) -> None:
+        # The bot edits its own replies many times while streaming them
         if after.author == self.bot.user:
             return
-        if isinstance(after.channel, discord.DMChannel):
-            rol_mecenas = discord.utils.get(self.bot.guilds[0].roles, id=mecenas)
-            guild_member = discord.utils.get(self.bot.guilds[0].members, id=after.author.id)
-            if guild_member is None:
-                await after.reply(
-                    content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser miembro y además mecenas de The Math Guys. Si quieres unirte al servidor, únete en https://discord.gg/the-math-guys, y para unirte al club de sus donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
-                )
-                return
-            if rol_mecenas not in guild_member.roles:
-                await after.reply(
-                    content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser mecenas de The Math Guys. Si quieres unirte al club de los donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
+        # Edits are also dispatched when Discord adds embeds to a message
+        if before.content == after.content and before.attachments == after.attachments:
+            return
+        previous_message = self.edit_origins.setdefault(after.id, before.content)
+        await self.run_message_work(after.id, self.handle_edit(after, previous_message))
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message) -> None:
+        await self.run_message_work(message.id, self.handle_message(message, previous_message=None))
+
+    async def handle_edit(self, message: discord.Message, previous_message: str) -> None:
+        """Handle an edited message once it hasn't been edited again for `edit_debounce` seconds."""
+        await asyncio.sleep(edit_debounce)
+        self.edit_origins.pop(message.id, None)
+        # The job queued for the previous version would be answered besides the new one
+        if self.broker is not None and await asyncio.to_thread(self.broker.cancel, message.id):
+            logger.info("Cancelled the jobs of edited message %d", message.id)
+        await self.handle_message(message, previous_message)
+
+    async def run_message_work(self, message_id: int, coroutine: Awaitable[None]) -> None:
+        """Run the work for a message, cancelling the work for its previous version."""
+        self.cancel_message_work(message_id, keep_origin=True)
+        task = asyncio.create_task(coroutine)
+        self.tasks[message_id] = task
+        try:
+            await asyncio.wait([task])
+        finally:
+            if self.tasks.get(message_id) is task:
+                del self.tasks[message_id]
+        if not task.cancelled():
+            task.result()
+
+    def cancel_message_work(self, message_id: int, keep_origin: bool = False) -> bool:
+        """Cancel the pending or running work for a message. Returns whether there was any."""
+        if not keep_origin:
+            self.edit_origins.pop(message_id, None)
+        task = self.tasks.pop(message_id, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def get_buffer(self, channel_id: int) -> ChannelBuffer:
+        """Get the buffer of unaddressed messages for a channel, restoring or creating it if needed."""
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            buffer = ChannelBuffer(buffer_max_messages, buffer_max_bytes)
+            saved = store.get(f"buffer:{channel_id}")
+            if saved is not None:
+                buffer.restore(
+                    [
+                        {**entry, "attachments": [AttachmentRef(**a) for a in entry["attachments"]]}
+                        for entry in saved["entries"]
+                    ],
+                    saved["dropped"],
                 )
-                return
-        async with ai_lock:
-            io = StringIO()
-            json.dump(
-                {
-                    "message": after.content,
-                    "user_ping": after.author.mention,
-                    "user_name": after.author.name,
-                    "channel": after.channel.name if not isinstance(after.channel, discord.DMChannel) else "DM Channel",
-                    "channel_mention": after.channel.mention if not isinstance(after.channel, discord.DMChannel) else after.author.mention,
-                    "time_utc": after.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                    "replying_to_user_with_ping": after.reference.resolved.author.mention if after.reference and isinstance(after.reference.resolved, discord.Message) else None,
-                    "previous_message": before.content,
-                },
-                io,
-                ensure_ascii=False,
-                indent=4,
-            )
-            io.seek(0)
-            self.current_input.append(
-                {
-                    "role": "user",
-                    "content": [],
-                }
+            self.buffers[channel_id] = buffer
+        return buffer
+
+    def save_buffer(self, channel_id: int, buffer: ChannelBuffer) -> None:
+        store.set(f"buffer:{channel_id}", buffer.snapshot())
+
+    async def check_dm_access(self, message: discord.Message) -> bool:
+        """Check if the author of a DM can use the bot, replying with the reason if not."""
+        entitlement = await self.entitlements.lookup(message.author.id)
+        if not entitlement.is_member:
+            await message.reply(
+                content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser miembro y además mecenas de The Math Guys. Si quieres unirte al servidor, únete en https://discord.gg/the-math-guys, y para unirte al club de sus donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
             )
-            self.current_input[-1]["content"].append(
-                {
-                    "type": "input_text",
-                    "text": io.getvalue(),
-                }
+            return False
+        if not entitlement.is_mecenas:
+            await message.reply(
+                content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser mecenas de The Math Guys. Si quieres unirte al club de los donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
             )
-            self.current_input[-1]["content"].extend(await attachment_parts(after.attachments))
-            self.message_count += 1
-            if self.message_count > message_limit:
-                self.previous_response_id = None
-                self.message_count = 0
-            if self.bot.user.mentioned_in(after) or isinstance(after.channel, discord.DMChannel):
-                user_input = self.current_input.copy()
-                there_was_function_call: bool = True
-                self.current_input.clear()
-                while there_was_function_call:
-                    there_was_function_call = False
-                    response = client.responses.create(
-                        model="gpt-4.1",
-                        input=user_input,
-                        instructions=ACADEMIC_INSTRUCTIONS,
-                        temperature=0.0,
-                        previous_response_id=self.previous_response_id,
-                        tools=[
-                            {
-                                "type": "function",
-                                "name": "bing_search",
-                                "description": "Search the internet.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "query": {
-                                            "type": "string",
-                                            "description": "The search query.",
-                                        },
-                                    },
-                                    "required": ["query"],
-                                    "additionalProperties": False,
-                                }
-                            },
-                            {
-                                "type": "function",
-                                "name": "render_manim",
-                                "description": "Render a Manim animation.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "title": {
-                                            "type": "string",
-                                            "description": "The title of the animation.",
-                                        },
-                                        "description": {
-                                            "type": "string",
-                                            "description": "The description of the animation. It's all what should be shown in the rendered video.",
-                                        },
-                                        "is_3d": {
-                                            "type": "boolean",
-                                            "description": "Whether the scene is 3D or not.",
-                                        },
-                                        "type": {
-                                            "type": "string",
-                                            "description": "The type of output.",
-                                            "enum": ["image", "video"],
-                                        }
-                                    },
-                                    "required": ["title", "description", "is_3d", "type"],
-                                    "additionalProperties": False,
-                                }
-                            },
-                            {
-                                "type": "function",
-                                "name": "solve_math",
-                                "description": "Solve a math problem.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "problem_statement": {
-                                            "type": "string",
-                                            "description": "The math problem statement.",
-                                        },
-                                    },
-                                    "required": ["problem_statement"],
-                                    "additionalProperties": False,
-                                }
-                            }
-                        ]
+            return False
+        return True
+
+    async def build_input(self, entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Turn buffered entries into model input, processing only the attachments within the budget.
+
+        The newest attachments are preferred. The ones that don't fit are replaced by a short note.
+        """
+        budget = attachment_budget_bytes
+        selected: set[tuple[int, int]] = set()
+        for i in range(len(entries) - 1, -1, -1):
+            attachments = entries[i]["attachments"]
+            for j in range(len(attachments) - 1, -1, -1):
+                if attachments[j].size <= budget:
+                    budget -= attachments[j].size
+                    selected.add((i, j))
+        user_input = []
+        for i, entry in enumerate(entries):
+            content = list(entry["content"])
+            for j, attachment in enumerate(entry["attachments"]):
+                if (i, j) in selected:
+                    content.extend(await attachment_parts([attachment]))
+                else:
+                    content.append(
+                        {
+                            "type": "input_text",
+                            "text": f"The attachment {attachment.describe()} was omitted because it exceeds the context budget.",
+                        }
                     )
-                    output = response.output
-                    self.previous_response_id = response.id
-                    user_input = []
-                    for out in output:
-                        if not isinstance(out, dict):
-                            out = out.to_dict(mode="json")
-                        if out.get("type") == "function_call":
-                            there_was_function_call = True
-                            name = content.get("name")
-                            arguments = json.loads(out.get("arguments"))
-                            if name == "render_manim":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = await render_manim(after, **arguments)
-                            elif name == "bing_search":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = bing_search(**arguments)
-                            elif name == "solve_math":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = solve_math(**arguments)
-                            user_input.append({
-                                "type": "function_call_output",
-                                "call_id": out.get("call_id"),
-                                "output": str(result)
-                            })
-                        contents = out.get("content")
-                        if contents:
-                            for content in contents:
-                                if content.get("type") == "output_text":
-                                    for i in range(0, len(content.get("text")), 2000):
-                                        await after.reply(content=content.get("text")[i:i + 2000])
-                                    if tex_message.search(content.get("text")):
-                                        await render_tex(after, content.get("text"))
-                    time.sleep(2.0)  # Avoid rate limit
+            user_input.append({"role": entry["role"], "content": content})
+        return user_input
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message) -> None:
+    async def handle_message(self, message: discord.Message, previous_message: str | None) -> None:
+        """Buffer a new or edited message and respond to it if the bot was invoked."""
         if message.author == self.bot.user:
             return
         if isinstance(message.channel, discord.DMChannel):
-            rol_mecenas = discord.utils.get(self.bot.guilds[0].roles, id=mecenas)
-            guild_member = discord.utils.get(self.bot.guilds[0].members, id=message.author.id)
-            if guild_member is None:
-                await message.reply(
-                    content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser miembro y además mecenas de The Math Guys. Si quieres unirte al servidor, únete en https://discord.gg/the-math-guys, y para unirte al club de sus donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
-                )
-                return
-            if rol_mecenas not in guild_member.roles:
-                await message.reply(
-                    content="¿Quieres recibir ayuda de la IA por privado? Para eso, debes ser mecenas de The Math Guys. Si quieres unirte al club de los donadores, puedes hacerlo en el siguiente enlace: https://patreon.com/MathLike\nRecuerda avisar a MathLike cuando hayas donado para que te den el rol.",
-                )
+            if not await self.check_dm_access(message):
                 return
-        async with ai_lock:
-            io = StringIO()
-            json.dump(
-                {
-                    "message": message.content,
-                    "user_ping": message.author.mention,
-                    "user_name": message.author.name,
-                    "channel": message.channel.name if not isinstance(message.channel, discord.DMChannel) else "DM Channel",
-                    "channel_mention": message.channel.mention if not isinstance(message.channel, discord.DMChannel) else message.author.mention,
-                    "time_utc": message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                    "replying_to_user_with_ping": message.reference.resolved.author.mention if message.reference and isinstance(message.reference.resolved, discord.Message) else None,
-                    "previous_message": None
-                },
-                io,
-                ensure_ascii=False,
-                indent=4,
-            )
-            io.seek(0)
-            self.current_input.append(
-                {
-                    "role": "user",
-                    "content": [],
-                }
-            )
-            self.current_input[-1]["content"].append(
+        io = StringIO()
+        json.dump(
+            {
+                "message": message.content,
+                "user_ping": message.author.mention,
+                "user_name": message.author.name,
+                "channel": message.channel.name if not isinstance(message.channel, discord.DMChannel) else "DM Channel",
+                "channel_mention": message.channel.mention if not isinstance(message.channel, discord.DMChannel) else message.author.mention,
+                "time_utc": message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                "replying_to_user_with_ping": message.reference.resolved.author.mention if message.reference and isinstance(message.reference.resolved, discord.Message) else None,
+                "previous_message": previous_message,
+            },
+            io,
+            ensure_ascii=False,
+            indent=4,
+        )
+        io.seek(0)
+        entry = {
+            "role": "user",
+            "content": [
                 {
                     "type": "input_text",
                     "text": io.getvalue(),
                 }
-            )
-            self.current_input[-1]["content"].extend(await attachment_parts(message.attachments))
-            self.message_count += 1
-            if self.message_count > message_limit:
-                self.previous_response_id = None
-                self.message_count = 0
-            if self.bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel):
-                user_input = self.current_input.copy()
-                there_was_function_call: bool = True
-                self.current_input.clear()
-                while there_was_function_call:
-                    there_was_function_call = False
-                    response = client.responses.create(
+            ],
+            "attachments": [AttachmentRef.from_attachment(a) for a in message.attachments],
+        }
+        buffer = self.get_buffer(message.channel.id)
+        dropped = buffer.append(entry)
+        if dropped:
+            logger.info("Dropped %d buffered messages in channel %d", dropped, message.channel.id)
+        self.save_buffer(message.channel.id, buffer)
+        if self.bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel):
+            with tracing.start_trace(
+                "on_message",
+                message_id=message.id,
+                channel_id=message.channel.id,
+                edited=previous_message is not None,
+            ):
+                await self.answer(message, buffer)
+
+    async def answer(self, message: discord.Message, buffer: ChannelBuffer) -> None:
+        """Answer a message that invoked the bot, with the buffered messages of its channel as context."""
+        entries, dropped = buffer.drain()
+        self.save_buffer(message.channel.id, buffer)
+        if self.broker is not None:
+            payload = {
+                "channel_id": message.channel.id,
+                "entries": [
+                    {**entry, "attachments": [dataclasses.asdict(a) for a in entry["attachments"]]}
+                    for entry in entries
+                ],
+                "dropped": dropped,
+            }
+            job_id = await asyncio.to_thread(self.broker.put, "answer", message.id, payload)
+            logger.info("Queued job %d for message %d", job_id, message.id)
+            return
+        await self.answer_entries(message, entries, dropped)
+
+    async def answer_entries(self, message: discord.Message, entries: list[dict[str, Any]], dropped: int) -> None:
+        """Answer a message with the given buffered entries as context."""
+        with tracing.span("build_input", entries=len(entries)):
+            user_input = await self.build_input(entries)
+        if dropped:
+            user_input.insert(0, {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "input_text",
+                        "text": f"{dropped} older messages of this channel were dropped and aren't included.",
+                    }
+                ],
+            })
+        await self.respond(message, user_input, len(entries))
+
+    async def respond(self, message: discord.Message, user_input: list[dict[str, Any]], messages: int) -> None:
+        """Answer a message with the academic model, running the tools it calls until it's done.
+
+        `messages` is how many Discord messages the input has. They count towards `message_limit`,
+        after which the conversation starts over.
+        """
+        inflight_requests.inc()
+        try:
+            # The lock is only held for the model calls, which read and move the chain. A response
+            # with function calls can't be continued by anyone else, so while its tools run the
+            # turn continues from its own responses, and the chain only moves to the last one.
+            # Turns completed by other users in the meantime are left out of the chain.
+            previous_response_id: str | None = None
+            message_count = 0
+            first_call = True
+            there_was_function_call: bool = True
+            while there_was_function_call:
+                there_was_function_call = False
+                reply = StreamingReply(message)
+                async with shared_lock(ai_lock, "ai"):
+                    if first_call:
+                        # Every worker continues the same chain, so it's read once the lock is held
+                        chain = await asyncio.to_thread(store.read, "academic", {})
+                        previous_response_id = chain.get("response_id")
+                        message_count = chain.get("message_count", 0) + messages
+                        if message_count > message_limit:
+                            previous_response_id = None
+                            message_count = messages
+                        first_call = False
+                    response = await stream_response(
+                        reply.feed,
                         model="gpt-4.1",
                         input=user_input,
                         instructions=ACADEMIC_INSTRUCTIONS,
                         temperature=0.0,
-                        previous_response_id=self.previous_response_id,
-                        tools=[
-                            {
-                                "type": "function",
-                                "name": "bing_search",
-                                "description": "Search the internet.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "query": {
-                                            "type": "string",
-                                            "description": "The search query.",
-                                        },
-                                    },
-                                    "required": ["query"],
-                                    "additionalProperties": False,
-                                },
-                            },
-                            {
-                                "type": "function",
-                                "name": "render_manim",
-                                "description": "Render a Manim animation.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "title": {
-                                            "type": "string",
-                                            "description": "The title of the animation.",
-                                        },
-                                        "description": {
-                                            "type": "string",
-                                            "description": "The description of the animation. It's all what should be shown in the rendered video.",
-                                        },
-                                        "is_3d": {
-                                            "type": "boolean",
-                                            "description": "Whether the scene is 3D or not.",
-                                        },
-                                        "type": {
-                                            "type": "string",
-                                            "description": "The type of output.",
-                                            "enum": ["image", "video"],
-                                        }
-                                    },
-                                    "additionalProperties": False,
-                                    "required": ["title", "description", "is_3d", "type"],
-                                }
-                            },
-                            {
-                                "type": "function",
-                                "name": "solve_math",
-                                "description": "Solve a math problem.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "problem_statement": {
-                                            "type": "string",
-                                            "description": "The math problem statement.",
-                                        },
-                                    },
-                                    "additionalProperties": False,
-                                    "required": ["problem_statement"],
-                                }
-                            }
-                        ]
+                        previous_response_id=previous_response_id,
+                        tools=academic_tools.schemas,
                     )
-                    output = response.output
-                    self.previous_response_id = response.id
-                    user_input = []
-                    for out in output:
-                        if not isinstance(out, dict):
-                            out = out.to_dict(mode="json")
-                        if out.get("type") == "function_call":
-                            there_was_function_call = True
-                            name = out.get("name")
-                            arguments = json.loads(out.get("arguments"))
-                            if name == "render_manim":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = await render_manim(message, **arguments)
-                            elif name == "bing_search":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = bing_search(**arguments)
-                            elif name == "solve_math":
-                                time.sleep(2.0)  # Avoid rate limit
-                                result = solve_math(**arguments)
-                            user_input.append({
-                                "type": "function_call_output",
-                                "call_id": out.get("call_id"),
-                                "output": str(result)
-                            })
-                        contents = out.get("content")
-                        if contents:
-                            for content in contents:
-                                if content.get("type") == "output_text":
-                                    for i in range(0, len(content.get("text")), 2000):
-                                        await message.reply(content=content.get("text")[i:i + 2000])
-                                    if tex_message.search(content.get("text")):
-                                        await render_tex(message, content.get("text"))
-                    time.sleep(2.0)  # Avoid rate limit
+                    await reply.close()
+                    output = [out if isinstance(out, dict) else out.to_dict(mode="json") for out in response.output]
+                    calls = [out for out in output if out.get("type") == "function_call"]
+                    if not calls:
+                        await asyncio.to_thread(
+                            store.write, "academic", {"response_id": response.id, "message_count": message_count}
+                        )
+                previous_response_id = response.id
+                there_was_function_call = bool(calls)
+                for out in output:
+                    contents = out.get("content")
+                    if contents:
+                        for content in contents:
+                            if content.get("type") == "output_text":
+                                if tex_message.search(content.get("text")):
+                                    await render_tex(message, content.get("text"))
+                user_input = await academic_tools.dispatch_calls(calls, message, tool_concurrency)
+                await asyncio.sleep(2.0)  # Avoid rate limit
+        finally:
+            inflight_requests.dec()
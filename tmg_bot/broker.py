@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+broker_path: str = os.getenv("BROKER_PATH", "broker.sqlite3")
+# A job whose lease isn't renewed in this time is handed to another worker, so a worker that
+# crashed or was restarted doesn't lose the requests it was answering.
+lease_seconds: float = 60.0
+max_attempts: int = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_message ON jobs (message_id);
+CREATE TABLE IF NOT EXISTS renders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    counted INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'waiting',
+    worker TEXT NOT NULL,
+    lease_until REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS renders_order ON renders (status, priority, id);
+CREATE INDEX IF NOT EXISTS renders_message ON renders (message_id);
+"""
+
+
+@dataclass(frozen=True)
+class Job:
+    id: int
+    kind: str
+    message_id: int
+    payload: dict[str, Any]
+    attempts: int
+
+
+class Broker:
+    """Job queue shared by the gateway process and the worker processes, backed by SQLite.
+
+    Jobs are leased by one worker at a time. Workers renew the lease while they work, and jobs
+    with an expired lease are leased again, up to `max_attempts` times.
+    """
+
+    def __init__(self, path: str = broker_path) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads, and the broker is used from `asyncio.to_thread`
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def put(self, kind: str, message_id: int, payload: dict[str, Any]) -> int:
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (kind, message_id, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, message_id, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        return cursor.lastrowid
+
+    def lease(self, worker: str) -> Job | None:
+        """Take the oldest job that is queued or whose lease expired."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, kind, message_id, payload, attempts FROM jobs"
+                " WHERE (status = 'queued' OR (status = 'leased' AND lease_until < ?))"
+                " ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            job_id, kind, message_id, payload, attempts = row
+            if attempts >= max_attempts:
+                connection.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'Too many attempts' WHERE id = ?",
+                    (job_id,),
+                )
+                connection.execute("COMMIT")
+                logger.warning("Job %d failed after %d attempts", job_id, attempts)
+                return self.lease(worker)
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease_seconds, job_id),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return Job(job_id, kind, message_id, json.loads(payload), attempts + 1)
+
+    def renew(self, job_id: int, worker: str) -> bool:
+        """Extend the lease of a job. Returns False if it was cancelled or taken by another worker."""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + lease_seconds, job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker: str, error: str | None = None) -> None:
+        """Mark a job as done or failed, unless it was cancelled or taken by another worker."""
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND status = 'leased'",
+            ("failed" if error else "done", error, job_id, worker),
+        )
+
+    def cancel(self, message_id: int) -> int:
+        """Cancel the queued and running jobs and renders of a message. Returns how many there were."""
+        connection = self._connection()
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'cancelled' WHERE message_id = ? AND status IN ('queued', 'leased')",
+            (message_id,),
+        )
+        cancelled = cursor.rowcount
+        cursor = connection.execute(
+            "UPDATE renders SET status = 'cancelled' WHERE message_id = ? AND status IN ('waiting', 'running')",
+            (message_id,),
+        )
+        return cancelled + cursor.rowcount
+
+    def purge(self, older_than: float = 86400.0) -> None:
+        """Delete finished jobs older than `older_than` seconds, and renders of workers that stopped."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND created_at < ?",
+            (now - older_than,),
+        )
+        connection.execute("DELETE FROM renders WHERE lease_until < ?", (now - lease_seconds,))
+
+    # Renders of every worker wait in a single queue, in order of priority and then of arrival,
+    # for one of a fixed number of slots. A worker renders its own jobs once they get a slot, and
+    # renews their lease while they wait and run, so the renders of a worker that stopped don't
+    # hold their place.
+
+    def put_render(self, message_id: int, priority: int, worker: str, max_waiting: int | None) -> int | None:
+        """Queue a render. Returns its ID, or None if `max_waiting` counted renders are already waiting.
+
+        Renders queued without a `max_waiting` aren't counted, like background re-renders.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if max_waiting is not None:
+                (waiting,) = connection.execute(
+                    "SELECT COUNT(*) FROM renders WHERE status = 'waiting' AND counted AND lease_until >= ?",
+                    (now,),
+                ).fetchone()
+                if waiting >= max_waiting:
+                    connection.execute("COMMIT")
+                    return None
+            cursor = connection.execute(
+                "INSERT INTO renders (message_id, priority, counted, worker, lease_until) VALUES (?, ?, ?, ?, ?)",
+                (message_id, priority, max_waiting is not None, worker, now + lease_seconds),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    def poll_render(self, render_id: int, max_running: int) -> tuple[str, int | None]:
+        """Renew the lease of a render and start it if it's first and a slot is free.
+
+        Returns its status (waiting, running or cancelled) and, while it waits, its position.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT priority, status FROM renders WHERE id = ?", (render_id,)).fetchone()
+            if row is None or row[1] == "cancelled":
+                connection.execute("COMMIT")
+                return "cancelled", None
+            priority, status = row
+            connection.execute("UPDATE renders SET lease_until = ? WHERE id = ?", (now + lease_seconds, render_id))
+            if status == "running":
+                connection.execute("COMMIT")
+                return "running", None
+            (ahead,) = connection.execute(
+                "SELECT COUNT(*) FROM renders WHERE status = 'waiting' AND lease_until >= ?"
+                " AND (priority < ? OR (priority = ? AND id < ?))",
+                (now, priority, priority, render_id),
+            ).fetchone()
+            (running,) = connection.execute(
+                "SELECT COUNT(*) FROM renders WHERE status = 'running' AND lease_until >= ?",
+                (now,),
+            ).fetchone()
+            if ahead == 0 and running < max_running:
+                connection.execute("UPDATE renders SET status = 'running' WHERE id = ?", (render_id,))
+                connection.execute("COMMIT")
+                return "running", None
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return "waiting", ahead + 1
+
+    def finish_render(self, render_id: int) -> None:
+        self._connection().execute("DELETE FROM renders WHERE id = ?", (render_id,))
+
+    def active_renders(self) -> int:
+        """Counted renders waiting for a slot or running, in every worker."""
+        (active,) = self._connection().execute(
+            "SELECT COUNT(*) FROM renders WHERE status IN ('waiting', 'running') AND counted AND lease_until >= ?",
+            (time.time(),),
+        ).fetchone()
+        return active
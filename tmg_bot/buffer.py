@@ -0,0 +1,72 @@
+from collections import deque
+from typing import Any
+
+
+def entry_size(entry: dict[str, Any]) -> int:
+    """Approximate the size in bytes of a buffered input entry."""
+    size = 0
+    for part in entry.get("content", []):
+        for key in ("text", "image_url"):
+            value = part.get(key)
+            if value:
+                size += len(value)
+    for attachment in entry.get("attachments", []):
+        size += len(attachment.url) + len(attachment.filename) + len(attachment.content_type)
+    return size
+
+
+class ChannelBuffer:
+    """Fixed-capacity ring buffer for the messages sent in a channel while the bot isn't invoked.
+
+    Both the number of messages and their total size are bounded. When either limit
+    is exceeded, the oldest entries are dropped and counted in `dropped`.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int) -> None:
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.dropped: int = 0
+        self._entries: deque[tuple[dict[str, Any], int]] = deque()
+        self._bytes: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def append(self, entry: dict[str, Any]) -> int:
+        """Append an entry and return how many old entries were dropped to make room for it."""
+        size = entry_size(entry)
+        self._entries.append((entry, size))
+        self._bytes += size
+        dropped = 0
+        # The newest entry is always kept, even if it's bigger than the byte limit by itself.
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_messages or self._bytes > self.max_bytes
+        ):
+            _, old_size = self._entries.popleft()
+            self._bytes -= old_size
+            dropped += 1
+        self.dropped += dropped
+        return dropped
+
+    def drain(self) -> tuple[list[dict[str, Any]], int]:
+        """Return the buffered entries and the number of dropped ones, and clear the buffer."""
+        entries = [entry for entry, _ in self._entries]
+        dropped = self.dropped
+        self._entries.clear()
+        self._bytes = 0
+        self.dropped = 0
+        return entries, dropped
+
+    def snapshot(self) -> dict[str, Any]:
+        """State of the buffer, for `restore`. Entries are shared, not copied."""
+        return {"entries": [entry for entry, _ in self._entries], "dropped": self.dropped}
+
+    def restore(self, entries: list[dict[str, Any]], dropped: int) -> None:
+        """Refill an empty buffer with saved entries, applying the current limits."""
+        for entry in entries:
+            self.append(entry)
+        self.dropped += dropped
@@ -1,12 +1,21 @@
 import os
 from azure.ai.projects import AIProjectClient
 from azure.identity import DefaultAzureCredential
-from openai import AzureOpenAI
+from openai import AzureOpenAI, OpenAI
 
-project_client = AIProjectClient.from_connection_string(
-    conn_str=os.getenv("AZURE_CONN_STR"),
-    credential=DefaultAzureCredential(),
-)
-client: AzureOpenAI = project_client.inference.get_azure_openai_client(
-    api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-)
+if os.getenv("OPENAI_BASE_URL"):
+    # Plain OpenAI-compatible endpoint, used to run the bot against local stubs (see `benchmarks`).
+    # Azure-only features, like the Bing search agent, aren't available.
+    project_client: AIProjectClient | None = None
+    client: OpenAI = OpenAI(
+        base_url=os.getenv("OPENAI_BASE_URL"),
+        api_key=os.getenv("OPENAI_API_KEY", "unused"),
+    )
+else:
+    project_client = AIProjectClient.from_connection_string(
+        conn_str=os.getenv("AZURE_CONN_STR"),
+        credential=DefaultAzureCredential(),
+    )
+    client: AzureOpenAI = project_client.inference.get_azure_openai_client(
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    )
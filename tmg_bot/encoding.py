@@ -0,0 +1,152 @@
+import json
+import logging
+import pathlib
+import subprocess
+import time
+from dataclasses import dataclass
+
+import discord
+
+from .metrics import encode_latency
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# Upload limit outside of guilds, where `Guild.filesize_limit` isn't available
+default_upload_limit: int = 10 * 1024 * 1024
+# Part of the budget left for the container overhead and the bitrate control error
+budget_margin: float = 0.92
+audio_bitrate: int = 96_000
+# Long videos with audio fall back to this audio bitrate, and then to no audio, before their
+# video bitrate goes under `min_video_bitrate`. Below it, no useful video fits in the budget.
+low_audio_bitrate: int = 32_000
+min_video_bitrate: int = 100_000
+# Below this many bits per pixel and frame, x264 output is too blocky to be worth sending,
+# so a lower resolution or frame rate is tried instead.
+min_bits_per_pixel: float = 0.03
+# Resolutions and frame rates to fall back to, from best to worst
+fallbacks: tuple[tuple[int, int], ...] = ((1080, 60), (1080, 30), (720, 30), (480, 30), (480, 15), (360, 15))
+
+
+@dataclass(frozen=True)
+class VideoInfo:
+    width: int
+    height: int
+    frame_rate: float
+    duration: float
+    has_audio: bool
+
+
+@dataclass(frozen=True)
+class EncodeResult:
+    """The file to upload, and how it was obtained."""
+
+    path: pathlib.Path
+    size: int
+    seconds: float
+    height: int
+    frame_rate: float
+    reencoded: bool
+
+    def describe(self) -> str:
+        how = f"re-encoded in {self.seconds:.1f} s" if self.reencoded else "not re-encoded"
+        return f"{self.size / 1024 / 1024:.1f} MB at {self.height}p{self.frame_rate:g}, {how}"
+
+
+def upload_limit(message: discord.Message) -> int:
+    """Maximum size of a file attached to a reply to `message`.
+
+    Messages fetched by a worker, without the guild cache, only have a `discord.Object` as
+    their guild, so they get the default limit.
+    """
+    return message.guild.filesize_limit if isinstance(message.guild, discord.Guild) else default_upload_limit
+
+
+def probe(path: pathlib.Path) -> VideoInfo:
+    result = tracing.run(
+        [
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,width,height,r_frame_rate:format=duration",
+            "-of", "json", str(path),
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    info = json.loads(result.stdout)
+    streams = info.get("streams", [])
+    video = next(stream for stream in streams if stream.get("codec_type") == "video")
+    numerator, _, denominator = video["r_frame_rate"].partition("/")
+    return VideoInfo(
+        width=int(video["width"]),
+        height=int(video["height"]),
+        frame_rate=float(numerator) / float(denominator or 1),
+        duration=float(info["format"]["duration"]),
+        has_audio=any(stream.get("codec_type") == "audio" for stream in streams),
+    )
+
+
+def encode_to_budget(path: pathlib.Path, budget: int) -> EncodeResult:
+    """Make a video fit in `budget` bytes.
+
+    Videos that already fit are returned as they are. Otherwise they are encoded with x264 at the
+    bitrate that fills the budget for their duration, using a fast preset. When that bitrate is too
+    low for the resolution and frame rate, or the result is still too large, lower resolutions and
+    frame rates are tried.
+
+    When the video is so long that even `min_video_bitrate` doesn't fit, it's returned as it is,
+    over the budget, which callers already treat as a failure.
+    """
+    size = path.stat().st_size
+    info = probe(path)
+    if size <= budget:
+        return EncodeResult(path, size, 0.0, info.height, info.frame_rate, False)
+    with tracing.span("encode", source_size=size, budget=budget, duration=info.duration) as span:
+        start = time.perf_counter()
+        output = path.with_name(f"{path.stem}.encoded.mp4")
+        total_bitrate = budget * 8 * budget_margin / max(info.duration, 0.1)
+        audio = audio_bitrate if info.has_audio else 0
+        if audio and total_bitrate - audio < min_video_bitrate:
+            audio = low_audio_bitrate if total_bitrate - low_audio_bitrate >= min_video_bitrate else 0
+        video_bitrate = int(total_bitrate - audio)
+        if video_bitrate < min_video_bitrate:
+            logger.info(
+                "%s lasts %.1f s, too long for %.1f MB even at %d b/s",
+                path.name, info.duration, budget / 1024 / 1024, min_video_bitrate,
+            )
+            return EncodeResult(path, size, time.perf_counter() - start, info.height, info.frame_rate, False)
+        candidates = [
+            (height, frame_rate) for height, frame_rate in fallbacks
+            if height <= info.height and frame_rate <= round(info.frame_rate)
+        ] or [(info.height, round(info.frame_rate))]
+        result = None
+        for i, (height, frame_rate) in enumerate(candidates):
+            width = info.width * height / info.height
+            last = i == len(candidates) - 1
+            if not last and video_bitrate / (width * height * frame_rate) < min_bits_per_pixel:
+                continue
+            _encode(path, output, height, frame_rate, video_bitrate, audio)
+            encoded_size = output.stat().st_size
+            result = EncodeResult(output, encoded_size, time.perf_counter() - start, height, frame_rate, True)
+            if encoded_size <= budget:
+                break
+            # x264 overshot the target, so aim lower on the next try
+            video_bitrate = int(video_bitrate * budget / encoded_size * budget_margin)
+        encode_latency.observe(result.seconds)
+        if span is not None:
+            span.set(size=result.size, height=result.height, frame_rate=result.frame_rate)
+    logger.info("Encoded %s from %.1f MB to %s", path.name, size / 1024 / 1024, result.describe())
+    return result
+
+
+def _encode(source: pathlib.Path, output: pathlib.Path, height: int, frame_rate: float, video_bitrate: int, audio: int) -> None:
+    """Encode at the given video bitrate, and at the audio bitrate `audio`, without audio if it's 0."""
+    command = [
+        "ffmpeg", "-y", "-v", "error", "-i", str(source),
+        "-vf", f"scale=-2:{height},fps={frame_rate}",
+        "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", str(video_bitrate), "-maxrate", str(int(video_bitrate * 1.2)), "-bufsize", str(video_bitrate),
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+    ]
+    command += ["-c:a", "aac", "-b:a", str(audio)] if audio else ["-an"]
+    tracing.run([*command, str(output)], check=True)
@@ -0,0 +1,108 @@
+import logging
+import time
+from dataclasses import dataclass
+
+import discord
+
+from .roles import mecenas
+
+
+logger = logging.getLogger(__name__)
+
+# How long a failed `fetch_member` is remembered, so users outside the guilds don't cause a
+# request with every DM
+not_member_ttl: float = 300.0
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    is_member: bool
+    is_mecenas: bool
+
+
+class Entitlements:
+    """Index of which users are members of the guilds with the mecenas role, and which are mecenas.
+
+    The index is built from the member cache when a guild becomes available and kept up to date
+    by member events, so lookups are a dict access. Users missing from it (the member cache may be
+    incomplete) are fetched once per guild and then indexed.
+    """
+
+    def __init__(self, bot: discord.Bot, role_id: int = mecenas) -> None:
+        self.bot = bot
+        self.role_id = role_id
+        self.members: dict[int, set[int]] = {}  # User ID -> IDs of the guilds they are in
+        self.patrons: dict[int, set[int]] = {}  # User ID -> IDs of the guilds where they have the role
+        self.not_members: dict[int, float] = {}  # User ID -> when the negative result expires
+
+    def guilds(self) -> list[discord.Guild]:
+        """Guilds that grant entitlements, that is, the ones with the mecenas role."""
+        return [guild for guild in self.bot.guilds if guild.get_role(self.role_id) is not None]
+
+    def index_guild(self, guild: discord.Guild) -> None:
+        if guild.get_role(self.role_id) is None:
+            return
+        for member in guild.members:
+            self.update(member)
+        logger.info("Indexed %d members of %s", len(guild.members), guild.name)
+
+    def forget_guild(self, guild: discord.Guild) -> None:
+        for index in (self.members, self.patrons):
+            for user_id in [user_id for user_id, guild_ids in index.items() if guild.id in guild_ids]:
+                self._discard(index, user_id, guild.id)
+
+    def update(self, member: discord.Member) -> None:
+        """Index a member that joined or whose roles changed."""
+        if member.guild.get_role(self.role_id) is None:
+            return
+        self.members.setdefault(member.id, set()).add(member.guild.id)
+        self.not_members.pop(member.id, None)
+        if member.get_role(self.role_id) is not None:
+            self.patrons.setdefault(member.id, set()).add(member.guild.id)
+        else:
+            self._discard(self.patrons, member.id, member.guild.id)
+
+    def remove(self, member: discord.Member) -> None:
+        """Forget a member that left a guild."""
+        self._discard(self.members, member.id, member.guild.id)
+        self._discard(self.patrons, member.id, member.guild.id)
+
+    def get(self, user_id: int) -> Entitlement | None:
+        """Look a user up in the index. Returns None when it's unknown whether they are a member."""
+        if user_id in self.members:
+            return Entitlement(True, user_id in self.patrons)
+        if self.not_members.get(user_id, 0.0) > time.monotonic():
+            return Entitlement(False, False)
+        return None
+
+    async def lookup(self, user_id: int) -> Entitlement:
+        entitlement = self.get(user_id)
+        if entitlement is not None:
+            return entitlement
+        # Only a NotFound says that the user isn't a member, other errors leave it unknown
+        unknown = False
+        for guild in self.guilds():
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                continue
+            except discord.HTTPException as e:
+                logger.warning("Couldn't fetch member %d of %s: %s", user_id, guild.name, e)
+                unknown = True
+                continue
+            self.update(member)
+        entitlement = self.get(user_id)
+        if entitlement is None:
+            if not unknown:
+                self.not_members[user_id] = time.monotonic() + not_member_ttl
+            entitlement = Entitlement(False, False)
+        return entitlement
+
+    @staticmethod
+    def _discard(index: dict[int, set[int]], user_id: int, guild_id: int) -> None:
+        guild_ids = index.get(user_id)
+        if guild_ids is None:
+            return
+        guild_ids.discard(guild_id)
+        if not guild_ids:
+            del index[user_id]
@@ -0,0 +1,116 @@
+import math
+import os
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+
+# Frames sent to the model, at most, and the image tokens they can use together
+max_keyframes: int = 40
+video_token_budget: int = int(os.getenv("VIDEO_TOKEN_BUDGET", "16000"))
+# Frames are compared at this rate, as grayscale thumbnails of this size
+analysis_fps: float = 4.0
+thumbnail_size: tuple[int, int] = (64, 36)
+# Mean absolute differences (0 to 255) below the noise floor are compression noise, and every
+# `min_change` of accumulated difference is worth one more keyframe
+noise_floor: float = 1.5
+min_change: float = 12.0
+
+
+@dataclass(frozen=True)
+class Keyframe:
+    index: int
+    seconds: float
+    jpeg: bytes
+
+
+def model_size(width: int, height: int) -> tuple[int, int]:
+    """Size an image is scaled to by the model with high detail: within 2048x2048, shortest side up to 768."""
+    scale = min(1.0, 2048 / max(width, height))
+    shortest = min(width, height) * scale
+    if shortest > 768:
+        scale *= 768 / shortest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_tokens(width: int, height: int) -> int:
+    """Input tokens of an image with high detail, 85 plus 170 for each 512 pixels tile."""
+    width, height = model_size(width, height)
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def read_thumbnails(video: cv2.VideoCapture) -> tuple[np.ndarray, np.ndarray]:
+    """Frame indices and grayscale thumbnails of the frames sampled at `analysis_fps`."""
+    fps = video.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, round(fps / analysis_fps))
+    indices = []
+    thumbnails = []
+    index = 0
+    while video.grab():
+        if index % step == 0:
+            success, frame = video.retrieve()
+            if not success:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            thumbnails.append(cv2.resize(gray, thumbnail_size, interpolation=cv2.INTER_AREA))
+            indices.append(index)
+        index += 1
+    if not thumbnails:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, thumbnail_size[1], thumbnail_size[0]), dtype=np.uint8)
+    return np.array(indices), np.stack(thumbnails)
+
+
+def select_keyframes(thumbnails: np.ndarray, k: int) -> list[int]:
+    """Positions of up to `k` thumbnails, spread evenly over the accumulated change of the video.
+
+    The first frame is always selected. A static video gives no more frames, a slide deck gives
+    the first frame of every slide, and continuous motion is sampled evenly.
+    """
+    if len(thumbnails) == 0 or k <= 0:
+        return []
+    differences = np.abs(np.diff(thumbnails.astype(np.int16), axis=0)).mean(axis=(1, 2))
+    differences[differences < noise_floor] = 0.0
+    change = np.cumsum(differences)
+    total = float(change[-1]) if len(change) else 0.0
+    count = min(k - 1, int(total // min_change))
+    if count <= 0:
+        return [0]
+    # The frame after the difference that reaches each target, so changes are seen once they happened
+    targets = np.arange(1, count + 1) * (total / (count + 1))
+    selected = np.searchsorted(change, targets) + 1
+    return [0, *np.unique(selected).tolist()]
+
+
+def extract_keyframes(path: str, token_budget: int = video_token_budget) -> list[Keyframe]:
+    """Keyframes of a video as JPEG images, scaled to the size the model would use."""
+    video = cv2.VideoCapture(path)
+    try:
+        fps = video.get(cv2.CAP_PROP_FPS) or 30.0
+        width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)) or 1
+        height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 1
+        indices, thumbnails = read_thumbnails(video)
+    finally:
+        video.release()
+    k = max(1, min(max_keyframes, token_budget // image_tokens(width, height)))
+    wanted = set(indices[select_keyframes(thumbnails, k)].tolist())
+    if not wanted:
+        return []
+    size = model_size(width, height)
+    keyframes = []
+    # Seeking isn't frame accurate in every format, so the video is read again up to the last keyframe
+    video = cv2.VideoCapture(path)
+    try:
+        index = 0
+        while index <= max(wanted) and video.grab():
+            if index in wanted:
+                success, frame = video.retrieve()
+                if success:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                    success, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                if success:
+                    keyframes.append(Keyframe(index, index / fps, jpeg.tobytes()))
+            index += 1
+    finally:
+        video.release()
+    return keyframes
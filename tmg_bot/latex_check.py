@@ -0,0 +1,145 @@
+import pathlib
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Literal
+
+import manim
+
+from .metrics import Counter, Histogram
+from . import tracing
+
+
+latex_checks = Counter(
+    "tmg_latex_checks_total",
+    "LaTeX strings checked for the builder, by whether the verdict was cached.",
+    ("result",),
+)
+latex_check_latency = Histogram(
+    "tmg_latex_check_seconds",
+    "Duration of the latex runs that check a batch of strings.",
+)
+
+Mode = Literal["text", "math"]
+
+# Environments that manim.Tex and manim.MathTex put the strings in
+_environments: dict[str, str] = {"text": "center", "math": "align*"}
+_error = re.compile(r"^! (.*?)$(.*?)^l\.\d+ ?(.*?)$", re.MULTILINE | re.DOTALL)
+
+
+def log_error(log: str) -> str:
+    """First error of a LaTeX log, with the line where it happened."""
+    match = _error.search(log)
+    if match is None:
+        return "LaTeX compilation error."
+    message, context, line = (part.strip() for part in match.groups())
+    return f"LaTeX compilation error: {message}\n{context}\n{line}".strip()
+
+
+class LatexChecker:
+    """Checks whether LaTeX strings compile with the Manim template, caching the verdicts.
+
+    The strings are compiled like manim.Tex and manim.MathTex would, but without dvisvgm and
+    many at once. A batch that compiles in a single latex run is valid as a whole. One that
+    doesn't is split in halves until the invalid strings are found, so a few mistakes in a
+    batch still cost a handful of runs.
+
+    Calls made while a batch is compiling are gathered into the next batch, so the concurrent
+    tool calls of a builder turn share their latex runs.
+    """
+
+    def __init__(self, max_entries: int = 4096, timeout: float = 30.0) -> None:
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._verdicts: OrderedDict[tuple[Mode, str], str | None] = OrderedDict()
+        self._pending: dict[tuple[Mode, str], Future] = {}
+        self._lock = threading.Lock()
+        self._compile_lock = threading.Lock()
+
+    def check(self, snippets: list[tuple[Mode, str]]) -> list[str | None]:
+        """Check `(mode, string)` pairs. Returns None for each valid string, or the LaTeX error."""
+        results: dict[tuple[Mode, str], str | None | Future] = {}
+        with self._lock:
+            for snippet in snippets:
+                if snippet in results:
+                    continue
+                if snippet in self._verdicts:
+                    self._verdicts.move_to_end(snippet)
+                    results[snippet] = self._verdicts[snippet]
+                    latex_checks.inc(result="cached")
+                    continue
+                if snippet not in self._pending:
+                    self._pending[snippet] = Future()
+                results[snippet] = self._pending[snippet]
+                latex_checks.inc(result="compiled")
+        futures = [result for result in results.values() if isinstance(result, Future)]
+        while not all(future.done() for future in futures):
+            with self._compile_lock:
+                with self._lock:
+                    batch, self._pending = self._pending, {}
+                if batch:
+                    self._run_batch(batch)
+        return [
+            results[snippet].result() if isinstance(results[snippet], Future) else results[snippet]
+            for snippet in snippets
+        ]
+
+    def _run_batch(self, batch: dict[tuple[Mode, str], Future]) -> None:
+        try:
+            with tracing.span("latex_check", snippets=len(batch)):
+                verdicts = self._find_errors(list(batch))
+        except BaseException as e:
+            for future in batch.values():
+                future.set_exception(e)
+            raise
+        with self._lock:
+            for snippet, error in verdicts.items():
+                self._verdicts[snippet] = error
+            while len(self._verdicts) > self.max_entries:
+                self._verdicts.popitem(last=False)
+        for snippet, future in batch.items():
+            future.set_result(verdicts[snippet])
+
+    def _find_errors(self, snippets: list[tuple[Mode, str]]) -> dict[tuple[Mode, str], str | None]:
+        error = self._compile(snippets)
+        if error is None:
+            return dict.fromkeys(snippets)
+        if len(snippets) == 1:
+            return {snippets[0]: error}
+        middle = len(snippets) // 2
+        return self._find_errors(snippets[:middle]) | self._find_errors(snippets[middle:])
+
+    def _compile(self, snippets: list[tuple[Mode, str]]) -> str | None:
+        """Compile the snippets in one document. Returns the first error, or None if there's none."""
+        template = manim.config.tex_template
+        body = "\n".join(
+            f"\\begin{{{_environments[mode]}}}\n{string}\n\\end{{{_environments[mode]}}}\n\\clearpage"
+            for mode, string in snippets
+        )
+        document = f"{template.documentclass}\n{template.preamble}\n\\begin{{document}}\n{template.post_doc_commands}\n{body}\n\\end{{document}}\n"
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "check.tex"
+            path.write_text(document, encoding="utf-8")
+            try:
+                result = tracing.run(
+                    [template.tex_compiler, "-interaction=nonstopmode", "-halt-on-error", path.name],
+                    cwd=directory,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=self.timeout,
+                )
+            except subprocess.TimeoutExpired:
+                return f"LaTeX compilation timed out after {self.timeout:.0f} seconds."
+            finally:
+                latex_check_latency.observe(time.perf_counter() - start)
+            if result.returncode == 0:
+                return None
+            return log_error(path.with_suffix(".log").read_text(encoding="utf-8", errors="replace"))
+
+
+latex_checker = LatexChecker()
@@ -1,3 +1,50 @@
 import asyncio
+import contextlib
+import logging
+import os
+import socket
+import time
+from typing import AsyncIterator
 
-ai_lock = asyncio.Lock()
\ No newline at end of file
+from .metrics import lock_wait, timed_lock
+from .state import store
+
+
+logger = logging.getLogger(__name__)
+
+ai_lock = asyncio.Lock()
+render_lock = asyncio.Lock()
+
+# Owner of the locks of this process in the store, like the names of the workers
+lock_owner: str = f"{socket.gethostname()}:{os.getpid()}"
+# Shared locks are leases of this many seconds, renewed while they are held
+shared_lock_seconds: float = 60.0
+shared_lock_poll_interval: float = 0.2
+
+
+@contextlib.asynccontextmanager
+async def shared_lock(lock: asyncio.Lock, name: str) -> AsyncIterator[None]:
+    """Hold `lock` in this process and the lock `name` of the store, which every process shares.
+
+    Gateway mode runs several workers, and a worker that dies holding the lock only blocks the
+    others until its lease expires.
+    """
+    async with timed_lock(lock, name):
+        start = time.perf_counter()
+        while not await asyncio.to_thread(store.acquire, name, lock_owner, shared_lock_seconds):
+            await asyncio.sleep(shared_lock_poll_interval)
+        lock_wait.observe(time.perf_counter() - start, lock=f"{name}_shared")
+        keepalive = asyncio.create_task(_renew(name))
+        try:
+            yield
+        finally:
+            keepalive.cancel()
+            await asyncio.to_thread(store.release, name, lock_owner)
+
+
+async def _renew(name: str) -> None:
+    while True:
+        await asyncio.sleep(shared_lock_seconds / 3)
+        if not await asyncio.to_thread(store.acquire, name, lock_owner, shared_lock_seconds):
+            logger.warning("The shared lock %s expired and was taken by another process", name)
+            return
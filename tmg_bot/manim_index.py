@@ -0,0 +1,171 @@
+import functools
+import inspect
+import re
+from dataclasses import dataclass
+from typing import Any
+
+import manim
+import manimpango
+
+
+# Builder tool outputs are cut at this many characters, since every one is sent back to the model
+max_output_chars: int = 4000
+max_summary_chars: int = 160
+max_doc_chars: int = 2000
+search_limit: int = 15
+
+_words = re.compile(r"[a-z0-9]+")
+_camel = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+
+def cap(text: str, max_chars: int = max_output_chars) -> str:
+    """Cut a tool output to `max_chars` characters, saying how much was left out."""
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + f"\n... ({len(text) - max_chars} more characters)"
+
+
+def signature(obj: Any) -> str:
+    """Signature of a callable, without `self`, or an empty string if it has none."""
+    try:
+        return str(inspect.signature(obj))
+    except (TypeError, ValueError):
+        return ""
+
+
+def summary(obj: Any) -> str:
+    """First paragraph of the docstring of an object, on a single line."""
+    doc = inspect.getdoc(obj) or ""
+    first = " ".join(doc.split("\n\n", 1)[0].split())
+    return first if len(first) <= max_summary_chars else first[:max_summary_chars - 3].rstrip() + "..."
+
+
+@dataclass(frozen=True)
+class ApiEntry:
+    """A public name exported by `manim`."""
+    name: str
+    kind: str
+    signature: str
+    summary: str
+    name_words: frozenset[str]
+    words: frozenset[str]
+
+    def describe(self) -> str:
+        line = f"{self.name}{self.signature}" if self.kind in ("class", "function") else self.name
+        return f"{line} [{self.kind}]" + (f": {self.summary}" if self.summary else "")
+
+
+def _kind(obj: Any) -> str:
+    if inspect.isclass(obj):
+        return "class"
+    if inspect.ismodule(obj):
+        return "module"
+    if callable(obj):
+        return "function"
+    return "constant"
+
+
+@functools.cache
+def api_index() -> tuple[ApiEntry, ...]:
+    """Index of the public names of `manim`, built once per process."""
+    entries = []
+    for name, obj in vars(manim).items():
+        if name.startswith("_"):
+            continue
+        kind = _kind(obj)
+        if kind == "module":
+            continue
+        text = summary(obj) if kind != "constant" else ""
+        name_words = frozenset(_words.findall(_camel.sub(" ", name).lower()))
+        words = name_words | frozenset(_words.findall(text.lower()))
+        entries.append(ApiEntry(name, kind, signature(obj) if kind != "constant" else "", text, name_words, words))
+    return tuple(entries)
+
+
+def search(query: str, limit: int = search_limit) -> list[ApiEntry]:
+    """Manim names relevant to `query`, best first.
+
+    Matches on the name count more than matches on the summary, and exact names and
+    prefixes count more than words, which count more than substrings.
+    """
+    query_lower = query.strip().lower()
+    terms = _words.findall(_camel.sub(" ", query.strip()).lower())
+    scored = []
+    for entry in api_index():
+        name = entry.name.lower()
+        score = 0.0
+        if name == query_lower:
+            score += 100
+        elif name.startswith(query_lower):
+            score += 40
+        elif query_lower and query_lower in name:
+            score += 20
+        for term in terms:
+            if term in entry.name_words:
+                score += 10
+            elif len(term) >= 3 and term in name:
+                score += 6
+            elif term in entry.words:
+                score += 3
+        if score:
+            # Classes are what the builder uses most, shorter names are more general
+            score += 2 * (entry.kind == "class") - len(name) / 100
+            scored.append((score, entry))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [entry for _, entry in scored[:limit]]
+
+
+def public_members(obj: Any) -> str:
+    """Public attributes of an object, methods with their signature."""
+    methods = []
+    attributes = []
+    for name in dir(obj):
+        if name.startswith("_"):
+            continue
+        try:
+            member = getattr(obj, name)
+        except Exception:
+            attributes.append(name)
+            continue
+        if callable(member) and not inspect.isclass(member):
+            methods.append(f"{name}{signature(member)}")
+        else:
+            attributes.append(name)
+    parts = []
+    if methods:
+        parts.append("Methods:\n" + "\n".join(methods))
+    if attributes:
+        parts.append("Attributes: " + ", ".join(attributes))
+    return "\n\n".join(parts)
+
+
+def short_doc(obj: Any) -> str | None:
+    """Docstring of an object, cut to its first sections."""
+    doc = inspect.getdoc(obj)
+    if not doc:
+        return None
+    return cap(doc, max_doc_chars)
+
+
+@functools.cache
+def font_names() -> tuple[str, ...]:
+    """Fonts available to `Text`, listed once per process."""
+    return tuple(sorted(set(manimpango.list_fonts()), key=str.lower))
+
+
+def scope_summary(scope: dict[str, Any]) -> str:
+    """Names defined in a builder scope on top of `manim` and the preloaded modules."""
+    lines = []
+    for name, value in scope.items():
+        if name.startswith("__") or vars(manim).get(name, scope) is value:
+            continue
+        try:
+            text = repr(value)
+        except Exception:
+            text = "..."
+        text = " ".join(text.split())
+        if len(text) > 80:
+            text = text[:77] + "..."
+        lines.append(f"{name}: {type(value).__name__} = {text}")
+    header = "Every public name of `manim` is available, besides these:"
+    return cap("\n".join([header, *lines]))
@@ -0,0 +1,235 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+all_metrics: list["Counter | Gauge | Histogram"] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        all_metrics.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            return self.values.get(key, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self.values)
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down, optionally split by labels."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram:
+    """Cumulative histogram of observed values, optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # For every label set: counts per bucket (the last one is +Inf), sum and count
+        self.values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+        self._lock = threading.Lock()
+        all_metrics.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            counts, total, count = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0, 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the time spent in a block of code."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {count}"
+
+
+llm_latency = Histogram(
+    "tmg_llm_request_seconds",
+    "Duration of LLM calls, until the whole response is received.",
+    ("model", "caller"),
+)
+llm_tokens = Counter(
+    "tmg_llm_tokens_total",
+    "Tokens used by LLM calls.",
+    ("model", "caller", "kind"),
+)
+render_tex_latency = Histogram(
+    "tmg_render_tex_seconds",
+    "Duration of render_tex, from the reply text to the uploaded image.",
+)
+tex_png_bytes = Histogram(
+    "tmg_tex_png_bytes",
+    "Size of the images sent by render_tex.",
+    buckets=(16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6),
+)
+tex_encode_latency = Histogram(
+    "tmg_tex_encode_seconds",
+    "Time spent quantizing and encoding the images of render_tex.",
+)
+tex_documents = Counter(
+    "tmg_tex_documents_total",
+    "LaTeX documents compiled by render_tex, by the template used for them.",
+    ("template",),
+)
+render_manim_latency = Histogram(
+    "tmg_render_manim_seconds",
+    "Duration of render_manim, including the builder loop and the final render.",
+    ("type",),
+)
+encode_latency = Histogram(
+    "tmg_encode_seconds",
+    "Time spent re-encoding rendered videos to fit the upload limit.",
+)
+attachment_latency = Histogram(
+    "tmg_attachment_seconds",
+    "Time spent downloading and processing an attachment.",
+    ("content_type",),
+)
+lock_wait = Histogram(
+    "tmg_lock_wait_seconds",
+    "Time spent waiting to acquire a lock or a queue slot.",
+    ("lock",),
+)
+inflight_requests = Gauge(
+    "tmg_inflight_requests",
+    "Requests being answered right now.",
+)
+render_queue_depth = Gauge(
+    "tmg_render_queue_depth",
+    "Manim renders waiting for their turn or running.",
+)
+renders = Counter(
+    "tmg_renders_total",
+    "Final Manim renders, by the quality chosen for them.",
+    ("type", "quality"),
+)
+
+
+def record_llm_usage(response: Any, model: str, caller: str, seconds: float) -> None:
+    """Record the latency and token usage of a response."""
+    llm_latency.observe(seconds, model=model, caller=caller)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        llm_tokens.inc(usage.input_tokens, model=model, caller=caller, kind="input")
+        llm_tokens.inc(usage.output_tokens, model=model, caller=caller, kind="output")
+
+
+@asynccontextmanager
+async def timed_lock(lock: asyncio.Lock, name: str) -> AsyncIterator[None]:
+    """Acquire an asyncio lock, recording how long it took."""
+    start = time.perf_counter()
+    async with lock:
+        lock_wait.observe(time.perf_counter() - start, lock=name)
+        yield
+
+
+def render() -> str:
+    """Render every metric in the Prometheus text format."""
+    lines = []
+    for metric in all_metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            status, body = "200 OK", render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.Server:
+    """Serve the metrics at http://host:port/metrics."""
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info("Serving metrics at http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,104 @@
+import re
+from typing import Iterator
+
+import emoji
+
+
+# Characters that can start or continue an emoji. Runs of them are checked with `emoji`, so
+# symbols in these ranges that aren't emojis, like € or →, are kept.
+_emoji_chars = "\u00a9\u00ae\u203c-\u3299\ufe0f\u200d\U0001f000-\U0001faff\U000e0020-\U000e007f"
+_emoji_run = re.compile(f"[#*0-9]\ufe0f?\u20e3|[{_emoji_chars}]+")
+
+# Every construct that the normalizer cares about, in a single pattern. Alternatives are tried
+# in order at each position, so code and math are consumed whole before anything inside them
+# could match, and their contents are never rewritten as prose.
+_token = re.compile(
+    r"""
+    (?P<fence>^[ \t]*(?P<mark>```|~~~).*?(?:^[ \t]*(?P=mark)[ \t]*$|\Z))
+    |(?P<code>(?P<ticks>`+)[^`]+?(?P=ticks))
+    |(?P<env>\\begin\{(?P<env_name>[a-zA-Z]+\*?)\}.*?\\end\{(?P=env_name)\})
+    |(?<!\\)\$\$(?P<dollars_display>.*?)(?<!\\)\$\$
+    |\\\[(?P<bracket_display>.*?)\\\]
+    |(?<!\\)\$(?P<dollars_inline>(?:\\.|[^$])+?)\$
+    |\\\((?P<paren_inline>.*?)\\\)
+    |(?P<mention><@!?\d+>)
+    |(?P<bullet>^[*+-][ \t]+)
+    |(?P<double>")
+    |(?P<single>')
+    |(?P<emoji>[#*0-9]\ufe0f?\u20e3|["""
+    + _emoji_chars
+    + r"""]+)
+    """,
+    re.MULTILINE | re.DOTALL | re.VERBOSE,
+)
+
+
+def strip_emoji(text: str) -> str:
+    """Remove the emojis of a piece of text, which pdfTeX can't typeset."""
+    if text.isascii():
+        return text
+    return _emoji_run.sub(lambda m: emoji.replace_emoji(m.group(0), ""), text)
+
+
+def _line_end(text: str, position: int) -> int:
+    end = text.find("\n", position)
+    return len(text) if end == -1 else end
+
+
+def normalize_parts(text: str) -> Iterator[str]:
+    """Pieces of the normalized text, produced in a single pass over it.
+
+    Code (fenced blocks and inline spans) and math (dollars, brackets, parentheses and
+    environments) are kept as they are, only without emojis, and math is always written
+    with dollars. In the prose between them, mentions are replaced, emojis removed, pairs of
+    quotes on the same line made typographic, and list bullets written as `*`.
+    """
+    position = 0
+    double_open_until = -1
+    single_open_until = -1
+    for match in _token.finditer(text):
+        start = match.start()
+        if start > position:
+            yield text[position:start]
+        position = match.end()
+        kind = match.lastgroup
+        if kind in ("fence", "code", "env"):
+            yield strip_emoji(match.group(0))
+        elif kind in ("dollars_display", "bracket_display"):
+            yield f"$${strip_emoji(match.group(kind))}$$"
+        elif kind in ("dollars_inline", "paren_inline"):
+            yield f"${strip_emoji(match.group(kind))}$"
+        elif kind == "mention":
+            yield "Usuario de Discord"
+        elif kind == "bullet":
+            yield "* "
+        elif kind == "emoji":
+            yield emoji.replace_emoji(match.group(0), "")
+        elif kind == "double":
+            if start < double_open_until:
+                double_open_until = -1
+                yield "”"
+            elif text.find('"', position, _line_end(text, position)) != -1:
+                double_open_until = _line_end(text, position)
+                yield "“"
+            else:
+                yield '"'
+        elif kind == "single":
+            # Apostrophes, like in "l'Hôpital", stay as they are
+            after_word = start > 0 and text[start - 1].isalnum()
+            before_word = position < len(text) and text[position].isalnum()
+            if start < single_open_until and not before_word:
+                single_open_until = -1
+                yield "’"
+            elif not after_word and before_word and text.find("'", position, _line_end(text, position)) != -1:
+                single_open_until = _line_end(text, position)
+                yield "‘"
+            else:
+                yield "'"
+    if position < len(text):
+        yield text[position:]
+
+
+def normalize(text: str) -> str:
+    """Prepare a Markdown reply for the TeX templates."""
+    return "".join(normalize_parts(text))
@@ -0,0 +1,60 @@
+import os
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Quality:
+    """Resolution and frame rate of a Manim render."""
+
+    name: str
+    pixel_width: int
+    pixel_height: int
+    frame_rate: int
+
+    @property
+    def label(self) -> str:
+        """Name of the directory where Manim writes videos of this quality, like `720p30`."""
+        return f"{self.pixel_height}p{self.frame_rate}"
+
+    def config(self) -> dict[str, int]:
+        """Settings for `manim.tempconfig`."""
+        return {
+            "pixel_width": self.pixel_width,
+            "pixel_height": self.pixel_height,
+            "frame_rate": self.frame_rate,
+        }
+
+
+LOW = Quality("low", 854, 480, 15)
+MEDIUM = Quality("medium", 1280, 720, 30)
+HIGH = Quality("high", 1920, 1080, 60)
+qualities: tuple[Quality, ...] = (LOW, MEDIUM, HIGH)
+
+# Seconds of animation above which a 2D video is downgraded one step. 3D frames are several
+# times slower to render, so their limit is lower.
+long_video_seconds: float = 20.0
+long_video_seconds_3d: float = 8.0
+# Renders in the queue, waiting or running and the one being rendered included, from which every
+# video is downgraded one step. A render that had to wait for another one is enough.
+busy_queue_depth: int = 2
+# Re-render downgraded videos at high quality once the queue is empty, and replace the sent file
+rerender_in_background: bool = os.getenv("RERENDER_HIGH_QUALITY", "").lower() in ("1", "true", "yes")
+
+
+def choose_quality(duration: float, is_3d: bool, queue_depth: int, type: str = "video") -> Quality:
+    """Choose the quality of the final render of a scene.
+
+    Images are a single frame, so they are always rendered at high quality. Videos start at high
+    quality and go down one step if they are long for their kind, and another one if other renders
+    are in the queue with them.
+    """
+    if type != "video":
+        return HIGH
+    level = qualities.index(HIGH)
+    if duration > (long_video_seconds_3d if is_3d else long_video_seconds):
+        level -= 1
+    if is_3d and duration > 2 * long_video_seconds_3d:
+        level -= 1
+    if queue_depth >= busy_queue_depth:
+        level -= 1
+    return qualities[max(level, 0)]
@@ -1,7 +1,11 @@
 import re
 
 tex_message = re.compile(r"(\$.*?\$)|(\$\$.*?\$\$)|\\\(.*?\\\)|\\\[.*?\\\]", re.DOTALL)
-mentions = re.compile(r"<@!?\d+>")
-double_quotes = re.compile(r"\"(.*?)\"")
-single_quotes = re.compile(r"'(.*?)'")
-markdown_list = re.compile(r"^(\*|\+|\-)\s+(.*)", re.MULTILINE)
\ No newline at end of file
+# Math of a normalized reply, including the environments that the markdown package passes through
+math_segment = re.compile(r"(?<!\\)\$\$.*?(?<!\\)\$\$|(?<!\\)\$.*?(?<!\\)\$|\\\(.*?\\\)|\\\[.*?\\\]|\\begin\{(\w+\*?)\}.*?\\end\{\1\}", re.DOTALL)
+# Markdown syntax, code, links and characters that plain LaTeX would print differently
+markdown_syntax = re.compile(
+    r"[*_`|<>\"~^]|\]\(|https?://|^\s*(?:#|>|\d+[.)]\s|[-+]\s|[-=]+\s*$)|^(?: {4}|\t)| {2,}$",
+    re.MULTILINE,
+)
+plain_special = re.compile(r"[%&#]|\.\.\.")
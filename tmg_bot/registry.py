@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from .metrics import Counter, Histogram
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+tool_calls = Counter(
+    "tmg_tool_calls_total",
+    "Tool calls by registry, tool and status (ok, error, timeout or unknown).",
+    ("registry", "tool", "status"),
+)
+tool_latency = Histogram(
+    "tmg_tool_latency_seconds",
+    "Time spent running a tool, without waiting for its concurrency limit.",
+    ("registry", "tool"),
+)
+
+
+class Tool:
+    """A function tool for the Responses API.
+
+    The handler is a coroutine function called with the dispatch context (the triggering
+    Discord message, the scene being built, etc.) and the arguments given by the model.
+    Exclusive tools run alone and in order, because they change state that later calls
+    of the same turn can depend on.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        parameters: dict[str, Any],
+        handler: Callable[..., Awaitable[Any]],
+        timeout: float | None = None,
+        concurrency: int | None = None,
+        exclusive: bool = False,
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.handler = handler
+        self.timeout = timeout
+        self.exclusive = exclusive
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.schema: dict[str, Any] = {
+            "type": "function",
+            "name": name,
+            "description": description,
+            "parameters": parameters,
+        }
+
+
+class ToolRegistry:
+    """Set of tools offered to a model, with their schemas built once and a timed dispatcher."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.tools: dict[str, Tool] = {}
+        self.schemas: list[dict[str, Any]] = []
+
+    def add(self, tool: Tool) -> None:
+        self.tools[tool.name] = tool
+        self.schemas = [t.schema for t in self.tools.values()]
+
+    def tool(
+        self,
+        name: str,
+        description: str,
+        parameters: dict[str, Any],
+        timeout: float | None = None,
+        concurrency: int | None = None,
+        exclusive: bool = False,
+    ) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+        """Decorator to register a coroutine function as a tool."""
+        def decorator(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self.add(Tool(name, description, parameters, handler, timeout, concurrency, exclusive))
+            return handler
+        return decorator
+
+    async def dispatch(self, name: str, arguments: dict[str, Any], context: Any) -> str:
+        """Run a tool and return its output as a string. Errors and timeouts are reported to the model."""
+        tool = self.tools.get(name)
+        if tool is None:
+            tool_calls.inc(registry=self.name, tool=name, status="unknown")
+            return f"Unknown tool {name}."
+        status = "ok"
+        async with tool.semaphore or contextlib.nullcontext():
+            with tracing.span(f"tool {name}", registry=self.name) as span:
+                start = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(tool.handler(context, **arguments), tool.timeout)
+                except asyncio.TimeoutError:
+                    status = "timeout"
+                    result = f"The tool {name} timed out after {tool.timeout} seconds."
+                except Exception as e:
+                    status = "error"
+                    logger.exception("Error running tool %s", name)
+                    result = f"An error occurred while running {name}.\n{type(e)}: {e}"
+                finally:
+                    tool_latency.observe(time.perf_counter() - start, registry=self.name, tool=name)
+                    tool_calls.inc(registry=self.name, tool=name, status=status)
+                if span is not None:
+                    span.set(status=status)
+        return str(result)
+
+    async def dispatch_calls(self, calls: list[dict[str, Any]], context: Any, concurrency: int) -> list[dict[str, Any]]:
+        """Run the function calls of a model turn and return their outputs in the same order.
+
+        Up to `concurrency` calls run at once. Exclusive tools wait for the previous calls to
+        finish and run alone.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        outputs: list[str | None] = [None] * len(calls)
+
+        async def run(i: int, call: dict[str, Any]) -> None:
+            async with semaphore:
+                try:
+                    arguments = json.loads(call["arguments"])
+                except json.JSONDecodeError as e:
+                    outputs[i] = f"Invalid arguments for {call['name']}: {e}"
+                    return
+                outputs[i] = await self.dispatch(call["name"], arguments, context)
+
+        pending: list[asyncio.Task] = []
+        for i, call in enumerate(calls):
+            tool = self.tools.get(call["name"])
+            if tool is not None and tool.exclusive:
+                await asyncio.gather(*pending)
+                pending = []
+                await run(i, call)
+            else:
+                pending.append(asyncio.create_task(run(i, call)))
+        await asyncio.gather(*pending)
+        return [
+            {
+                "type": "function_call_output",
+                "call_id": call["call_id"],
+                "output": output,
+            }
+            for call, output in zip(calls, outputs)
+        ]
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Summarize calls, errors, timeouts and mean latency per tool."""
+        summary = {}
+        for name in self.tools:
+            counts = {
+                status: tool_calls.values.get((self.name, name, status), 0.0)
+                for status in ("ok", "error", "timeout")
+            }
+            _, total, count = tool_latency.values.get((self.name, name), (None, 0.0, 0))
+            summary[name] = {
+                "calls": sum(counts.values()),
+                "errors": counts["error"],
+                "timeouts": counts["timeout"],
+                "mean_latency": total / count if count else 0.0,
+            }
+        return summary
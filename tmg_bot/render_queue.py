@@ -0,0 +1,306 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Coroutine
+
+import discord
+
+from .broker import Broker
+from .metrics import lock_wait, render_queue_depth
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH: int = 0  # Mecenas
+PRIORITY_NORMAL: int = 1
+PRIORITY_BACKGROUND: int = 2  # Re-renders nobody is waiting for, which never count as queued
+poll_interval: float = 0.5  # Seconds between checks of a render waiting in the broker
+
+
+class QueueFull(Exception):
+    """The render queue doesn't accept more jobs right now."""
+
+
+class RenderCancelled(Exception):
+    """The render was cancelled, usually because its message was deleted."""
+
+
+@dataclass(order=True)
+class RenderJob:
+    priority: int
+    sequence: int
+    message_id: int = field(compare=False)
+    run: Callable[[threading.Event, int], Awaitable[Any]] = field(compare=False)
+    on_position: Callable[[int | None], Awaitable[None]] | None = field(compare=False, default=None)
+    future: asyncio.Future = field(compare=False, default=None)
+    cancel_event: threading.Event = field(compare=False, default_factory=threading.Event)
+    position: int | None = field(compare=False, default=None)
+    # Renders in the queue besides background ones, this one included, when it was queued or
+    # when it started, whichever was more. It tells how busy renders are for this one.
+    load: int = field(compare=False, default=1)
+    # Context of the submitter, so the render and its status updates are part of their trace
+    context: contextvars.Context = field(compare=False, default=None)
+
+
+class RenderQueue:
+    """Admission control for renders.
+
+    Jobs wait in priority order, then in order of arrival, until one of the `max_concurrent`
+    slots is free. When `max_length` jobs are already waiting, new ones are rejected with
+    `QueueFull`. Waiting jobs are told their position whenever it changes.
+
+    `run` is called with the cancel event and the load of the job (see `RenderJob.load`).
+
+    A job is cancelled by the ID of the message that triggered it. A waiting job is removed
+    right away. A running one can't be interrupted from the event loop, since it renders in
+    a worker thread, so its `cancel_event` is set for the render to stop at the next check.
+    """
+
+    def __init__(self, max_concurrent: int, max_length: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_length = max_length
+        self.waiting: list[RenderJob] = []
+        self.running: dict[int, RenderJob] = {}
+        self._sequence = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        """Jobs waiting for a slot, excluding background ones."""
+        return sum(1 for job in self.waiting if job.priority != PRIORITY_BACKGROUND)
+
+    @property
+    def depth(self) -> int:
+        """Jobs waiting for a slot or running, excluding background ones."""
+        jobs = itertools.chain(self.waiting, self.running.values())
+        return sum(1 for job in jobs if job.priority != PRIORITY_BACKGROUND)
+
+    async def submit(
+        self,
+        message_id: int,
+        run: Callable[[threading.Event, int], Awaitable[Any]],
+        priority: int = PRIORITY_NORMAL,
+        on_position: Callable[[int | None], Awaitable[None]] | None = None,
+    ) -> Any:
+        """Wait for a slot, then return the result of `run(cancel_event, load)`."""
+        if priority != PRIORITY_BACKGROUND and self.queued >= self.max_length:
+            raise QueueFull()
+        job = RenderJob(
+            priority=priority,
+            sequence=next(self._sequence),
+            message_id=message_id,
+            run=run,
+            on_position=on_position,
+            future=asyncio.get_running_loop().create_future(),
+            context=contextvars.copy_context(),
+            load=self.depth + 1,
+        )
+        heapq.heappush(self.waiting, job)
+        self._update()
+        try:
+            with lock_wait.time(lock="render_queue"):
+                await asyncio.wait([job.future])
+        except asyncio.CancelledError:
+            # Whoever was waiting for the result is gone, so the job isn't needed anymore
+            if job in self.waiting:
+                self.waiting.remove(job)
+                heapq.heapify(self.waiting)
+                self._update()
+            job.cancel_event.set()
+            raise
+        return job.future.result()
+
+    def cancel(self, message_id: int) -> bool:
+        """Cancel the jobs triggered by a message. Returns whether there was any."""
+        found = False
+        for job in [job for job in self.waiting if job.message_id == message_id]:
+            self.waiting.remove(job)
+            job.future.set_exception(RenderCancelled())
+            found = True
+        if found:
+            heapq.heapify(self.waiting)
+            self._update()
+        for job in self.running.values():
+            if job.message_id == message_id:
+                job.cancel_event.set()
+                found = True
+        return found
+
+    def _update(self) -> None:
+        """Start jobs while there are free slots and tell the waiting ones their new position."""
+        while self.waiting and len(self.running) < self.max_concurrent:
+            job = heapq.heappop(self.waiting)
+            self.running[id(job)] = job
+            self._spawn(self._run(job), job.context)
+        for position, job in enumerate(sorted(self.waiting), start=1):
+            if job.position != position and job.on_position is not None:
+                self._spawn(job.on_position(position), job.context)
+            job.position = position
+        render_queue_depth.set(len(self.waiting) + len(self.running))
+
+    async def _run(self, job: RenderJob) -> None:
+        try:
+            if job.on_position is not None and job.position is not None:
+                await job.on_position(None)
+            job.load = max(job.load, self.depth)
+            result = await job.run(job.cancel_event, job.load)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            del self.running[id(job)]
+            self._update()
+
+    def _spawn(self, coroutine: Coroutine[Any, Any, None], context: contextvars.Context) -> None:
+        # Tasks are started by whichever job happens to call `_update`, so they run in a copy of
+        # the context of the job they belong to instead
+        task = asyncio.get_running_loop().create_task(coroutine, context=context.copy())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class SharedRenderQueue:
+    """Render queue kept in the broker, so the workers of gateway mode share a single one.
+
+    It's used like `RenderQueue`, and `max_concurrent` and `max_length` apply to every worker
+    together. Each worker renders its own jobs once the broker gives them a slot. A render
+    that waits or runs is checked every `poll_interval` seconds, which also keeps its place.
+    Renders are cancelled through `Broker.cancel`, from any process, or by `cancel` for the
+    ones of this worker.
+    """
+
+    def __init__(self, broker: Broker, worker: str, max_concurrent: int, max_length: int) -> None:
+        self.broker = broker
+        self.worker = worker
+        self.max_concurrent = max_concurrent
+        self.max_length = max_length
+        self.cancel_events: dict[int, list[threading.Event]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        message_id: int,
+        run: Callable[[threading.Event, int], Awaitable[Any]],
+        priority: int = PRIORITY_NORMAL,
+        on_position: Callable[[int | None], Awaitable[None]] | None = None,
+    ) -> Any:
+        """Wait for a slot, then return the result of `run(cancel_event, load)`."""
+        max_waiting = None if priority == PRIORITY_BACKGROUND else self.max_length
+        load = await asyncio.to_thread(self.broker.active_renders) + 1
+        render_id = await asyncio.to_thread(self.broker.put_render, message_id, priority, self.worker, max_waiting)
+        if render_id is None:
+            raise QueueFull()
+        cancel_event = threading.Event()
+        self.cancel_events.setdefault(message_id, []).append(cancel_event)
+        started = False
+        try:
+            position = None
+            with lock_wait.time(lock="render_queue"):
+                while True:
+                    if cancel_event.is_set():
+                        raise RenderCancelled()
+                    status, new_position = await asyncio.to_thread(self.broker.poll_render, render_id, self.max_concurrent)
+                    if status == "cancelled":
+                        raise RenderCancelled()
+                    if status == "running":
+                        break
+                    if new_position != position and on_position is not None:
+                        await on_position(new_position)
+                    position = new_position
+                    await asyncio.sleep(poll_interval)
+            if position is not None and on_position is not None:
+                await on_position(None)
+            load = max(load, await asyncio.to_thread(self.broker.active_renders))
+            # The render runs in its own task, which keeps the slot until the render stops, even
+            # if whoever was waiting for it is gone
+            task = asyncio.create_task(self._run(render_id, message_id, run, cancel_event, load))
+            started = True
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                cancel_event.set()
+                raise
+            return task.result()
+        finally:
+            if not started:
+                self._forget(message_id, cancel_event)
+                await asyncio.to_thread(self.broker.finish_render, render_id)
+
+    async def _run(
+        self,
+        render_id: int,
+        message_id: int,
+        run: Callable[[threading.Event, int], Awaitable[Any]],
+        cancel_event: threading.Event,
+        load: int,
+    ) -> Any:
+        keepalive = asyncio.create_task(self._keep_running(render_id, cancel_event))
+        try:
+            return await run(cancel_event, load)
+        finally:
+            keepalive.cancel()
+            self._forget(message_id, cancel_event)
+            await asyncio.to_thread(self.broker.finish_render, render_id)
+
+    async def _keep_running(self, render_id: int, cancel_event: threading.Event) -> None:
+        while True:
+            await asyncio.sleep(poll_interval)
+            status, _ = await asyncio.to_thread(self.broker.poll_render, render_id, self.max_concurrent)
+            if status == "cancelled":
+                cancel_event.set()
+                return
+
+    def _forget(self, message_id: int, cancel_event: threading.Event) -> None:
+        events = self.cancel_events.get(message_id, [])
+        if cancel_event in events:
+            events.remove(cancel_event)
+        if not events:
+            self.cancel_events.pop(message_id, None)
+
+    def cancel(self, message_id: int) -> bool:
+        """Cancel the renders of a message in this worker. Returns whether there was any."""
+        events = self.cancel_events.get(message_id, [])
+        for cancel_event in events:
+            cancel_event.set()
+        return bool(events)
+
+
+class QueueStatus:
+    """Status message telling a user where their render is in the queue."""
+
+    def __init__(self, message: discord.Message) -> None:
+        self.message = message
+        self.sent: discord.Message | None = None
+        # Updates are spawned as separate tasks, so two of them could both send a new message
+        # or edit one that is being deleted
+        self._lock = asyncio.Lock()
+
+    async def __call__(self, position: int | None) -> None:
+        async with self._lock:
+            try:
+                with tracing.span("discord.send", kind="queue_status"):
+                    if position is None:
+                        if self.sent is not None:
+                            await self.sent.delete()
+                            self.sent = None
+                        return
+                    content = f"⏳ Tu animación está en la cola, en la posición {position}. Te avisaré cuando esté lista."
+                    if self.sent is None:
+                        self.sent = await self.message.reply(content=content)
+                    else:
+                        await self.sent.edit(content=content)
+            except discord.HTTPException as e:
+                logger.warning("Couldn't update the render queue status: %s", e)
+
+    async def clear(self) -> None:
+        await self(None)
@@ -0,0 +1,9 @@
+import discord
+
+
+mecenas: int = 1357139735700574218
+
+
+def is_mecenas(user: discord.User | discord.Member) -> bool:
+    """Check if a guild member has the mecenas role. Users outside of a guild have no roles."""
+    return any(role.id == mecenas for role in getattr(user, "roles", ()))
@@ -0,0 +1,96 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from .metrics import Counter
+
+
+solution_cache_lookups = Counter(
+    "tmg_solution_cache_lookups_total",
+    "Lookups in the solve_math solution cache.",
+    ("result",),
+)
+
+_latex_delimiters = re.compile(r"\$\$?|\\[()\[\]]")
+_latex_spacing = re.compile(r"\\(?:left|right|displaystyle|[,;:! ])(?![a-zA-Z])")
+_latex_fractions = re.compile(r"\\[dt]frac(?![a-zA-Z])")
+_trailing_zeros = re.compile(r"(\d+)\.(\d*?)0+(?!\d)")
+_leading_zeros = re.compile(r"(?<![\d.])0+(?=\d)")
+_words = re.compile(r"(?<![\\a-zA-Z])[a-zA-Z]{2,}")
+_spaces = re.compile(r"\s+")
+_space_between_symbols = re.compile(r" (?=\W)|(?<=\W) ")
+
+
+def normalize_problem(statement: str) -> str:
+    """Fold the differences between two ways of writing the same problem statement.
+
+    Unicode forms and accents, LaTeX delimiters and spacing commands, leading and trailing
+    zeros of numbers and whitespace are folded, along with the punctuation around the whole
+    statement. Only words are lowercased, since the case of single letters (variables, points)
+    is meaningful in math. Commas are kept as they are: between digits they can be decimal
+    commas, thousands separators or the separators of a tuple, a set or arguments, and telling
+    them apart wrongly would give two different problems the same solution.
+    """
+    text = unicodedata.normalize("NFKD", statement)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = unicodedata.normalize("NFKC", text)
+    text = _words.sub(lambda m: m.group(0).lower(), text)
+    text = _latex_delimiters.sub(" ", text)
+    text = _latex_spacing.sub(" ", text)
+    text = _latex_fractions.sub(r"\\frac", text)
+    text = _trailing_zeros.sub(lambda m: m.group(1) + ("." + m.group(2) if m.group(2) else ""), text)
+    text = _leading_zeros.sub("", text)
+    text = _spaces.sub(" ", text).strip()
+    text = _space_between_symbols.sub("", text)
+    return text.strip("¿?¡!.:; ")
+
+
+class SolutionCache:
+    """LRU cache of solve_math solutions with a time to live.
+
+    Keys include a version, derived from the instructions and the model, so changing them
+    invalidates every previous solution.
+    """
+
+    def __init__(self, version: str, max_entries: int = 1024, ttl: float = 7 * 24 * 3600.0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.set_version(version)
+
+    def set_version(self, version: str) -> None:
+        self.version = hashlib.sha256(version.encode("utf-8")).hexdigest()[:16]
+        self.invalidate()
+
+    def key(self, statement: str) -> str:
+        return hashlib.sha256(f"{self.version}\0{normalize_problem(statement)}".encode("utf-8")).hexdigest()
+
+    def get(self, statement: str) -> str | None:
+        key = self.key(statement)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                solution_cache_lookups.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+        solution_cache_lookups.inc(result="hit")
+        return entry[1]
+
+    def put(self, statement: str, solution: str) -> None:
+        key = self.key(statement)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, solution)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
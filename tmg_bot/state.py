@@ -0,0 +1,149 @@
+import atexit
+import dataclasses
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+state_path: str = os.getenv("STATE_PATH", "state.sqlite3")
+# Changes are written at most this often, so a busy conversation costs one write per interval
+flush_interval: float = 2.0
+
+_missing = object()
+
+
+def _default(value: Any) -> Any:
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+class ConversationStore:
+    """Small persistent key-value store for the state of conversations, backed by SQLite.
+
+    With `get` and `set`, values are loaded the first time their key is read, and kept in
+    memory afterwards. Writes only update memory and mark the key as dirty. A background thread
+    saves the dirty keys every `flush_interval` seconds in a single transaction, and once more
+    at exit. This is meant for keys that a single process uses, like the buffers of the gateway.
+
+    Keys shared by several processes, like the response chains that every worker continues,
+    are used with `read` and `write` instead, which always go to SQLite.
+
+    Values must be JSON serializable, dataclasses included, and must not be mutated after
+    being set, since they are serialized later.
+    """
+
+    def __init__(self, path: str = state_path) -> None:
+        self.path = path
+        self._cache: dict[str, Any] = {}
+        self._dirty: dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._thread: threading.Thread | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Only used with `self._lock` held
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._connection
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            value = self._cache.get(key, _missing)
+            if value is _missing:
+                row = self._connect().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                value = json.loads(row[0]) if row else None
+                self._cache[key] = value
+        return default if value is None else value
+
+    def read(self, key: str, default: Any = None) -> Any:
+        """Read the value that is saved right now, which another process may have written."""
+        with self._lock:
+            value = self._dirty.get(key, _missing)
+            if value is _missing:
+                row = self._connect().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                value = json.loads(row[0]) if row else None
+            self._cache[key] = value
+        return default if value is None else value
+
+    def write(self, key: str, value: Any) -> None:
+        """Save a value right away, so the other processes read it from now on."""
+        with self._lock:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT INTO state (key, value, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                    (key, json.dumps(value, ensure_ascii=False, default=_default), time.time()),
+                )
+            self._cache[key] = value
+            self._dirty.pop(key, None)
+
+    def acquire(self, name: str, owner: str, seconds: float) -> bool:
+        """Take or renew a lock shared by every process using the store, for `seconds`.
+
+        Returns False if another owner holds it. A lock that isn't renewed in time can be
+        taken by anyone, so an owner that died doesn't keep it.
+        """
+        now = time.time()
+        with self._lock:
+            with self._connect() as connection:
+                cursor = connection.execute(
+                    "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE locks.owner = excluded.owner OR locks.expires_at < ?",
+                    (name, owner, now + seconds, now),
+                )
+        return cursor.rowcount == 1
+
+    def release(self, name: str, owner: str) -> None:
+        with self._lock:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = value
+            self._dirty[key] = value
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-flush", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            rows = [(key, json.dumps(value, ensure_ascii=False, default=_default), now) for key, value in self._dirty.items()]
+            with self._connect() as connection:
+                connection.executemany(
+                    "INSERT INTO state (key, value, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                    rows,
+                )
+            # Only forgotten once they are saved, so a failed write is tried again on the next flush
+            self._dirty = {}
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error saving the conversation state")
+
+
+store = ConversationStore()
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+import discord
+from typing import Any, Awaitable, Callable
+
+from .client import client
+from .metrics import record_llm_usage
+from . import tracing
+
+
+discord_message_limit: int = 2000
+edit_interval: float = 1.2  # Seconds between edits of the same message, to stay under Discord's rate limits
+
+
+def split_text(text: str, limit: int = discord_message_limit) -> tuple[str, str]:
+    """Split text into a head that fits in `limit` characters and the remaining tail.
+
+    Paragraph boundaries are preferred, then line breaks, then spaces.
+    """
+    if len(text) <= limit:
+        return text, ""
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, limit)
+        if index > 0:
+            return text[:index], text[index + len(separator):]
+    return text[:limit], text[limit:]
+
+
+class StreamingReply:
+    """Reply to a message as soon as text arrives and keep editing it while more text is streamed.
+
+    When the text doesn't fit in a single Discord message anymore, it's rolled over to a new one.
+    """
+
+    def __init__(self, message: discord.Message) -> None:
+        self.message = message
+        self.text: str = ""
+        self.sent: discord.Message | None = None
+        self.shown: str = ""
+        self.last_edit: float = 0.0
+
+    async def feed(self, delta: str) -> None:
+        self.text += delta
+        while len(self.text) > discord_message_limit:
+            head, self.text = split_text(self.text)
+            await self._show(head)
+            self.sent = None
+            self.shown = ""
+        if time.monotonic() - self.last_edit >= edit_interval:
+            await self._show(self.text)
+
+    async def close(self) -> None:
+        """Show the remaining text and start over, so the next text goes in a new message."""
+        await self._show(self.text)
+        self.text = ""
+        self.sent = None
+        self.shown = ""
+
+    async def _show(self, text: str) -> None:
+        if not text.strip() or text == self.shown:
+            return
+        with tracing.span("discord.send", kind="reply" if self.sent is None else "edit", length=len(text)):
+            if self.sent is None:
+                self.sent = await self.message.reply(content=text)
+            else:
+                await self.sent.edit(content=text)
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+
+async def stream_response(on_text: Callable[[str], Awaitable[None]], caller: str = "academic", **kwargs: Any) -> Any:
+    """Create a response in streaming mode, calling `on_text` with every text delta.
+
+    The OpenAI client is synchronous, so the stream is consumed in a worker thread and its
+    events are passed to the event loop. Returns the completed response.
+    """
+    with tracing.span("llm", model=kwargs.get("model", "unknown"), caller=caller, stream=True) as span:
+        response = await _stream_response(on_text, caller, **kwargs)
+        tracing.record_usage(span, response)
+        return response
+
+
+async def _stream_response(on_text: Callable[[str], Awaitable[None]], caller: str, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    # Set when nobody reads the events anymore, so the thread leaves the stream and closes it
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            with client.responses.create(stream=True, **kwargs) as stream:
+                for event in stream:
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    start = time.perf_counter()
+    producer = loop.run_in_executor(None, produce)
+    response = None
+    error: Exception | None = None
+    try:
+        while (event := await queue.get()) is not None:
+            if isinstance(event, Exception):
+                error = event
+            elif event.type == "response.output_text.delta":
+                await on_text(event.delta)
+            elif event.type == "response.output_text.done":
+                await on_text("\n\n")
+            elif event.type == "response.completed":
+                response = event.response
+            elif event.type == "response.failed":
+                error = RuntimeError(f"Response failed: {event.response.error}")
+            elif event.type == "error":
+                error = RuntimeError(f"Response stream error: {event.message}")
+    finally:
+        stop.set()
+    await producer
+    if error is not None:
+        raise error
+    if response is None:
+        raise RuntimeError("Response stream ended without a completed response.")
+    record_llm_usage(response, kwargs.get("model", "unknown"), caller, time.perf_counter() - start)
+    return response
@@ -0,0 +1,154 @@
+import math
+import re
+import struct
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from .metrics import tex_encode_latency, tex_png_bytes
+
+
+_fence = re.compile(r"^\s*(```|~~~)")
+_list_item = re.compile(r"^\s*(?:[-*+]|\d+[.)]|#\.)\s")
+_display_open = re.compile(r"^\s*(?:\$\$|\\\[|\\begin\{(equation|align|gather|multline)\*?\})")
+_display_close = re.compile(r"(?:\$\$|\\\]|\\end\{(?:equation|align|gather|multline)\*?\})\s*$")
+
+# Blocks are compiled together up to this many characters, since every latex run has a fixed
+# startup cost that is larger than the cost of a typical paragraph.
+chunk_chars: int = 1200
+# Rendered blocks are stacked into images up to this many pixels tall
+tile_max_height: int = 6000
+tile_spacing: int = 40
+# DPI of the rendered text, chosen so that all the blocks of a reply fit in the pixel budget
+max_dpi: int = 500
+min_dpi: int = 150
+pixel_budget: int = 8_000_000
+# Colors of the palette the output is quantized to, 0 to keep full RGBA
+png_colors: int = 64
+
+
+def split_blocks(markdown: str) -> list[str]:
+    """Split Markdown into blocks that can be compiled independently.
+
+    Blocks are separated by blank lines, except inside fenced code and display math. The items
+    of a list stay in the same block, even when they are separated by blank lines.
+    """
+    blocks: list[list[str]] = []
+    current: list[str] = []
+    fence: str | None = None
+    in_display = False
+    for line in markdown.split("\n"):
+        if fence is not None:
+            current.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+            continue
+        if in_display:
+            current.append(line)
+            if _display_close.search(line):
+                in_display = False
+            continue
+        if (match := _fence.match(line)) is not None:
+            fence = match.group(1)
+            current.append(line)
+            continue
+        if _display_open.match(line):
+            # A display that opens and closes on the same line, like $$x$$, doesn't continue
+            stripped = line.strip()
+            in_display = not (len(stripped) > 2 and _display_close.search(stripped[2:]))
+            current.append(line)
+            continue
+        if not line.strip():
+            if current:
+                blocks.append(current)
+                current = []
+            continue
+        is_continuation = (
+            not current
+            and blocks
+            and _list_item.match(blocks[-1][0])
+            and (_list_item.match(line) or line.startswith((" ", "\t")))
+        )
+        if is_continuation:
+            current = blocks.pop()
+            current.append("")
+        current.append(line)
+    if current:
+        blocks.append(current)
+    return ["\n".join(block) for block in blocks]
+
+
+def chunk_blocks(blocks: list[str], max_chars: int = chunk_chars) -> list[list[str]]:
+    """Group consecutive blocks into chunks of up to `max_chars` characters."""
+    chunks: list[list[str]] = []
+    size = 0
+    for block in blocks:
+        if chunks and size + len(block) <= max_chars:
+            chunks[-1].append(block)
+            size += len(block)
+        else:
+            chunks.append([block])
+            size = len(block)
+    return chunks
+
+
+def dvi_size(path: str) -> tuple[float, float]:
+    """Width and height in inches of the largest page of a DVI file, read from its postamble."""
+    with open(path, "rb") as f:
+        data = f.read()
+    end = len(data) - 1
+    while data[end] == 223:  # Trailing padding
+        end -= 1
+    post = struct.unpack(">I", data[end - 4:end])[0]
+    if data[post] != 248:
+        raise ValueError(f"{path} has no DVI postamble")
+    num, den, mag, height, width = struct.unpack(">IIIII", data[post + 5:post + 25])
+    # DVI units times num/den are 1e-7 meters
+    inches = num / den * mag / 1000 / 1e7 / 0.0254
+    return width * inches, height * inches
+
+
+def choose_dpi(area: float) -> int:
+    """DPI that keeps `area` square inches within the pixel budget."""
+    if area <= 0:
+        return max_dpi
+    return max(min_dpi, min(max_dpi, int(math.sqrt(pixel_budget / area))))
+
+
+def encode_png(image: Image.Image, colors: int = png_colors) -> bytes:
+    """Encode an image as an optimized PNG, quantized to a palette unless `colors` is 0."""
+    if colors:
+        image = image.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    output = BytesIO()
+    image.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def stitch(images: list[Image.Image], max_height: int = tile_max_height, spacing: int = tile_spacing) -> list[bytes]:
+    """Stack images vertically into tiles of up to `max_height` pixels, returned as optimized PNG files.
+
+    An image taller than `max_height` gets a tile of its own.
+    """
+    groups: list[list[Image.Image]] = []
+    height = 0
+    for image in images:
+        if groups and height + spacing + image.height <= max_height:
+            groups[-1].append(image)
+            height += spacing + image.height
+        else:
+            groups.append([image])
+            height = image.height
+    tiles = []
+    for group in groups:
+        width = max(image.width for image in group)
+        tile = Image.new("RGBA", (width, sum(image.height for image in group) + spacing * (len(group) - 1)))
+        y = 0
+        for image in group:
+            tile.paste(image, (0, y))
+            y += image.height + spacing
+        start = time.perf_counter()
+        tiles.append(encode_png(tile))
+        tex_png_bytes.observe(len(tiles[-1]))
+        tex_encode_latency.observe(time.perf_counter() - start)
+    return tiles
@@ -0,0 +1,189 @@
+import atexit
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import manim
+from manim.mobject.text import tex_mobject
+
+from .latex_check import log_error
+from .metrics import Counter, Gauge
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+tex_cache_dir: str = os.getenv("TEX_CACHE_DIR", "tex_cache")
+tex_cache_max_bytes: int = int(os.getenv("TEX_CACHE_MAX_MB", "256")) * 1024 * 1024
+# The size of the cache is checked every this many new files
+evict_every: int = 64
+# Work directories left behind by a process that died while compiling are removed after this long
+stale_work_seconds: float = 3600.0
+
+tex_cache_lookups = Counter(
+    "tmg_tex_cache_lookups_total",
+    "Lookups of compiled Tex and MathTex SVG files in the shared cache.",
+    ("result",),
+)
+tex_cache_bytes = Gauge(
+    "tmg_tex_cache_bytes",
+    "Size of the shared Tex SVG cache, as of its last size check.",
+)
+
+
+class TexCache:
+    """Directory of the SVG files of compiled Tex and MathTex mobjects, shared between processes.
+
+    Files are named by a hash of the full document and the compiler, so the builder pass, the
+    final render and every worker pointed at the same directory reuse each other's results.
+    Each compilation happens in a private work directory and its SVG is moved in place with
+    `os.replace`, so other processes see either no file or a complete one. Hits touch their
+    file, and when the directory grows over `max_bytes` the least recently used files are
+    removed until it's back under 90% of it.
+
+    Manim reads the returned file right after asking for it, and another process could evict it
+    in between, so what's returned is a hard link that only the calling thread uses. It's
+    removed the next time the thread asks for a file.
+    """
+
+    def __init__(self, path: str = tex_cache_dir, max_bytes: int = tex_cache_max_bytes) -> None:
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self._added = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reading_dir: pathlib.Path | None = None
+
+    def svg_file(
+        self,
+        expression: str,
+        environment: str | None = None,
+        tex_template: manim.TexTemplate | None = None,
+    ) -> pathlib.Path:
+        """Drop-in replacement for `manim.utils.tex_file_writing.tex_to_svg_file`."""
+        if tex_template is None:
+            tex_template = manim.config.tex_template
+        if environment is not None:
+            code = tex_template.get_texcode_for_expression_in_env(expression, environment)
+        else:
+            code = tex_template.get_texcode_for_expression(expression)
+        key = hashlib.sha256(f"{tex_template.tex_compiler}\0{tex_template.output_format}\0{code}".encode("utf-8")).hexdigest()[:32]
+        svg = self.path / f"{key}.svg"
+        try:
+            os.utime(svg)
+            link = self._reading_link(svg)
+        except FileNotFoundError:
+            # Not compiled yet, or evicted by another process right after the check
+            pass
+        else:
+            tex_cache_lookups.inc(result="hit")
+            return link
+        tex_cache_lookups.inc(result="miss")
+        self.path.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.path, prefix=".work-") as directory:
+            work = pathlib.Path(directory)
+            with tracing.span("tex_cache.compile", compiler=tex_template.tex_compiler):
+                compiled = self._compile(work, code, tex_template.tex_compiler, tex_template.output_format)
+            link = self._reading_link(compiled, svg.name)
+            os.replace(compiled, svg)
+        with self._lock:
+            self._added += 1
+            should_evict = (self._added - 1) % evict_every == 0
+        if should_evict:
+            self.evict()
+        return link
+
+    def _reading_link(self, svg: pathlib.Path, name: str | None = None) -> pathlib.Path:
+        """Hard link to `svg` for the calling thread, replacing the link it got before."""
+        with self._lock:
+            if self._reading_dir is None:
+                self._reading_dir = self.path / f".work-reading-{os.getpid()}"
+                atexit.register(shutil.rmtree, self._reading_dir, ignore_errors=True)
+            directory = self._reading_dir
+        # Also recreated if another process removed it as stale, after an hour without renders
+        directory.mkdir(parents=True, exist_ok=True)
+        link = directory / f"{threading.get_ident()}-{name or svg.name}"
+        previous = getattr(self._local, "link", None)
+        if previous is not None and previous != link:
+            previous.unlink(missing_ok=True)
+        link.unlink(missing_ok=True)
+        os.link(svg, link)
+        self._local.link = link
+        return link
+
+    def _compile(self, work: pathlib.Path, code: str, compiler: str, output_format: str) -> pathlib.Path:
+        tex = work / "expression.tex"
+        tex.write_text(code, encoding="utf-8")
+        if compiler == "xelatex":
+            if output_format not in (".xdv", ".pdf"):
+                raise ValueError("xelatex output is either pdf or xdv")
+            command = ["xelatex", "-no-pdf"] if output_format == ".xdv" else ["xelatex"]
+        elif compiler in ("latex", "pdflatex", "luatex", "lualatex"):
+            command = [compiler, f"-output-format={output_format[1:]}"]
+        else:
+            raise ValueError(f"Tex compiler {compiler} unknown.")
+        result = tracing.run(
+            [*command, "-interaction=batchmode", "-halt-on-error", tex.name],
+            cwd=work,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if result.returncode != 0:
+            log = tex.with_suffix(".log")
+            error = log_error(log.read_text(encoding="utf-8", errors="replace")) if log.exists() else "No log file."
+            raise ValueError(f"{compiler} error converting to {output_format[1:]}.\n{error}")
+        svg = tex.with_suffix(".svg")
+        tracing.run(
+            ["dvisvgm", *(["--pdf"] if output_format == ".pdf" else []), "-p", "1", "-n", "-v", "0", "-o", svg.name, tex.with_suffix(output_format).name],
+            cwd=work,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if not svg.exists():
+            raise ValueError(f"dvisvgm couldn't convert the {output_format[1:]} file to SVG.")
+        return svg
+
+    def evict(self) -> None:
+        """Remove the least recently used files while the cache is over its size, and stale work directories."""
+        files = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.is_dir():
+                if entry.name.startswith(".work-") and now - stat.st_mtime > stale_work_seconds:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total > self.max_bytes:
+            files.sort()
+            removed = 0
+            for _, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            logger.info("Removed %d files from the Tex cache", removed)
+        tex_cache_bytes.set(total)
+
+
+tex_cache = TexCache()
+
+
+def install() -> None:
+    """Make Tex and MathTex mobjects go through the shared cache."""
+    tex_mobject.tex_to_svg_file = tex_cache.svg_file
@@ -19,3 +19,20 @@ DEFAULT_TEX_TEMPLATE: str = """
 \\end{{markdown}}
 \\end{{document}}
 """.strip()
+
+# Preamble for replies that are plain text and math. It skips minted, markdown and hyperref, so
+# it doesn't need -shell-escape nor a second pass, and loads in a fraction of the time.
+MINIMAL_TEX_TEMPLATE: str = """
+\\documentclass[preview]{{standalone}}
+\\usepackage[spanish]{{babel}}
+\\usepackage{{amsmath}}
+\\usepackage{{amssymb}}
+\\usepackage{{xcolor}}
+\\usepackage{{mlmodern}}
+\\setlength{{\\parskip}}{{\\medskipamount}}
+\\setlength{{\\parindent}}{{0pt}}
+\\begin{{document}}
+\\color{{white}}
+{md}
+\\end{{document}}
+""".strip()
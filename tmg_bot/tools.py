@@ -4,25 +4,36 @@ import sympy
 import pathlib
 import math
 import numpy as np
-from typing import Any
+from typing import Any, Awaitable, Callable
 from io import StringIO
 import json
+import logging
 import time
 from .instructions import MANIM_BUILDER_INSTRUCTIONS, MATH_SOLVE_INSTRUCTIONS, BING_SEARCH_INSTRUCTIONS
 import discord
-import manimpango
-import inspect
 import os
+import asyncio
+import threading
+import functools
 from .client import project_client, client
 from azure.ai.projects.models import BingGroundingTool, MessageRole
 from .supabase_client import supabase
+from .locks import render_lock
+from .metrics import record_llm_usage, render_manim_latency, renders, timed_lock
+from .registry import Tool, ToolRegistry
+from .solution_cache import SolutionCache
+from .latex_check import latex_checker
+from . import manim_index, tex_cache
+from .state import store
+from .encoding import encode_to_budget, upload_limit
+from .broker import Broker
+from .render_queue import PRIORITY_BACKGROUND, PRIORITY_HIGH, PRIORITY_NORMAL, QueueFull, QueueStatus, RenderCancelled, RenderQueue, SharedRenderQueue
+from .roles import is_mecenas
+from .quality import HIGH, LOW, Quality, choose_quality, rerender_in_background
+from . import tracing
 
-bing_connection = project_client.connections.get(connection_name=os.getenv("AZURE_BING_CONNECTION_NAME"))
-conn_id = bing_connection.id
+logger = logging.getLogger(__name__)
 
-print(conn_id)
-
-bing = BingGroundingTool(connection_id=conn_id)
 
 manim.config.tex_template = manim.TexTemplate(
     preamble=r"""
@@ -34,7 +45,20 @@ manim.config.tex_template = manim.TexTemplate(
 """
 )
 manim.config.background_color = "#161616"
+# Only disables the cache of partial movie files. Tex mobjects have their own shared cache.
 manim.config.disable_caching = True
+tex_cache.install()
+
+builder_tool_concurrency: int = 4
+math_lock = threading.Lock()  # `solve_math` continues a single conversation, so calls can't overlap
+
+
+@functools.cache
+def get_bing_tool() -> BingGroundingTool:
+    """Resolve the Bing connection the first time it's needed."""
+    bing_connection = project_client.connections.get(connection_name=os.getenv("AZURE_BING_CONNECTION_NAME"))
+    logger.debug("Bing connection: %s", bing_connection.id)
+    return BingGroundingTool(connection_id=bing_connection.id)
 
 
 def bing_search(
@@ -46,7 +70,7 @@ def bing_search(
             model="gpt-4o",
             instructions=BING_SEARCH_INSTRUCTIONS,
             name="bing_search",
-            tools=bing.definitions,
+            tools=get_bing_tool().definitions,
             headers={"x-ms-enable-preview": "true"},
         )
         thread = project_client.agents.create_thread()
@@ -56,18 +80,17 @@ def bing_search(
             content=query,
         )
         run = project_client.agents.create_and_process_run(thread_id=thread.id, agent_id=agent.id)
-        print(f"Run finished with status: {run.status}")
+        logger.info("Bing search run finished with status: %s", run.status)
         # Retrieve run step details to get Bing Search query link
         # To render the webpage, we recommend you replace the endpoint of Bing search query URLs with `www.bing.com` and your Bing search query URL would look like "https://www.bing.com/search?q={search query}"
         run_steps = project_client.agents.list_run_steps(run_id=run.id, thread_id=thread.id)
         run_steps_data = run_steps['data']
-        print(f"Last run step detail: {run_steps_data}")
+        logger.debug("Last run step detail: %s", run_steps_data)
 
         if run.status == "failed":
-            print(f"Run failed: {run.last_error}")
+            logger.warning("Bing search run failed: %s", run.last_error)
 
         project_client.agents.delete_agent(agent.id)
-        print("Deleted agent")
 
         response_message = project_client.agents.list_messages(thread_id=thread.id).get_last_message_by_role(
             MessageRole.AGENT
@@ -75,18 +98,16 @@ def bing_search(
         if response_message:
             data = {"text_messages": [], "url_citation_annotations": []}
             for text_message in response_message.text_messages:
-                print(f"Agent response: {text_message.text.value}")
                 data["text_messages"].append(text_message.text.value)
             for annotation in response_message.url_citation_annotations:
-                print(f"URL Citation: [{annotation.url_citation.title}]({annotation.url_citation.url})")
                 data["url_citation_annotations"].append(f"[{annotation.url_citation.title}]({annotation.url_citation.url})")
-            print("Agent response:", data)
+            logger.debug("Bing search response: %s", data)
             return str(data)
         else:
-            print("No response message found.")
+            logger.warning("No response message found for the Bing search.")
             return "No response message found."
-    except Exception as e:
-        print(f"Error searching the internet: {e}")
+    except Exception:
+        logger.exception("Error searching the internet")
         return "An error occurred while searching the internet. Please try again."
 
 
@@ -94,163 +115,28 @@ class ResponseScene(manim.Scene):
     _internal_manim_builder_previous_response_id: str | None = None
     _internal_prompt_count: int = 0
     _internal_prompt_limit: int = 500
-    _internal_tools: list = [
-        {
-            "type": "function",
-            "name": "exec_python",
-            "description": "Executes Python code. Use this to run Manim code inside the `construct` method.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "code": {
-                        "type": "string",
-                        "description": "Python code to execute.",
-                    },
-                },
-                "required": ["code"],
-                "additionalProperties": False,
-            },
-        },
-        {
-            "type": "function",
-            "name": "scope",
-            "description": "Returns the current scope variables and functions.",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": [],
-                "additionalProperties": False,
-            },
-        },
-        {
-            "type": "function",
-            "name": "dir",
-            "description": "Lists the available attributes and methods of an object.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "object": {
-                        "type": "string",
-                        "description": "Python object to list the attributes and methods. Must be available considering the current scope.",
-                    },
-                },
-                "additionalProperties": False,
-                "required": ["object"],
-            }
-        },
-        {
-            "type": "function",
-            "name": "doc",
-            "description": "Returns the docstring of a method or attribute.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "object": {
-                        "type": "string",
-                        "description": "Python object to get the docstring. Must be available considering the current scope.",
-                    },
-                },
-                "additionalProperties": False,
-                "required": ["object"],
-            }
-        },
-        {
-            "type": "function",
-            "name": "getparams",
-            "description": "Returns the parameters of a method or function.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "object": {
-                        "type": "string",
-                        "description": "Python object to get the parameters. Must be available considering the current scope.",
-                    },
-                },
-                "additionalProperties": False,
-                "required": ["object"],
-            }
-        },
-        {
-            "type": "function",
-            "name": "list_fonts",
-            "description": "Lists the available fonts for `Text` mobject.",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "additionalProperties": False,
-                "required": [],
-            },
-        },
-        {
-            "type": "function",
-            "name": "try_latex_text",
-            "description": "Tests if a LaTeX text mode string is valid.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "text": {
-                        "type": "string",
-                        "description": "LaTeX text mode string to test.",
-                    },
-                },
-                "additionalProperties": False,
-                "required": ["text"],
-            },
-        },
-        {
-            "type": "function",
-            "name": "try_latex_math",
-            "description": "Tests if a LaTeX math mode string is valid.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "math": {
-                        "type": "string",
-                        "description": "LaTeX math mode string to test.",
-                    },
-                },
-                "required": ["math"],
-                "additionalProperties": False,
-            },
-        },
-        {
-            "type": "function",
-            "name": "eval",
-            "description": "Evaluates a Python expression.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "expression": {
-                        "type": "string",
-                        "description": "Python expression to evaluate.",
-                    },
-                },
-                "required": ["expression"],
-                "additionalProperties": False,
-            },
-        },
-        {
-            "type": "function",
-            "name": "finish",
-            "description": "Finishes the scene rendering.",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": [],
-                "additionalProperties": False,
-            },
-        },
-    ]
     """Scene class for rendering responses."""
 
-    def __init__(self, title: str, description: str, type: str, data: list[dict[str, Any]] | None = None, **kwargs):
+    def __init__(
+        self,
+        title: str,
+        description: str,
+        type: str,
+        data: list[dict[str, Any]] | None = None,
+        loop: asyncio.AbstractEventLoop | None = None,
+        cancel_event: threading.Event | None = None,
+        **kwargs
+    ):
         super().__init__(**kwargs)
+        self._internal_loop = loop
+        self._internal_cancel_event = cancel_event
         self._internal_title = title
         self._internal_description = description
         self._internal_data = data
         self._internal_type = type
         self._internal_finished: bool = False
         self._internal_successful_data = []
+        self._internal_duration: float = 0.0
         self._internal_reset_scope()
     
     def _internal_reset_scope(self) -> None:
@@ -271,6 +157,8 @@ class ResponseScene(manim.Scene):
         if self._internal_prompt_count > self._internal_prompt_limit:
             self._internal_manim_builder_previous_response_id = None
             self._internal_prompt_count = 0
+            MANIM_BUILDER_FORMATTED_INSTRUCTIONS = None
+        if MANIM_BUILDER_FORMATTED_INSTRUCTIONS is None:
             MANIM_BUILDER_FORMATTED_INSTRUCTIONS = MANIM_BUILDER_INSTRUCTIONS.format(
                 rag_dataset=load_manim_rag_dataset()
             )
@@ -284,113 +172,47 @@ class ResponseScene(manim.Scene):
         sio.seek(0)
         first_time: bool = True
         while not self._internal_finished:
-            self._internal_prompt_count += 1
-            response = client.responses.create(
-                model="gpt-4.1",
-                instructions=MANIM_BUILDER_FORMATTED_INSTRUCTIONS,
-                input=sio.getvalue() if first_time else outputs,
-                temperature=0.0,
-                tools=self._internal_tools,
-                previous_response_id=self._internal_manim_builder_previous_response_id,
-            )
-            outputs = []
-            first_time = False
-            response_id = response.id
-            self._internal_manim_builder_previous_response_id = response_id
-            output = response.output
-            for item in output:
-                if not isinstance(item, dict):
-                    item = item.to_dict(mode="json")
-                if item["type"] == "function_call":
-                    name = item["name"]
-                    arguments = json.loads(item["arguments"])
-                    if name == "exec_python":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_exec_python(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "scope":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_show_scope()
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "dir":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_show_dir(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "doc":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_show_doc(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "getparams":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_show_params(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "list_fonts":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_list_fonts()
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "try_latex_text":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_try_latex_text(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "try_latex_math":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_try_latex_math(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "eval":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_eval(**arguments)
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                    elif name == "finish":
-                        time.sleep(2.0)  # Avoid hitting the API too fast
-                        out = self._internal_finish_scene()
-                        outputs.append({
-                            "type": "function_call_output",
-                            "call_id": item["call_id"],
-                            "output": out,
-                        })
-                contents = item.get("content", None)
-                if contents:
-                    for content in contents:
-                        if content["type"] == "output_text":
-                            print(content["text"])
-            time.sleep(2.0)  # Avoid hitting the API too fast
+            if self._internal_cancel_event is not None and self._internal_cancel_event.is_set():
+                raise RenderCancelled()
+            with tracing.span("builder_turn", turn=self._internal_prompt_count + 1):
+                self._internal_prompt_count += 1
+                start = time.perf_counter()
+                with tracing.span("llm", model="gpt-4.1", caller="builder") as span:
+                    response = client.responses.create(
+                        model="gpt-4.1",
+                        instructions=MANIM_BUILDER_FORMATTED_INSTRUCTIONS,
+                        input=sio.getvalue() if first_time else outputs,
+                        temperature=0.0,
+                        tools=builder_tools.schemas,
+                        previous_response_id=self._internal_manim_builder_previous_response_id,
+                    )
+                    tracing.record_usage(span, response)
+                record_llm_usage(response, "gpt-4.1", "builder", time.perf_counter() - start)
+                first_time = False
+                response_id = response.id
+                self._internal_manim_builder_previous_response_id = response_id
+                output = response.output
+                calls = []
+                for item in output:
+                    if not isinstance(item, dict):
+                        item = item.to_dict(mode="json")
+                    if item["type"] == "function_call":
+                        calls.append(item)
+                    contents = item.get("content", None)
+                    if contents:
+                        for content in contents:
+                            if content["type"] == "output_text":
+                                logger.debug("Builder says: %s", content["text"])
+                outputs = self._internal_run_calls(calls)
+                time.sleep(2.0)  # Avoid hitting the API too fast
     
+    def _internal_run_calls(self, calls: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Runs the function calls of a turn in the bot's event loop and waits for their outputs."""
+        coroutine = builder_tools.dispatch_calls(calls, self, builder_tool_concurrency)
+        if self._internal_loop is None:
+            return asyncio.run(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._internal_loop).result()
+
     def _internal_construct_with_data(self) -> None:
         for item in self._internal_data:
             exec(item["code"], self._internal_scope)
@@ -399,12 +221,14 @@ class ResponseScene(manim.Scene):
         """Executes Python code."""
         self.clear()
         self._internal_reset_scope()
+        # Every call replays the successful code, so the time of the scene starts again from zero
+        self.renderer.time = 0
         for item in self._internal_successful_data:
             exec(item["code"], self._internal_scope)
         try:
             exec(code, self._internal_scope)
         except Exception as e:
-            print("Error executing code\n" + str(type(e)) + ": " + str(e))
+            logger.debug("Error executing code: %s: %s", type(e), e)
             return "Error executing code\n" + str(type(e)) + ": " + str(e)
         else:
             self._internal_successful_data.append(
@@ -412,90 +236,89 @@ class ResponseScene(manim.Scene):
                     "code": code,
                 }
             )
-            print("Code executed successfully.")
+            self._internal_duration = self.renderer.time
             return "Code executed successfully."
     
     def _internal_show_scope(self) -> str:
-        print("Scope:", self._internal_scope)
-        return str(self._internal_scope)
+        return manim_index.scope_summary(self._internal_scope)
+
+    def _internal_search_manim(self, query: str) -> str:
+        entries = manim_index.search(query)
+        if not entries:
+            return f"Nothing in Manim matches {query!r}."
+        return manim_index.cap("\n".join(entry.describe() for entry in entries))
     
     def _internal_show_dir(self, object: str) -> str:
         try:
             obj = eval(object, self._internal_scope)
-            print("Dir:", dir(obj))
-            return str(dir(obj))
+            return manim_index.cap(manim_index.public_members(obj) or f"{object} has no public attributes.")
         except Exception as e:
-            print(f"{type(e)}: {e}")
-            return "An error occurred while trying to get the dir of {object}.\n" + str(type(e)) + ": " + str(e)
+            logger.debug("%s: %s", type(e), e)
+            return f"An error occurred while trying to get the dir of {object}.\n" + str(type(e)) + ": " + str(e)
     
     def _internal_show_doc(self, object: str) -> str:
         try:
             obj = eval(object, self._internal_scope)
-            doc = getattr(obj, "__doc__", None)
+            doc = manim_index.short_doc(obj)
             if doc:
-                print("Doc:", doc)
-                return str(doc)
+                return doc
             else:
-                print(f"No docstring found for {object}, but it exists.")
                 return f"No docstring found for {object}, but it exists."
         except Exception as e:
-            print(f"{type(e)}: {e}")
+            logger.debug("%s: %s", type(e), e)
             return f"An error occurred while trying to get the docstring of {object}.\n" + str(type(e)) + ": " + str(e)
     
     def _internal_show_params(self, object: str) -> str:
         try:
             obj = eval(object, self._internal_scope)
             if not callable(obj):
-                print(f"Object {object} is not callable.")
                 return f"Object {object} is not callable."
-            params = inspect.getfullargspec(obj).args
-            if params:
-                print("Params:", params)
-                return str(params)
+            params = manim_index.signature(obj)
+            if params and params != "()":
+                return manim_index.cap(f"{object}{params}")
             else:
-                print(f"Function {object} has no parameters. Call it using `()`.")
                 return f"Function {object} has no parameters. Call it using `()`. "
         except Exception as e:
-            print(f"{type(e)}: {e}")
+            logger.debug("%s: %s", type(e), e)
             return f"An error occurred while trying to get the parameters of {object}.\n" + str(type(e)) + ": " + str(e)
     
     def _internal_list_fonts(self) -> str:
-        fonts = manimpango.list_fonts()
-        print("Fonts:", fonts)
-        return str(fonts)
+        return manim_index.cap(", ".join(manim_index.font_names()))
     
     def _internal_try_latex_text(self, text: str) -> str:
-        try:
-            manim.Tex(text)
-            print("LaTeX text mode string is valid.")
+        error = latex_checker.check([("text", text)])[0]
+        if error is None:
             return "LaTeX text mode string is valid."
-        except Exception as e:
-            print("LaTeX text mode string is invalid.\n" + str(type(e)) + ": " + str(e))
-            return "LaTeX text mode string is invalid.\n" + str(type(e)) + ": " + str(e)
+        return "LaTeX text mode string is invalid.\n" + error
         
     def _internal_try_latex_math(self, math: str) -> str:
-        try:
-            manim.MathTex(math)
-            print("LaTeX math mode string is valid.")
+        error = latex_checker.check([("math", math)])[0]
+        if error is None:
             return "LaTeX math mode string is valid."
-        except Exception as e:
-            print("LaTeX math mode string is invalid.\n" + str(type(e)) + ": " + str(e))
-            return "LaTeX math mode string is invalid.\n" + str(type(e)) + ": " + str(e)
+        return "LaTeX math mode string is invalid.\n" + error
+
+    def _internal_try_latex_batch(self, strings: list[dict[str, str]]) -> str:
+        errors = latex_checker.check([(item["mode"], item["latex"]) for item in strings])
+        lines = []
+        for i, (item, error) in enumerate(zip(strings, errors), start=1):
+            if error is None:
+                lines.append(f"{i}. LaTeX {item['mode']} mode string is valid.")
+            else:
+                lines.append(f"{i}. LaTeX {item['mode']} mode string is invalid.\n" + error)
+        return "\n".join(lines)
     
     def _internal_eval(self, expression: str) -> str:
         try:
             code = expression.split("\n")
             exec("\n".join(code[:-1]), self._internal_scope)
             obj = eval(code[-1], self._internal_scope)
-            print("Eval:", obj)
             return str(obj)
         except Exception as e:
-            print(f"An error occurred while trying to evaluate {expression}.\n" + str(type(e)) + ": " + str(e))
             return f"An error occurred while trying to evaluate {expression}.\n" + str(type(e)) + ": " + str(e)
     
     def _internal_finish_scene(self) -> str:
         self._internal_finished = True
-        print("Scene finished.")
+        logger.info("Scene %r finished", self._internal_title)
         return "Scene finished."
 
 
@@ -504,6 +327,223 @@ class ResponseScene3D(manim.ThreeDScene, ResponseScene):
     pass
 
 
+builder_tools = ToolRegistry("builder")
+
+
+def _scene_tool(method: str) -> Callable[..., Awaitable[str]]:
+    """Make a tool handler that runs a method of the scene being built in a worker thread."""
+    async def handler(scene: ResponseScene, **arguments: Any) -> str:
+        return await asyncio.to_thread(getattr(scene, method), **arguments)
+    return handler
+
+
+builder_tools.add(Tool(
+    name="exec_python",
+    description="Executes Python code. Use this to run Manim code inside the `construct` method.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "code": {
+                "type": "string",
+                "description": "Python code to execute.",
+            },
+        },
+        "required": ["code"],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_exec_python"),
+    exclusive=True,
+))
+builder_tools.add(Tool(
+    name="scope",
+    description="Returns the variables and functions defined in the current scope, besides Manim's.",
+    parameters={
+        "type": "object",
+        "properties": {},
+        "required": [],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_show_scope"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="search_manim",
+    description="Searches the classes, functions and constants of Manim by name and description.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "Name or words to search, like `Arrow`, `number line` or `fade in`.",
+            },
+        },
+        "required": ["query"],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_search_manim"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="dir",
+    description="Lists the available attributes and methods of an object.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "object": {
+                "type": "string",
+                "description": "Python object to list the attributes and methods. Must be available considering the current scope.",
+            },
+        },
+        "additionalProperties": False,
+        "required": ["object"],
+    },
+    handler=_scene_tool("_internal_show_dir"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="doc",
+    description="Returns the docstring of a method or attribute.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "object": {
+                "type": "string",
+                "description": "Python object to get the docstring. Must be available considering the current scope.",
+            },
+        },
+        "additionalProperties": False,
+        "required": ["object"],
+    },
+    handler=_scene_tool("_internal_show_doc"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="getparams",
+    description="Returns the parameters of a method or function.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "object": {
+                "type": "string",
+                "description": "Python object to get the parameters. Must be available considering the current scope.",
+            },
+        },
+        "additionalProperties": False,
+        "required": ["object"],
+    },
+    handler=_scene_tool("_internal_show_params"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="list_fonts",
+    description="Lists the available fonts for `Text` mobject.",
+    parameters={
+        "type": "object",
+        "properties": {},
+        "additionalProperties": False,
+        "required": [],
+    },
+    handler=_scene_tool("_internal_list_fonts"),
+    timeout=30.0,
+))
+builder_tools.add(Tool(
+    name="try_latex_text",
+    description="Tests if a LaTeX text mode string is valid.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "text": {
+                "type": "string",
+                "description": "LaTeX text mode string to test.",
+            },
+        },
+        "additionalProperties": False,
+        "required": ["text"],
+    },
+    handler=_scene_tool("_internal_try_latex_text"),
+    timeout=60.0,
+))
+builder_tools.add(Tool(
+    name="try_latex_math",
+    description="Tests if a LaTeX math mode string is valid.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "math": {
+                "type": "string",
+                "description": "LaTeX math mode string to test.",
+            },
+        },
+        "required": ["math"],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_try_latex_math"),
+    timeout=60.0,
+))
+builder_tools.add(Tool(
+    name="try_latex_batch",
+    description="Tests several LaTeX strings at once, in text or math mode. Faster than testing them one by one.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "strings": {
+                "type": "array",
+                "description": "LaTeX strings to test.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "mode": {
+                            "type": "string",
+                            "enum": ["text", "math"],
+                            "description": "Whether the string is a LaTeX text mode or math mode string.",
+                        },
+                        "latex": {
+                            "type": "string",
+                            "description": "LaTeX string to test.",
+                        },
+                    },
+                    "required": ["mode", "latex"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["strings"],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_try_latex_batch"),
+    timeout=120.0,
+))
+builder_tools.add(Tool(
+    name="eval",
+    description="Evaluates a Python expression.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "expression": {
+                "type": "string",
+                "description": "Python expression to evaluate.",
+            },
+        },
+        "required": ["expression"],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_eval"),
+    exclusive=True,
+))
+builder_tools.add(Tool(
+    name="finish",
+    description="Finishes the scene rendering.",
+    parameters={
+        "type": "object",
+        "properties": {},
+        "required": [],
+        "additionalProperties": False,
+    },
+    handler=_scene_tool("_internal_finish_scene"),
+    exclusive=True,
+))
+
+
 def get_code_template(scene: ResponseScene | ResponseScene3D) -> str:
     base_class_name = "ThreeDScene" if isinstance(scene, ResponseScene3D) else "Scene"
     code = "\n".join([
@@ -557,9 +597,29 @@ Here you will see well done examples with title, description, and the code snipp
     return rag_dataset
 
 
-MANIM_BUILDER_FORMATTED_INSTRUCTIONS: str = MANIM_BUILDER_INSTRUCTIONS.format(
-    rag_dataset=load_manim_rag_dataset()
-)
+# Loaded when the first scene is built, so importing this module doesn't query Supabase
+MANIM_BUILDER_FORMATTED_INSTRUCTIONS: str | None = None
+
+
+# Manim's config is global, so a process renders one scene at a time (see `render_lock`).
+# Raising MAX_CONCURRENT_RENDERS only makes sense in gateway mode, where the workers share the
+# queue and its slots (see `share_render_queue`).
+max_concurrent_renders: int = int(os.getenv("MAX_CONCURRENT_RENDERS", "1"))
+max_queued_renders: int = int(os.getenv("MAX_QUEUED_RENDERS", "5"))
+render_queue: RenderQueue | SharedRenderQueue = RenderQueue(max_concurrent_renders, max_queued_renders)
+
+
+def share_render_queue(broker: Broker, worker: str) -> None:
+    """Keep the render queue in the broker, so the workers of gateway mode wait in a single one."""
+    global render_queue
+    render_queue = SharedRenderQueue(broker, worker, max_concurrent_renders, max_queued_renders)
+
+
+def render_priority(message: discord.Message) -> int:
+    """Mecenas go first. DMs are only answered for mecenas, so they go first too."""
+    if isinstance(message.channel, discord.DMChannel) or is_mecenas(message.author):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
 
 
 async def render_manim(
@@ -569,32 +629,159 @@ async def render_manim(
     is_3d: bool,
     type: str
 ) -> str:
-    """Render a Manim scene and send it to the Discord channel."""
+    """Render a Manim scene and send it to the Discord channel, when its turn in the render queue comes."""
+    async def run(cancel_event: threading.Event, load: int) -> str:
+        async with timed_lock(render_lock, "render"):
+            with render_manim_latency.time(type=type):
+                return await _render_manim(message, title, description, is_3d, type, cancel_event, load)
+
+    status = QueueStatus(message)
     try:
-        scene = ResponseScene3D if is_3d else ResponseScene
-        manim.config.output_file = scene.__name__
-        manim.config.write_to_movie = True
+        return await render_queue.submit(message.id, run, render_priority(message), status)
+    except QueueFull:
+        return "The render queue is full right now. Kindly tell the user to ask for the animation again in a few minutes."
+    except RenderCancelled:
+        return "The render was cancelled because the user deleted their message."
+    finally:
+        await status.clear()
+
+
+def scene_output_path(scene_instance: ResponseScene, type: str) -> pathlib.Path | None:
+    """Path of the file written by the last render of a scene."""
+    file_writer = scene_instance.renderer.file_writer
+    path = file_writer.movie_file_path if type == "video" else file_writer.image_file_path
+    return pathlib.Path(path) if path else None
+
+
+def replay_scene(
+    title: str,
+    description: str,
+    is_3d: bool,
+    type: str,
+    data: list[dict[str, Any]],
+    quality: Quality,
+) -> ResponseScene:
+    """Render a scene from the code of a previous build, at the given quality."""
+    scene = ResponseScene3D if is_3d else ResponseScene
+    manim.config.output_file = scene.__name__
+    manim.config.write_to_movie = True
+    with manim.tempconfig(quality.config()):
         scene_instance = scene(
             title=title,
             description=description,
             type=type,
-            data=None,
+            data=data,
         )
-        scene_instance.render()
-        scene = ResponseScene3D if is_3d else ResponseScene
+        with tracing.span("manim.render", pieces=len(data), quality=quality.label):
+            scene_instance.render()
+    return scene_instance
+
+
+def build_scene(
+    title: str,
+    description: str,
+    is_3d: bool,
+    type: str,
+    loop: asyncio.AbstractEventLoop | None = None,
+    queue_depth: int = 1,
+    cancel_event: threading.Event | None = None,
+) -> tuple[ResponseScene, Quality]:
+    """Build a scene with the builder model and render it again from the successful code.
+
+    The builder pass is only seen by the builder model, so it's rendered at low quality. The
+    quality of the final render is chosen from the duration of the built scene and the renders
+    in the queue around it (see `RenderJob.load`).
+    """
+    scene = ResponseScene3D if is_3d else ResponseScene
+    manim.config.output_file = scene.__name__
+    manim.config.write_to_movie = True
+    with manim.tempconfig(LOW.config()):
         scene_instance = scene(
             title=title,
             description=description,
             type=type,
-            data=scene_instance._internal_successful_data,
+            data=None,
+            loop=loop,
+            cancel_event=cancel_event,
+        )
+        with tracing.span("manim.build"):
+            scene_instance.render()
+    # The duration of the successful code, without the replays and failed attempts of the builder
+    duration = scene_instance._internal_duration
+    quality = choose_quality(duration, is_3d, queue_depth, type)
+    logger.info("Rendering %s of %.1f s at %s", type, duration, quality.label)
+    scene_instance = replay_scene(title, description, is_3d, type, scene_instance._internal_successful_data, quality)
+    return scene_instance, quality
+
+
+# Background re-renders, referenced so they aren't garbage collected while they run
+background_renders: set[asyncio.Task] = set()
+
+
+async def rerender_high_quality(
+    msg: discord.Message,
+    title: str,
+    description: str,
+    is_3d: bool,
+    data: list[dict[str, Any]],
+) -> None:
+    """Render a video again at high quality once no other render is waiting, and replace the sent file."""
+    async def run(cancel_event: threading.Event, load: int) -> None:
+        async with timed_lock(render_lock, "render"):
+            scene_instance = await asyncio.to_thread(replay_scene, title, description, is_3d, "video", data, HIGH)
+            path = scene_output_path(scene_instance, "video")
+            if path is None or not path.exists():
+                return
+            if path.stat().st_size > upload_limit(msg):
+                logger.info("High quality render of %s is too large to upload", title)
+                return
+            with open(path, "rb") as f, tracing.span("discord.send", kind="manim_rerender", size=path.stat().st_size):
+                await msg.edit(file=discord.File(fp=f, filename=f"{title}.mp4"), attachments=[])
+        renders.inc(type="video", quality=HIGH.name)
+
+    try:
+        # Deleting the video cancels its re-render
+        await render_queue.submit(msg.id, run, PRIORITY_BACKGROUND)
+    except RenderCancelled:
+        pass
+    except Exception:
+        logger.exception("Error re-rendering Manim scene at high quality")
+
+
+async def _render_manim(
+    message: discord.Message,
+    title: str,
+    description: str,
+    is_3d: bool,
+    type: str,
+    cancel_event: threading.Event | None = None,
+    queue_depth: int = 1,
+) -> str:
+    try:
+        # Rendering is blocking, so it runs in a worker thread. Manim's config is global,
+        # which is why renders are serialized by `render_lock`.
+        scene_instance, quality = await asyncio.to_thread(
+            build_scene,
+            title,
+            description,
+            is_3d,
+            type,
+            asyncio.get_running_loop(),
+            queue_depth,
+            cancel_event,
         )
+        renders.inc(type=type, quality=quality.name)
         code_template = get_code_template(scene_instance)
-        scene_instance.render()
+        path = scene_output_path(scene_instance, type)
         if type == "video":
-            path = pathlib.Path("media") / "videos" / "1080p60" / f"{scene.__name__}.mp4"
-            if not path.exists():
+            if path is None or not path.exists():
                 return "The video was not rendered. Please try again."
-            with open(path, "rb") as f:
+            budget = upload_limit(message)
+            encoded = await asyncio.to_thread(encode_to_budget, path, budget)
+            if encoded.size > budget:
+                return "The video is too large to upload, even at low quality. Please ask for a shorter animation."
+            path = encoded.path
+            with open(path, "rb") as f, tracing.span("discord.send", kind="manim", size=path.stat().st_size, quality=quality.label):
                 msg = await message.reply(content="Reacciona a este mensaje, por favor. Tu feedback es importante.", file=discord.File(fp=f, filename=f"{title}.mp4"))
             await msg.add_reaction("👍")
             await msg.add_reaction("👎")
@@ -609,17 +796,22 @@ async def render_manim(
                     "id": str(msg.id),
                 }
             ).execute()
+            if rerender_in_background and quality != HIGH:
+                task = asyncio.create_task(
+                    rerender_high_quality(msg, title, description, is_3d, scene_instance._internal_data)
+                )
+                background_renders.add(task)
+                task.add_done_callback(background_renders.discard)
             return (
-                "The video was rendered successfully. The user must watch it in the sent message.\n"
+                f"The video was rendered successfully at {quality.label} ({encoded.describe()}). The user must watch it in the sent message.\n"
                 + "The code to build the scene is:\n```python\n" \
                 + code_template
                 + "```"
             )
         else:
-            path = pathlib.Path("media") / "images" / f"{scene.__name__}.png"
-            if not path.exists():
+            if path is None or not path.exists():
                 return "The image was not rendered. Please try again."
-            with open(path, "rb") as f:
+            with open(path, "rb") as f, tracing.span("discord.send", kind="manim", size=path.stat().st_size, quality=quality.label):
                 msg = await message.reply(content="Reacciona a este mensaje, por favor. Tu feedback es importante.", file=discord.File(fp=f, filename=f"{title}.png"))
             await msg.add_reaction("👍")
             await msg.add_reaction("👎")
@@ -640,8 +832,10 @@ async def render_manim(
                 + code_template
                 +"```"
             )
-    except Exception as e:
-        print(f"Error rendering Manim scene: {e}")
+    except RenderCancelled:
+        raise
+    except Exception:
+        logger.exception("Error rendering Manim scene")
         return "An error occurred while rendering the Manim scene. Please try again."
 
 
@@ -650,11 +844,36 @@ prompt_count: int = 0
 prompt_limit: int = 500
 
 
+solve_math_error: str = "An error occurred while solving the math problem. Please try again."
+# Solutions are reused for repeated problems, until the instructions or the model change
+solution_cache = SolutionCache(f"gpt-4.1\0{MATH_SOLVE_INSTRUCTIONS}")
+
+
 def solve_math(
     problem_statement: str
 ) -> str:
     """Create a math response using reasoning model."""
+    solution = solution_cache.get(problem_statement)
+    if solution is not None:
+        return solution
+    with math_lock:
+        # The same problem may have been solved while waiting for the lock
+        solution = solution_cache.get(problem_statement)
+        if solution is not None:
+            return solution
+        solution = _solve_math(problem_statement)
+        if solution != solve_math_error:
+            solution_cache.put(problem_statement, solution)
+        return solution
+
+
+def _solve_math(
+    problem_statement: str
+) -> str:
     global last_math_response_id, prompt_count, prompt_limit
+    chain = store.read("solve_math", {})
+    last_math_response_id = chain.get("response_id")
+    prompt_count = chain.get("prompt_count", 0)
     prompt_count += 1
     if prompt_count > prompt_limit:
         last_math_response_id = None
@@ -664,31 +883,35 @@ def solve_math(
         text_parts = []
         while there_was_function_call:
             there_was_function_call = False
-            response = client.responses.create(
-                model="gpt-4.1",
-                instructions=MATH_SOLVE_INSTRUCTIONS,
-                input=problem_statement,
-                temperature=0.0,
-                previous_response_id=last_math_response_id,
-                tools=[
-                    {
-                        "type": "function",
-                        "name": "sympy_calculator",
-                        "description": "Calculates mathematical expressions using Python and SymPy, NumPy and math module.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "expression": {
-                                    "type": "string",
-                                    "description": "Python expression to evaluate..",
+            start = time.perf_counter()
+            with tracing.span("llm", model="gpt-4.1", caller="solve_math") as span:
+                response = client.responses.create(
+                    model="gpt-4.1",
+                    instructions=MATH_SOLVE_INSTRUCTIONS,
+                    input=problem_statement,
+                    temperature=0.0,
+                    previous_response_id=last_math_response_id,
+                    tools=[
+                        {
+                            "type": "function",
+                            "name": "sympy_calculator",
+                            "description": "Calculates mathematical expressions using Python and SymPy, NumPy and math module.",
+                            "parameters": {
+                                "type": "object",
+                                "properties": {
+                                    "expression": {
+                                        "type": "string",
+                                        "description": "Python expression to evaluate..",
+                                    },
                                 },
+                                "required": ["expression"],
+                                "additionalProperties": False,
                             },
-                            "required": ["expression"],
-                            "additionalProperties": False,
                         },
-                    },
-                ],
-            )
+                    ],
+                )
+                tracing.record_usage(span, response)
+            record_llm_usage(response, "gpt-4.1", "solve_math", time.perf_counter() - start)
             last_math_response_id = response.id
             output = response.output
             problem_statement = []
@@ -700,7 +923,6 @@ def solve_math(
                     arguments = json.loads(item["arguments"])
                     if name == "sympy_calculator":
                         expression = arguments["expression"]
-                        print("Expression:", expression)
                         try:
                             scope = {"sympy": sympy, "math": math, "np": np}
                             code = expression.split("\n")
@@ -708,7 +930,7 @@ def solve_math(
                             result = str(eval(code[-1], scope))
                         except Exception as e:
                             result = f"{type(e)}: {e}"
-                        print("Result:", result)
+                        logger.debug("sympy_calculator: %s -> %s", expression, result)
                         problem_statement.append({
                             "type": "function_call_output",
                             "call_id": item["call_id"],
@@ -721,10 +943,89 @@ def solve_math(
                 if content:
                     for content_item in content:
                         if content_item["type"] == "output_text":
-                            print(content_item["text"])
                             text_parts.append(content_item["text"])
             time.sleep(2.0)  # Avoid hitting the API too fast
         return "\n\n".join(text_parts)
-    except Exception as e:
-        print(f"Error solving math problem: {e}")
-        return "An error occurred while solving the math problem. Please try again."
+    except Exception:
+        logger.exception("Error solving math problem")
+        return solve_math_error
+    finally:
+        store.write("solve_math", {"response_id": last_math_response_id, "prompt_count": prompt_count})
+
+
+academic_tools = ToolRegistry("academic")
+
+
+@academic_tools.tool(
+    name="bing_search",
+    description="Search the internet.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "The search query.",
+            },
+        },
+        "required": ["query"],
+        "additionalProperties": False,
+    },
+    timeout=120.0,
+    concurrency=2,
+)
+async def _bing_search_tool(message: discord.Message, query: str) -> str:
+    return await asyncio.to_thread(bing_search, query)
+
+
+@academic_tools.tool(
+    name="render_manim",
+    description="Render a Manim animation.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "title": {
+                "type": "string",
+                "description": "The title of the animation.",
+            },
+            "description": {
+                "type": "string",
+                "description": "The description of the animation. It's all what should be shown in the rendered video.",
+            },
+            "is_3d": {
+                "type": "boolean",
+                "description": "Whether the scene is 3D or not.",
+            },
+            "type": {
+                "type": "string",
+                "description": "The type of output.",
+                "enum": ["image", "video"],
+            }
+        },
+        "additionalProperties": False,
+        "required": ["title", "description", "is_3d", "type"],
+    },
+)
+async def _render_manim_tool(message: discord.Message, **arguments: Any) -> str:
+    # No timeout: the render can't be stopped once it's running in its thread.
+    return await render_manim(message, **arguments)
+
+
+@academic_tools.tool(
+    name="solve_math",
+    description="Solve a math problem.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "problem_statement": {
+                "type": "string",
+                "description": "The math problem statement.",
+            },
+        },
+        "additionalProperties": False,
+        "required": ["problem_statement"],
+    },
+    timeout=600.0,
+    concurrency=1,
+)
+async def _solve_math_tool(message: discord.Message, problem_statement: str) -> str:
+    return await asyncio.to_thread(solve_math, problem_statement)
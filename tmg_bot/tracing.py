@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import subprocess
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+trace_file: str | None = os.getenv("TRACE_FILE")
+otlp_endpoint: str | None = os.getenv("OTLP_ENDPOINT")  # For example http://localhost:4318/v1/traces
+sample_rate: float = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+service_name: str = os.getenv("TRACE_SERVICE_NAME", "tmg-bot")
+
+
+class Span:
+    """A timed operation inside a trace."""
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: dict[str, Any]) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.error: str | None = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Exporter:
+    """Exports finished spans in batches from a background thread."""
+
+    def __init__(self, path: str | None, endpoint: str | None, batch_size: int = 128, interval: float = 2.0) -> None:
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: queue.Queue[Span] = queue.Queue(maxsize=10_000)
+        self.thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            logger.warning("Trace export queue is full, dropping span %s", span.name)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Error exporting %d spans", len(batch))
+
+    def _write(self, batch: list[Span]) -> None:
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for span in batch:
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+        if self.endpoint:
+            payload = {
+                "resourceSpans": [{
+                    "resource": {"attributes": [_otlp_attribute("service.name", service_name)]},
+                    "scopeSpans": [{
+                        "scope": {"name": "tmg_bot"},
+                        "spans": [span.to_otlp() for span in batch],
+                    }],
+                }],
+            }
+            request = urllib.request.Request(
+                self.endpoint,
+                data=json.dumps(payload, default=str).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            urllib.request.urlopen(request, timeout=10).close()
+
+
+exporter: Exporter | None = Exporter(trace_file, otlp_endpoint) if trace_file or otlp_endpoint else None
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def _activate(span: Span) -> Iterator[Span]:
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        span.end_ns = time.time_ns()
+        exporter.export(span)
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """Start a new trace, if tracing is enabled and the trace is sampled."""
+    if exporter is None or random.random() >= sample_rate:
+        token = current_span.set(None)
+        try:
+            yield None
+        finally:
+            current_span.reset(token)
+        return
+    with _activate(Span(name, secrets.token_hex(16), None, attributes)) as span:
+        yield span
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """Record a child span of the current one. Does nothing outside of a sampled trace.
+
+    The current span is kept in a context variable, so it follows asyncio tasks and
+    `asyncio.to_thread` calls.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _activate(Span(name, parent.trace_id, parent.span_id, attributes)) as child:
+        yield child
+
+
+def record_usage(span: Span | None, response: Any) -> None:
+    """Add the token usage of a response to its LLM span."""
+    usage = getattr(response, "usage", None)
+    if span is not None and usage is not None:
+        span.set(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens)
+
+
+def run(command: str | list[str], **kwargs: Any) -> subprocess.CompletedProcess:
+    """`subprocess.run` recorded as a span."""
+    program = command.split()[0] if isinstance(command, str) else command[0]
+    with span(f"subprocess {program}", command=command if isinstance(command, str) else " ".join(command)) as s:
+        result = subprocess.run(command, **kwargs)
+        if s is not None:
+            s.set(returncode=result.returncode)
+        return result
@@ -1,25 +1,46 @@
+import asyncio
+import aiohttp
 import discord
-import emoji
+import logging
 import pathlib
 import subprocess
 import base64
-import cv2
 from .client import client
 import tempfile
-import math
+import contextvars
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import time
 from io import BytesIO
 from PIL import Image
 import pdf2image
+from dataclasses import dataclass
+from typing import Any, Callable
 
-from .regex import tex_message
-from .tex_templates import DEFAULT_TEX_TEMPLATE
+from .tex_templates import DEFAULT_TEX_TEMPLATE, MINIMAL_TEX_TEMPLATE
 from .client import client
-from .regex import mentions, double_quotes, single_quotes, markdown_list
+from .regex import math_segment, markdown_syntax, plain_special
+from .normalize import normalize
+from .keyframes import extract_keyframes
+from .tex_blocks import choose_dpi, chunk_blocks, dvi_size, split_blocks, stitch
+from .metrics import attachment_latency, render_tex_latency, tex_documents
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# latex and dvipng run as subprocesses, so threads are enough to use several cores
+tex_workers: int = int(os.getenv("TEX_WORKERS", str(min(4, os.cpu_count() or 1))))
+tex_pool = ThreadPoolExecutor(max_workers=tex_workers, thread_name_prefix="tex")
+max_files_per_message: int = 10
+# Attachments of other types aren't sent to the model, so they aren't downloaded either
+supported_content_types: tuple[str, ...] = ("image/", "video/", "audio/", "application/pdf", "text/")
 
 
 def has_audio(filename: str) -> bool:
     """Check if the file has audio."""
-    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
+    result = tracing.run(["ffprobe", "-v", "error", "-show_entries",
                              "format=nb_streams", "-of",
                              "default=noprint_wrappers=1:nokey=1", filename],
         stdout=subprocess.PIPE,
@@ -30,13 +51,13 @@ def has_audio(filename: str) -> bool:
 def mp4_to_mp3(mp4_path: str, mp3_path: str) -> None:
     """Convert MP4 file to MP3."""
     command = f"ffmpeg -y -i {mp4_path} -vn -ar 44100 -ac 2 -b:a 192k {mp3_path}"
-    subprocess.run(command, shell=True, check=True)
+    tracing.run(command, shell=True, check=True)
 
 
 def audio_to_mp3(audio_path: str, mp3_path: str) -> None:
     """Convert audio file to MP3."""
     command = f"ffmpeg -y -i {audio_path} -vn -ar 44100 -ac 2 -b:a 192k {mp3_path}"
-    subprocess.run(command, shell=True, check=True)
+    tracing.run(command, shell=True, check=True)
 
 
 def process_video(video_data: bytes) -> list:
@@ -45,46 +66,38 @@ def process_video(video_data: bytes) -> list:
         temp_video.write(video_data)
         temp_video.seek(0)
         has_a = has_audio(temp_video.name)
-        video_stream = cv2.VideoCapture(temp_video.name)
+        keyframes = extract_keyframes(temp_video.name)
+        span = tracing.current_span.get()
+        if span is not None:
+            span.set(keyframes=len(keyframes))
         frames_and_transcription = []
         frames_and_transcription.append(
             {
                 "type": "input_text",
-                "text": "A video is starting right now. The next inputs are 40 (or less) evenly spaced frames and the last one is the transcription, if any audio. There's no transcription if it's null, empty or senseless.",
+                "text": f"A video is starting right now. The next inputs are {len(keyframes)} frames, chosen where the content changes, each one after its timestamp, and the last one is the transcription, if any audio. There's no transcription if it's null, empty or senseless.",
             }
         )
-        frame_step = math.ceil(video_stream.get(cv2.CAP_PROP_FRAME_COUNT) / 10)
-        frame_count = 0
-        while video_stream.isOpened():
-            success, frame = video_stream.read()
-            if not success:
-                break
-            bio = BytesIO()
-            Image.fromarray(frame).convert("RGB").save(bio, format="JPEG")
-            bio.seek(0)
-            data = bio.read()
-            data = base64.b64encode(data).decode("utf-8")
-            if frame_count % frame_step == 0:
-                print(data)
-                frames_and_transcription.append(
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{data}",
-                        "detail": "high",
-                    }
-                )
-            frame_count += 1
-        video_stream.release()
+        for keyframe in keyframes:
+            data = base64.b64encode(keyframe.jpeg).decode("utf-8")
+            frames_and_transcription.append(
+                {
+                    "type": "input_text",
+                    "text": f"{int(keyframe.seconds // 60)}:{keyframe.seconds % 60:04.1f}",
+                }
+            )
+            frames_and_transcription.append(
+                {
+                    "type": "input_image",
+                    "image_url": f"data:image/jpeg;base64,{data}",
+                    "detail": "high",
+                }
+            )
         if has_a:
             with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_audio:
                 mp4_to_mp3(temp_video.name, temp_audio.name)
                 temp_audio.seek(0)
-                transcription = client.audio.transcriptions.create(
-                    file=open(temp_audio.name, "rb"),
-                    model="whisper"
-                )
-                text = transcription.text
-                print(text)
+                text = transcribe(temp_audio.name)
+                logger.debug("Video transcription: %s", text)
                 frames_and_transcription.append(
                     {
                         "type": "input_text",
@@ -100,129 +113,298 @@ def process_video(video_data: bytes) -> list:
     return frames_and_transcription
 
 
-async def attachment_parts(attachments: list[discord.Attachment]) -> list:
-    """Convert attachments to parts for the OpenAI API."""
+@dataclass(frozen=True)
+class AttachmentRef:
+    """Lightweight reference to a Discord attachment, downloaded and processed only when needed."""
+    url: str
+    filename: str
+    content_type: str
+    size: int
+
+    @classmethod
+    def from_attachment(cls, attachment: discord.Attachment) -> "AttachmentRef":
+        return cls(
+            url=attachment.url,
+            filename=attachment.filename,
+            content_type=attachment.content_type or "application/octet-stream",
+            size=attachment.size,
+        )
+
+    def describe(self) -> str:
+        return f"{self.filename} ({self.content_type}, {self.size} bytes)"
+
+
+def transcribe(mp3_path: str) -> str:
+    """Transcribe an MP3 file with Whisper."""
+    with open(mp3_path, "rb") as f:
+        transcription = client.audio.transcriptions.create(
+            file=f,
+            model="whisper"
+        )
+    return transcription.text
+
+
+def process_audio(audio_data: bytes) -> str:
+    """Convert audio data to MP3 and return its transcription."""
+    with tempfile.NamedTemporaryFile(delete=False) as temp_audio:
+        temp_audio.write(audio_data)
+        temp_audio.seek(0)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_mp3:
+            audio_to_mp3(temp_audio.name, temp_mp3.name)
+            return transcribe(temp_mp3.name)
+
+
+def process_pdf(pdf_data: bytes) -> list[str]:
+    """Rasterise a PDF and return its pages as base64 encoded JPEGs."""
+    pages = []
+    for image in pdf2image.convert_from_bytes(pdf_data):
+        bio = BytesIO()
+        image.save(bio, format="JPEG")
+        bio.seek(0)
+        pages.append(base64.b64encode(bio.read()).decode("utf-8"))
+    return pages
+
+
+async def attachment_parts(attachments: list[AttachmentRef]) -> list:
+    """Download attachments and convert them to parts for the OpenAI API."""
     parts = []
-    for attachment in attachments:
-        if attachment.content_type.startswith("image/"):
-            image_data = await attachment.read()
-            encoded_image = base64.b64encode(image_data).decode("utf-8")
-            parts.append(
-                {
-                    "type": "input_image",
-                    "image_url": f"data:{attachment.content_type};base64,{encoded_image}",
-                    "detail": "high",
-                }
-            )
-        elif attachment.content_type.startswith("video/"):
-            video_data = await attachment.read()
-            parts.extend(process_video(video_data))
-        elif attachment.content_type.startswith("audio/"):
-            audio_data = await attachment.read()
-            with tempfile.NamedTemporaryFile(delete=False) as temp_audio:
-                temp_audio.write(audio_data)
-                temp_audio.seek(0)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_mp3:
-                    audio_to_mp3(temp_audio.name, temp_mp3.name)
-                    temp_mp3.seek(0)
-                    transcription = client.audio.transcriptions.create(
-                        file=open(temp_mp3.name, "rb"),
-                        model="whisper"
+    if not attachments:
+        return parts
+    async with aiohttp.ClientSession() as session:
+        for attachment in attachments:
+            if not attachment.content_type.startswith(supported_content_types):
+                logger.debug("Skipping unsupported attachment %s", attachment.describe())
+                continue
+            with tracing.span("attachment", content_type=attachment.content_type, size=attachment.size):
+                try:
+                    parts.extend(await _attachment_parts(session, attachment))
+                except aiohttp.ClientError as e:
+                    logger.warning("Couldn't download attachment %s: %s", attachment.describe(), e)
+                    parts.append(
+                        {
+                            "type": "input_text",
+                            "text": f"The attachment {attachment.filename} couldn't be downloaded.",
+                        }
                     )
-                    text = transcription.text
-                    print("Transcription:", text)
+                except Exception:
+                    # ffmpeg, pdf2image, Whisper or the text encoding can fail on a single file
+                    logger.exception("Couldn't process attachment %s", attachment.describe())
                     parts.append(
                         {
                             "type": "input_text",
-                            "text": f"An audio has been sent.\n\n# Transcription\n{text}",
+                            "text": f"The attachment {attachment.filename} couldn't be processed.",
                         }
                     )
-        elif attachment.content_type.startswith("application/pdf"):
-            pdf_data = await attachment.read()
-            images = pdf2image.convert_from_bytes(pdf_data)
-            parts.append(
-                {
-                    "type": "input_text",
-                    "text": f"The following {len(images)} pages are from a PDF file.",
-                }
-            )
-            for i, image in enumerate(images):
-                bio = BytesIO()
-                image.save(bio, format="JPEG")
-                bio.seek(0)
-                data = bio.read()
-                data = base64.b64encode(data).decode("utf-8")
-                parts.append(
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{data}",
-                        "detail": "high",
-                    }
-                )
-            parts.append(
-                {
-                    "type": "input_text",
-                    "text": "The PDF file has ended.",
-                }
-            )
-        elif attachment.content_type.startswith("text/"):
-            text_data = await attachment.read()
-            text = text_data.decode("utf-8")
+    return parts
+
+
+async def _attachment_parts(session: aiohttp.ClientSession, attachment: AttachmentRef) -> list:
+    """Download and convert a single attachment."""
+    parts = []
+    start = time.perf_counter()
+    async with session.get(attachment.url) as response:
+        response.raise_for_status()
+        data = await response.read()
+    if attachment.content_type.startswith("image/"):
+        encoded_image = base64.b64encode(data).decode("utf-8")
+        parts.append(
+            {
+                "type": "input_image",
+                "image_url": f"data:{attachment.content_type};base64,{encoded_image}",
+                "detail": "high",
+            }
+        )
+    elif attachment.content_type.startswith("video/"):
+        parts.extend(await asyncio.to_thread(process_video, data))
+    elif attachment.content_type.startswith("audio/"):
+        text = await asyncio.to_thread(process_audio, data)
+        logger.debug("Audio transcription: %s", text)
+        parts.append(
+            {
+                "type": "input_text",
+                "text": f"An audio has been sent.\n\n# Transcription\n{text}",
+            }
+        )
+    elif attachment.content_type.startswith("application/pdf"):
+        pages = await asyncio.to_thread(process_pdf, data)
+        parts.append(
+            {
+                "type": "input_text",
+                "text": f"The following {len(pages)} pages are from a PDF file.",
+            }
+        )
+        for page in pages:
             parts.append(
                 {
-                    "type": "input_text",
-                    "text": f"A text file has been sent with mime type {attachment.content_type}.\n\n# Content\n{text}",
+                    "type": "input_image",
+                    "image_url": f"data:image/jpeg;base64,{page}",
+                    "detail": "high",
                 }
             )
+        parts.append(
+            {
+                "type": "input_text",
+                "text": "The PDF file has ended.",
+            }
+        )
+    elif attachment.content_type.startswith("text/"):
+        text = data.decode("utf-8")
+        parts.append(
+            {
+                "type": "input_text",
+                "text": f"A text file has been sent with mime type {attachment.content_type}.\n\n# Content\n{text}",
+            }
+        )
+    attachment_latency.observe(time.perf_counter() - start, content_type=attachment.content_type.split("/")[0])
     return parts
 
 
-def change_prefix_and_suffix(tex: str) -> str:
-    """Change the prefix and suffix of a TeX string."""
-    if tex.startswith("\\(") and tex.endswith("\\)"):
-        return f"${tex[2:-2]}$"
-    elif tex.startswith("\\[") and tex.endswith("\\]"):
-        return f"$$\\{tex[2:-2]}$$"
+async def render_tex(message: discord.Message, contents: str) -> None:
+    with render_tex_latency.time(), tracing.span("render_tex", length=len(contents)):
+        await _render_tex(message, contents)
+
+
+def needs_markdown(tex: str) -> bool:
+    """Whether the text outside the math of a normalized reply uses Markdown, code or links."""
+    return markdown_syntax.search(math_segment.sub(" ", tex)) is not None
+
+
+def escape_plain(tex: str) -> str:
+    """Escape the special characters of the text outside the math, for the minimal template."""
+    def escape(text: str) -> str:
+        return plain_special.sub(lambda m: "\\ldots{}" if m.group(0) == "..." else f"\\{m.group(0)}", text)
+
+    parts = []
+    last = 0
+    for match in math_segment.finditer(tex):
+        parts.append(escape(tex[last:match.start()]))
+        parts.append(match.group(0))
+        last = match.end()
+    parts.append(escape(tex[last:]))
+    return "".join(parts)
+
+
+def write_tex(temp_dir: pathlib.Path, name: str, contents: str) -> bool:
+    """Write a Markdown reply as a standalone LaTeX document.
+
+    Replies that are only text and math get the minimal template. Returns whether the
+    Markdown template was needed instead.
+    """
+    tex = normalize(contents)
+    markdown = needs_markdown(tex)
+    if markdown:
+        document = DEFAULT_TEX_TEMPLATE.format(md=tex)
     else:
-        return tex
+        document = MINIMAL_TEX_TEMPLATE.format(md=escape_plain(tex))
+    (temp_dir / f"{name}.tex").write_text(document, encoding="utf-8")
+    tex_documents.inc(template="markdown" if markdown else "minimal")
+    return markdown
 
 
-def fix_tex_bugs(text: str) -> str:
-    without_emojis = emoji.replace_emoji(text, "")
-    without_mentions = mentions.sub("Usuario de Discord", without_emojis)
-    beautify_quotes = double_quotes.sub(r"“\1”", without_mentions)
-    beautify_quotes = single_quotes.sub(r"‘\1’", beautify_quotes)
-    force_dollars = tex_message.sub(
-        lambda m: change_prefix_and_suffix(m.group(0)), beautify_quotes
-    )
-    result = markdown_list.sub(
-        lambda m: f"* {m.group(2)}", force_dollars
-    )
-    return result
+def run_latex(temp_dir: pathlib.Path, name: str, markdown: bool = True) -> None:
+    """Compile `<name>.tex` to DVI.
 
+    The markdown package runs Lua through -shell-escape and needs two passes. Documents with
+    the minimal template are compiled once, without -shell-escape.
+    """
+    command = ["latex", "-interaction=nonstopmode", f"{name}.tex"]
+    if markdown:
+        command.insert(1, "-shell-escape")
+    for _ in range(2 if markdown else 1):
+        tracing.run(command, cwd=temp_dir, check=True, stdout=subprocess.DEVNULL)
 
-async def render_tex(message: discord.Message, contents: str) -> None:
-    temp_dir: pathlib.Path = pathlib.Path("temp")
-    temp_dir.mkdir(exist_ok=True)
-    md = fix_tex_bugs(contents)
+
+def run_dvipng(temp_dir: pathlib.Path, name: str, dpi: int = 500) -> pathlib.Path:
+    """Convert `<name>.dvi` to a transparent PNG."""
+    tracing.run(["dvipng", "-T", "tight", "-o", f"{name}.png", "-bg", "Transparent", "-D", str(dpi), f"{name}.dvi"], cwd=temp_dir, check=True, stdout=subprocess.DEVNULL)
+    return temp_dir / f"{name}.png"
+
+
+def compile_block(temp_dir: pathlib.Path, name: str, markdown: str) -> tuple[float, float] | None:
+    """Compile a piece of a reply to DVI. Returns its size in inches, or None if it doesn't compile."""
+    uses_markdown = write_tex(temp_dir, name, markdown)
+    try:
+        run_latex(temp_dir, name, uses_markdown)
+    except subprocess.CalledProcessError:
+        return None
+    return dvi_size(str(temp_dir / f"{name}.dvi"))
+
+
+def rasterize_block(temp_dir: pathlib.Path, name: str, dpi: int) -> Image.Image | None:
+    try:
+        png = run_dvipng(temp_dir, name, dpi=dpi)
+    except subprocess.CalledProcessError:
+        return None
+    with Image.open(png) as image:
+        image.load()
+        return image
+
+
+async def compile_blocks(temp_dir: pathlib.Path, chunks: list[list[str]]) -> list[Image.Image]:
+    """Compile chunks of blocks in parallel, in order.
+
+    When a chunk fails, its blocks are compiled one by one, so a bad block only loses itself.
+    All the blocks are rasterized at the same DPI, the highest one that keeps their total
+    area within the pixel budget.
+    """
+    loop = asyncio.get_running_loop()
+
+    def submit(function: Callable[..., Any], *args: Any) -> asyncio.Future:
+        context = contextvars.copy_context()
+        return loop.run_in_executor(tex_pool, context.run, function, *args)
+
+    sizes = await asyncio.gather(*(
+        submit(compile_block, temp_dir, str(i), "\n\n".join(chunk)) for i, chunk in enumerate(chunks)
+    ))
+    compiled: list[tuple[str, tuple[float, float]]] = []
+    for i, (chunk, size) in enumerate(zip(chunks, sizes)):
+        if size is not None:
+            compiled.append((str(i), size))
+            continue
+        if len(chunk) == 1:
+            logger.warning("Error rendering LaTeX block: %.80r", chunk[0])
+            continue
+        retries = await asyncio.gather(*(
+            submit(compile_block, temp_dir, f"{i}-{j}", block) for j, block in enumerate(chunk)
+        ))
+        for j, (block, retry) in enumerate(zip(chunk, retries)):
+            if retry is None:
+                logger.warning("Error rendering LaTeX block: %.80r", block)
+            else:
+                compiled.append((f"{i}-{j}", retry))
+    dpi = choose_dpi(sum(width * height for _, (width, height) in compiled))
+    images = await asyncio.gather(*(submit(rasterize_block, temp_dir, name, dpi) for name, _ in compiled))
+    span = tracing.current_span.get()
+    if span is not None:
+        span.set(dpi=dpi, pixels=sum(image.width * image.height for image in images if image is not None))
+    return [image for image in images if image is not None]
+
+
+async def _render_tex(message: discord.Message, contents: str) -> None:
+    pathlib.Path("temp").mkdir(exist_ok=True)
+    temp_dir = pathlib.Path(tempfile.mkdtemp(dir="temp"))
     channel = message.channel
     author = message.author
-    temp_tex = temp_dir / f"{message.id}.tex"
-    temp_png = temp_dir / f"{message.id}.png"
-    temp_tex.write_text(DEFAULT_TEX_TEMPLATE.format(md=md), encoding="utf-8")
-    try:
-        for _ in range(2):
-            subprocess.run(" ".join(["cd", "temp", "&&", "latex", "-interaction=nonstopmode", "-shell-escape", f"{message.id}.tex"]), check=True, shell=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error rendering LaTeX: {e}")
-        return
     try:
-        subprocess.run(" ".join(["cd", "temp", "&&", "dvipng", "-T", "tight", "-o", f"{message.id}.png", "-bg", "Transparent", "-D", "500", f"{message.id}.dvi"]), check=True, shell=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error rendering LaTeX: {e}")
-        return
-    with open(temp_png, "rb") as f:
-        if isinstance(channel, discord.DMChannel):
-            await author.send(file=discord.File(f, "texput.png"), reference=message)
-        else:
-            await channel.send(file=discord.File(f, "texput.png"), reference=message)
+        chunks = chunk_blocks(split_blocks(contents))
+        with tracing.span("tex.compile", chunks=len(chunks)):
+            images = await compile_blocks(temp_dir, chunks)
+        if not images:
+            return
+        start = time.perf_counter()
+        tiles = await asyncio.to_thread(stitch, images)
+        logger.info(
+            "Rendered LaTeX in %d images of %d KB, encoded in %.2f s",
+            len(tiles),
+            sum(len(tile) for tile in tiles) // 1024,
+            time.perf_counter() - start,
+        )
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    files = [discord.File(BytesIO(tile), f"texput-{i}.png") for i, tile in enumerate(tiles, start=1)]
+    for i in range(0, len(files), max_files_per_message):
+        with tracing.span("discord.send", kind="tex", files=len(files[i:i + max_files_per_message])):
+            if isinstance(channel, discord.DMChannel):
+                await author.send(files=files[i:i + max_files_per_message], reference=message)
+            else:
+                await channel.send(files=files[i:i + max_files_per_message], reference=message)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+import discord
+
+from .ai import AI
+from .broker import Broker, Job, lease_seconds
+from .utils import AttachmentRef
+from . import tools, tracing
+
+
+logger = logging.getLogger(__name__)
+
+worker_concurrency: int = int(os.getenv("WORKER_CONCURRENCY", "1"))
+poll_interval: float = 0.5
+
+
+class Worker:
+    """Answers the requests that the gateway process puts on the broker.
+
+    The worker only uses Discord's REST API, so any number of them can run, and they can be
+    restarted, while the gateway keeps its connection. Jobs of a worker that stops without
+    finishing them are leased again by another one once their lease expires.
+    """
+
+    def __init__(self, client: discord.Bot, broker: Broker) -> None:
+        self.client = client
+        self.broker = broker
+        self.cog = AI(client)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        # Renders of every worker wait in the same queue, in the broker
+        tools.share_render_queue(broker, self.name)
+        self.stopping = asyncio.Event()
+
+    async def run(self) -> None:
+        semaphore = asyncio.Semaphore(worker_concurrency)
+        tasks: set[asyncio.Task] = set()
+        await asyncio.to_thread(self.broker.purge)
+        logger.info("Worker %s is ready", self.name)
+        while not self.stopping.is_set():
+            await semaphore.acquire()
+            job = await asyncio.to_thread(self.broker.lease, self.name)
+            if job is None:
+                semaphore.release()
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self.process(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: semaphore.release())
+        # Finish the jobs in progress, so a restart doesn't answer them twice
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def process(self, job: Job) -> None:
+        answer = asyncio.create_task(self.answer(job))
+        keepalive = asyncio.create_task(self.keep_leased(job, answer))
+        error = None
+        try:
+            await answer
+        except asyncio.CancelledError:
+            error = "Cancelled"
+        except Exception as e:
+            logger.exception("Error processing job %d", job.id)
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            keepalive.cancel()
+        await asyncio.to_thread(self.broker.complete, job.id, self.name, error)
+
+    async def answer(self, job: Job) -> None:
+        payload = job.payload
+        with tracing.start_trace("worker_job", job_id=job.id, message_id=job.message_id, attempt=job.attempts):
+            channel = await self.client.fetch_channel(payload["channel_id"])
+            message = await channel.fetch_message(job.message_id)
+            entries = [
+                {**entry, "attachments": [AttachmentRef(**a) for a in entry["attachments"]]}
+                for entry in payload["entries"]
+            ]
+            await self.cog.answer_entries(message, entries, payload["dropped"])
+
+    async def keep_leased(self, job: Job, answer: asyncio.Task) -> None:
+        """Renew the lease of a job while it's answered, and stop answering if it was cancelled."""
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if not await asyncio.to_thread(self.broker.renew, job.id, self.name):
+                logger.info("Job %d was cancelled or taken by another worker", job.id)
+                tools.render_queue.cancel(job.message_id)
+                answer.cancel()
+                return
+
+
+async def run_worker(token: str) -> None:
+    # Logging in only uses the REST API. The gateway connection belongs to the gateway process.
+    client = discord.Bot(intents=discord.Intents.none())
+    await client.login(token)
+    worker = Worker(client, Broker())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stopping.set)
+    try:
+        await worker.run()
+    finally:
+        await client.close()